@@ -257,6 +257,50 @@ typedef struct {
 	uint16_t modifiedFlagsMask, testedFlagsMask, undefinedFlagsMask;
 } _DInst;
 
+/* Size in bytes of the opcodes bitmap of a _DecodeFilter, a bit for every possible opcode ID. */
+#define FILTER_OPCODES_SIZE (0x10000 / 8)
+
+/*
+ * Decides which of the decoded instructions are returned, see distorm_decompose_filtered.
+ * An instruction is returned only if it matches all of the criteria, a zero (or NULL) criterion matches any instruction.
+ * Undecodable instructions are never returned.
+ */
+typedef struct {
+	/* Bitmap of FILTER_OPCODES_SIZE bytes, the bit of an opcode ID (see mnemonics.h) is (opcodes[id >> 3] >> (id & 7)) & 1. */
+	const uint8_t* opcodes;
+	/* A bit for every instruction set class, eg. (1 << ISC_SSE) | (1 << ISC_SSE2). */
+	uint32_t iscMask;
+	/* A bit for every flow control type, eg. (1 << FC_CALL), (1 << FC_NONE) stands for the other instructions. */
+	uint32_t fcMask;
+	/* Register classes (RM_XXX) that the instruction uses at least one of. */
+	uint32_t usedRegistersMask;
+	/* Flags that the instruction has all of, FLAG_RIP_RELATIVE and FLAG_PRIVILEGED_INSTRUCTION are the useful ones. */
+	uint16_t flags;
+} _DecodeFilter;
+
+/* Reason that distorm_decompose_region stopped decoding for, see _DecodeRegion. */
+typedef enum {
+	DECSTOP_NONE, /* Nothing was decoded, because of an input error. */
+	DECSTOP_CODE_END, /* The whole code was decoded. */
+	DECSTOP_REGION_END, /* The next instruction starts at the endOffset of the region, or after it. */
+	DECSTOP_RESULTS_FULL, /* There's no more room in the result array, but there's more code (DECRES_MEMORYERR). */
+	DECSTOP_FLOW_CONTROL, /* The last instruction is a flow control one that a DF_STOP_ON_XXX feature stops on. */
+	DECSTOP_PRIVILEGED, /* The last instruction is privileged (DF_STOP_ON_PRIVILEGED). */
+	DECSTOP_UNDECODABLE, /* The last instruction is an undecodable byte (DF_STOP_ON_UNDECODEABLE). */
+	DECSTOP_TRUNCATED /* The code ends in the middle of the next instruction (DF_STOP_ON_TRUNCATED, DECRES_TRUNCATED). */
+} _DecodeStop;
+
+/*
+ * Bounds the decoding to a region of the code, see distorm_decompose_region.
+ * An instruction that starts before endOffset is decoded whole, even if it ends after it.
+ */
+typedef struct {
+	/* IN: Offset (like the codeOffset of the _CodeInfo) where the region ends, the decoding doesn't go past it. */
+	_OffsetType endOffset;
+	/* OUT: Why the decoding stopped, so the last instruction doesn't have to be inspected to tell. */
+	_DecodeStop stop;
+} _DecodeRegion;
+
 #ifndef DISTORM_LIGHT
 
 /* Static size of strings. Do not change this value. Keep Python wrapper in sync. */
@@ -398,6 +442,11 @@ typedef struct {
 #define DF_FILL_EFLAGS 0x4000
 /* The decoder will use the addrMask in CodeInfo structure instead of DF_MAXIMUM_ADDR16/32. */
 #define DF_USE_ADDR_MASK 0x8000
+/*
+ * The decoder will stop and return DECRES_TRUNCATED when the code ends in the middle of an instruction,
+ * instead of returning its bytes as undecodable. The nextOffset of the CodeInfo is where that instruction starts.
+ */
+#define DF_STOP_ON_TRUNCATED 0x10000
 
 /* The decoder will stop and return to the caller when any flow control instruction was decoded. */
 #define DF_STOP_ON_FLOW_CONTROL (DF_STOP_ON_CALL | DF_STOP_ON_RET | DF_STOP_ON_SYS | DF_STOP_ON_UNC_BRANCH | DF_STOP_ON_CND_BRANCH | DF_STOP_ON_INT | DF_STOP_ON_CMOV | DF_STOP_ON_HLT)
@@ -425,7 +474,7 @@ typedef struct {
 #define FC_HLT 8
 
 /* Return code of the decoding function. */
-typedef enum { DECRES_NONE, DECRES_SUCCESS, DECRES_MEMORYERR, DECRES_INPUTERR } _DecodeResult;
+typedef enum { DECRES_NONE, DECRES_SUCCESS, DECRES_MEMORYERR, DECRES_INPUTERR, DECRES_TRUNCATED } _DecodeResult;
 
 /* Define the following interface functions only for outer projects. */
 #if !(defined(DISTORM_STATIC) || defined(DISTORM_DYNAMIC))
@@ -451,12 +500,40 @@ typedef enum { DECRES_NONE, DECRES_SUCCESS, DECRES_MEMORYERR, DECRES_INPUTERR }
 
 /* distorm_decompose
  * See more documentation online at the GitHub project's wiki.
- *
+ * Return: Same as distorm_decode, and with the DF_STOP_ON_TRUNCATED feature also DECRES_TRUNCATED,
+ *         when the code ends in the middle of an instruction, which starts at the nextOffset of ci.
+ */
+
+/* distorm_decompose_filtered
+ * Same as distorm_decompose, but only the instructions that match the filter are written to the result array,
+ * it's a generalization of the DF_RETURN_FC_ONLY feature. See _DecodeFilter.
+ */
+
+/* distorm_decompose_region
+ * Same as distorm_decompose, but the decoding stops at the endOffset of the region (see _DecodeRegion),
+ * and the reason that it stopped for is returned in its stop field, eg. DECSTOP_FLOW_CONTROL.
+ * An endOffset at or below the codeOffset of ci is an empty region (DECSTOP_REGION_END), unless the code wraps around
+ * the end of the address space and endOffset is in its wrapped part, then the region wraps around too.
+ * That's what decoding a basic block needs, together with the DF_STOP_ON_XXX features.
+ */
+
+/* distorm_lengths
+ * Decodes the instructions like distorm_decompose does, but only returns the length of every instruction,
+ * a byte each in the lengths array, which is zero for an undecodable byte (that is skipped).
+ * That's all that scanning for instruction boundaries needs, without filling and going through _DInst structures.
+ * Only the DF_SINGLE_BYTE_STEP and DF_STOP_ON_TRUNCATED features apply, with DF_SINGLE_BYTE_STEP there's a length per byte.
+ * Return: Same as distorm_decompose.
  */
 #ifdef SUPPORT_64BIT_OFFSET
 
 	_DecodeResult distorm_decompose64(_CodeInfo* ci, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
 	#define distorm_decompose distorm_decompose64
+	_DecodeResult distorm_decompose_filtered64(_CodeInfo* ci, const _DecodeFilter* filter, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_decompose_filtered distorm_decompose_filtered64
+	_DecodeResult distorm_decompose_region64(_CodeInfo* ci, _DecodeRegion* region, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_decompose_region distorm_decompose_region64
+	_DecodeResult distorm_lengths64(_CodeInfo* ci, unsigned char lengths[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_lengths distorm_lengths64
 
 #ifndef DISTORM_LIGHT
 	/* If distorm-light is defined, we won't export these text-formatting functionality. */
@@ -470,6 +547,12 @@ typedef enum { DECRES_NONE, DECRES_SUCCESS, DECRES_MEMORYERR, DECRES_INPUTERR }
 
 	_DecodeResult distorm_decompose32(_CodeInfo* ci, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
 	#define distorm_decompose distorm_decompose32
+	_DecodeResult distorm_decompose_filtered32(_CodeInfo* ci, const _DecodeFilter* filter, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_decompose_filtered distorm_decompose_filtered32
+	_DecodeResult distorm_decompose_region32(_CodeInfo* ci, _DecodeRegion* region, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_decompose_region distorm_decompose_region32
+	_DecodeResult distorm_lengths32(_CodeInfo* ci, unsigned char lengths[], unsigned int maxInstructions, unsigned int* usedInstructionsCount);
+	#define distorm_lengths distorm_lengths32
 
 #ifndef DISTORM_LIGHT
 	/* If distorm-light is defined, we won't export these text-formatting functionality. */
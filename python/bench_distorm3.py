@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+#
+# diStorm3 Python binding benchmarks
+# Run: python bench_distorm3.py [benchmark names...]
+#
+
+import os
+import sys
+import timeit
+import random
+
+import distorm3
+
+def _randomCode(size, seed = 1):
+	r = random.Random(seed)
+	return bytes(bytearray([r.randint(0, 255) for i in range(size)]))
+
+def _report(name, seconds, count, unit = "call"):
+	print("%-40s %10.0f ns/%s" % (name, seconds * 1e9 / count, unit))
+
+def _withoutNative(f):
+	native = distorm3._native
+	distorm3._native = None
+	try:
+		return f()
+	finally:
+		distorm3._native = native
+
+def bench_aio(size = 4 << 20):
+	"Decomposing in an asyncio event loop, the longest the loop was blocked, a plain generator versus adecompose."
+	import asyncio
+	import distorm3.aio
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	async def plain():
+		for inst in distorm3.DecomposeGenerator(0, code, dt):
+			yield inst
+	async def measure(insts):
+		stalls = [0]
+		done = []
+		async def ticker():
+			while not done:
+				start = timeit.default_timer()
+				await asyncio.sleep(0.001)
+				stalls.append(timeit.default_timer() - start - 0.001)
+		task = asyncio.ensure_future(ticker())
+		await asyncio.sleep(0.01)
+		start = timeit.default_timer()
+		count = 0
+		async for inst in insts:
+			count += 1
+		seconds = timeit.default_timer() - start
+		done.append(True)
+		await task
+		return seconds, count, max(stalls)
+	for name, insts in (("DecomposeGenerator", plain), ("adecompose", lambda: distorm3.aio.adecompose(0, code, dt))):
+		seconds, count, stall = asyncio.run(measure(insts()))
+		_report(name, seconds, count, "instruction")
+		print("%-40s %10.0f us" % ("%s longest event loop stall" % name, stall * 1e6))
+
+def bench_threads(size = 1 << 20, maxThreads = 32):
+	"Threads that decompose at once, total throughput by the number of threads (it scales in free-threaded builds)."
+	import threading
+	gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+	print("GIL is %s" % ("enabled" if gil else "disabled"))
+	dt = distorm3.Decode64Bits
+	calls = [("Decompose", lambda code: distorm3.Decompose(0, code, dt)),
+		("Decoder.local().decompose", lambda code: distorm3.Decoder.local(dt).decompose(0, code))]
+	try:
+		import numpy
+		calls.append(("DecomposeArray", lambda code: distorm3.DecomposeArray(0, code, dt)))
+	except ImportError:
+		pass
+	for name, call in calls:
+		threads = 1
+		while threads <= maxThreads:
+			codes = [_randomCode(size // threads, seed = i) for i in range(threads)]
+			def run():
+				workers = [threading.Thread(target = call, args = (code,)) for code in codes]
+				for t in workers:
+					t.start()
+				for t in workers:
+					t.join()
+			_report("%s, %d threads" % (name, threads), min(timeit.repeat(run, number = 1, repeat = 3)), size, "byte")
+			threads *= 2
+
+def bench_cache(count = 20000, blocksNo = 64):
+	"A trace of hot basic blocks decoded over and over, without and with a DecodeCache."
+	import distorm3.cache
+	dt = distorm3.Decode64Bits
+	r = random.Random(4)
+	code = _randomCode(1 << 12)
+	blocks = [(r.randrange(len(code) - 64), r.randrange(8, 64)) for i in range(blocksNo)]
+	trace = [blocks[r.randrange(blocksNo)] for i in range(count)]
+	view = memoryview(code)
+	cache = distorm3.cache.DecodeCache()
+	for name, decompose in (("Decompose", distorm3.Decompose), ("DecodeCache.decompose", cache.decompose)):
+		_report(name, min(timeit.repeat(lambda: [decompose(0x1000 + i, view[i : i + n], dt) for (i, n) in trace], number = 1, repeat = 3)), count, "block")
+	# The same bytes at other addresses reuse the entries.
+	_report("DecodeCache.decompose, relocated", min(timeit.repeat(lambda: [cache.decompose(0x7000 + i * 3, view[i : i + n], dt) for (i, n) in trace], number = 1, repeat = 3)), count, "block")
+	for name, decode in (("Decode", distorm3.Decode), ("DecodeCache.decode", cache.decode)):
+		_report(name, min(timeit.repeat(lambda: [decode(0x1000 + i, view[i : i + n], dt) for (i, n) in trace], number = 1, repeat = 3)), count, "block")
+	_report("DecodeCache.decode, relocated", min(timeit.repeat(lambda: [cache.decode(0x7000 + i * 3, view[i : i + n], dt) for (i, n) in trace], number = 1, repeat = 3)), count, "block")
+	print("%d hits, %d misses, %d entries, %d bytes" % (cache.hits, cache.misses, len(cache), cache.size))
+
+def bench_diskcache(size = 16 << 20):
+	"Decomposing a big buffer into an array, cold and with a warm DiskCache of a previous run."
+	import shutil
+	import tempfile
+	import distorm3.cache
+	try:
+		import numpy
+	except ImportError:
+		print("numpy isn't installed")
+		return
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	directory = tempfile.mkdtemp()
+	try:
+		_report("DecomposeArray", min(timeit.repeat(lambda: distorm3.DecomposeArray(0, code, dt), number = 1, repeat = 3)), size, "byte")
+		def cold():
+			distorm3.cache.DiskCache(directory).clear()
+			return distorm3.cache.DiskCache(directory).decomposeArray(0, code, dt)
+		_report("DiskCache.decomposeArray, cold", min(timeit.repeat(cold, number = 1, repeat = 3)), size, "byte")
+		# A new cache object, like a new process would have.
+		_report("DiskCache.decomposeArray, warm", min(timeit.repeat(lambda: distorm3.cache.DiskCache(directory).decomposeArray(0, code, dt), number = 1, repeat = 3)), size, "byte")
+		_report("DiskCache.decomposeArray, warm, relocated", min(timeit.repeat(lambda: distorm3.cache.DiskCache(directory).decomposeArray(0x1000, code, dt), number = 1, repeat = 3)), size, "byte")
+	finally:
+		shutil.rmtree(directory)
+
+def bench_lengths(size = 16 << 20):
+	"Scanning a big buffer for the lengths of its instructions, compared to decomposing it."
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	_report("DecodeLengths", min(timeit.repeat(lambda: distorm3.DecodeLengths(code, dt), number = 1, repeat = 3)), size, "byte")
+	try:
+		import numpy
+		_report("DecomposeArray", min(timeit.repeat(lambda: distorm3.DecomposeArray(0, code, dt), number = 1, repeat = 3)), size, "byte")
+	except ImportError:
+		pass
+	view = memoryview(code)[:size // 16]
+	_report("Decompose", min(timeit.repeat(lambda: distorm3.Decompose(0, view, dt), number = 1, repeat = 3)), size // 16, "byte")
+
+def bench_bitmap(size = 16 << 20, count = 100000):
+	"Bitmaps of the instructions' starts of a big buffer, building them and testing addresses, compared to a set of addresses."
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	r = random.Random(5)
+	addresses = [r.randrange(size) for i in range(count)]
+	_report("DecodeBoundaries", min(timeit.repeat(lambda: distorm3.DecodeBoundaries(0, code, dt), number = 1, repeat = 3)), size, "byte")
+	_report("DecodeValidOffsets", min(timeit.repeat(lambda: distorm3.DecodeValidOffsets(0, code, dt), number = 1, repeat = 3)), size, "byte")
+	boundaries = distorm3.DecodeBoundaries(0, code, dt)
+	print("%-40s %10d bytes" % ("InstructionBitmap size", len(boundaries.bits)))
+	_report("address in InstructionBitmap", min(timeit.repeat(lambda: [a in boundaries for a in addresses], number = 1, repeat = 3)), count, "address")
+	view = memoryview(code)[:size // 16]
+	_report("set of Decompose addresses", min(timeit.repeat(lambda: set([i.address for i in distorm3.Decompose(0, view, dt)]), number = 1, repeat = 3)), size // 16, "byte")
+	valid = distorm3.DecodeValidOffsets(0, code, dt)
+	_report("InstructionBitmap &", min(timeit.repeat(lambda: boundaries & valid, number = 1, repeat = 3)), size, "byte")
+
+def bench_filter(size = 16 << 20):
+	"Looking for the SSE instructions that use RSP in a big buffer, filtering in Python versus a DecodeFilter."
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	classes = ("ISC_SSE", "ISC_SSE2", "ISC_SSE3", "ISC_SSSE3", "ISC_SSE4_1", "ISC_SSE4_2", "ISC_SSE4_A")
+	decodeFilter = distorm3.DecodeFilter(classes = classes, registers = ["RM_SP"])
+	view = memoryview(code)[:size // 16]
+	_report("Decompose, filtered in Python", min(timeit.repeat(lambda: [i for i in distorm3.Decompose(0, view, dt) if i.instructionClass in classes and "RM_SP" in i.registers], number = 1, repeat = 3)), size // 16, "byte")
+	_report("Decompose, DecodeFilter", min(timeit.repeat(lambda: distorm3.Decompose(0, code, dt, filter = decodeFilter), number = 1, repeat = 3)), size, "byte")
+	try:
+		import numpy
+		_report("DecomposeArray, DecodeFilter", min(timeit.repeat(lambda: distorm3.DecomposeArray(0, code, dt, filter = decodeFilter), number = 1, repeat = 3)), size, "byte")
+	except ImportError:
+		pass
+	print("%d matching instructions" % len(distorm3.Decompose(0, code, dt, filter = decodeFilter)))
+
+def bench_events(size = 4 << 20):
+	"Finding the calls and the privileged instructions, restarting Decompose at every stop versus DecomposeEvents."
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	features = distorm3.DF_STOP_ON_CALL | distorm3.DF_STOP_ON_PRIVILEGED
+	view = memoryview(code)[:size // 16]
+	def restart():
+		events = []
+		index = 0
+		while index < len(view):
+			insts = distorm3.Decompose(index, view[index:], dt, features)
+			if not insts:
+				break
+			events.append(insts[-1])
+			index = insts[-1].address + insts[-1].size
+		return events
+	_report("Decompose, restarted at every stop", min(timeit.repeat(restart, number = 1, repeat = 3)), size // 16, "byte")
+	_report("DecomposeEvents", min(timeit.repeat(lambda: list(distorm3.DecomposeEvents(0, code, dt, features)), number = 1, repeat = 3)), size, "byte")
+	print("%d events" % len(list(distorm3.DecomposeEvents(0, code, dt, features))))
+
+def bench_at(count = 20000):
+	"Decoding the instruction at each of many addresses of one buffer."
+	code = _randomCode(1 << 16)
+	base = 0x400000
+	r = random.Random(2)
+	addresses = sorted([base + r.randrange(len(code)) for i in range(count)])
+	dt = distorm3.Decode64Bits
+	try:
+		import numpy
+	except ImportError:
+		print("numpy isn't installed")
+		return
+	_report("DecomposeAt", min(timeit.repeat(lambda: distorm3.DecomposeAt(base, code, addresses, dt), number = 1, repeat = 3)), count, "address")
+	view = memoryview(code)
+	_report("DecomposeOne per address", min(timeit.repeat(lambda: [distorm3.DecomposeOne(a, view[a - base:], dt) for a in addresses], number = 1, repeat = 3)), count, "address")
+
+def bench_parallel(regionsNo = 2000, maxWorkers = 32):
+	"ParallelDecompose of independent regions by the number of threads."
+	import distorm3.parallel
+	r = random.Random(3)
+	regions = [(r.randrange(1 << 32), _randomCode(r.randrange(4096), seed = i), distorm3.Decode64Bits) for i in range(regionsNo)]
+	count = sum([len(code) for (_, code, _) in regions])
+	try:
+		import numpy
+		modes = ((False, "lists"), (True, "array"))
+	except ImportError:
+		modes = ((False, "lists"),)
+	for asArray, modeName in modes:
+		workers = 1
+		while workers <= maxWorkers:
+			seconds = min(timeit.repeat(lambda: distorm3.parallel.ParallelDecompose(regions, workers, as_array = asArray), number = 1, repeat = 3))
+			_report("ParallelDecompose %s, %d workers" % (modeName, workers), seconds, count, "byte")
+			workers *= 2
+
+def bench_sweep(size = 32 << 20, maxWorkers = 32):
+	"ParallelSweep of a single big buffer by the number of threads, compared to a sequential DecomposeArray."
+	import distorm3.parallel
+	try:
+		import numpy
+	except ImportError:
+		print("numpy isn't installed")
+		return
+	code = _randomCode(size)
+	dt = distorm3.Decode64Bits
+	_report("DecomposeArray", min(timeit.repeat(lambda: distorm3.DecomposeArray(0, code, dt), number = 1, repeat = 3)), size, "byte")
+	workers = 1
+	while workers <= maxWorkers:
+		seconds = min(timeit.repeat(lambda: distorm3.parallel.ParallelSweep(0, code, dt, workers = workers), number = 1, repeat = 3))
+		_report("ParallelSweep, %d workers" % workers, seconds, size, "byte")
+		workers *= 2
+
+def _decomposeFileInstructions(path):
+	with open(path, "rb") as f:
+		return distorm3.Decompose(0, f.read(), distorm3.Decode64Bits)
+
+def bench_pool(filesNo = 16, size = 256 << 10, processes = 4):
+	"Decomposing files in a process pool, shared memory arrays versus pickled Instruction objects."
+	import multiprocessing
+	import shutil
+	import tempfile
+	import distorm3.pool
+	try:
+		import numpy
+	except ImportError:
+		print("numpy isn't installed")
+		return
+	tempDir = tempfile.mkdtemp()
+	try:
+		files = []
+		for i in range(filesNo):
+			files.append(os.path.join(tempDir, "code%d.bin" % i))
+			with open(files[-1], "wb") as f:
+				f.write(_randomCode(size, seed = i))
+		for prefork in (False, True):
+			seconds = min(timeit.repeat(lambda: distorm3.pool.DecomposeFiles(files, distorm3.Decode64Bits, processes = processes, prefork = prefork), number = 1, repeat = 3))
+			_report("DecomposeFiles%s" % (", prefork" if prefork else ""), seconds, filesNo * size, "byte")
+		def pickled():
+			pool = multiprocessing.Pool(processes)
+			try:
+				return pool.map(_decomposeFileInstructions, files)
+			finally:
+				pool.terminate()
+		_report("Pool.map of Decompose", min(timeit.repeat(pickled, number = 1, repeat = 3)), filesNo * size, "byte")
+	finally:
+		shutil.rmtree(tempDir)
+
+def bench_one(number = 200000):
+	"Latency of decoding a single instruction."
+	# mov rax, [rip+0x12345678]
+	code = b"\x48\x8b\x05\x78\x56\x34\x12" + b"\x90" * 8
+	dt = distorm3.Decode64Bits
+	paths = [("native", lambda f: f())] if distorm3._native is not None else []
+	paths.append(("ctypes", _withoutNative))
+	for pathName, path in paths:
+		n = number if pathName == "native" else number // 10
+		for name, stmt in (
+			("DecodeOne", lambda: distorm3.DecodeOne(0x1000, code, dt)),
+			("DecomposeOne", lambda: distorm3.DecomposeOne(0x1000, code, dt)),
+			("Decode(max_instructions=1)", lambda: distorm3.Decode(0x1000, code, dt, max_instructions = 1)),
+			("Decompose(max_instructions=1)", lambda: distorm3.Decompose(0x1000, code, dt, max_instructions = 1))):
+			_report("%s %s" % (pathName, name), path(lambda: min(timeit.repeat(stmt, number = n, repeat = 3))), n)
+
+BENCHMARKS = [(name[6:], f) for (name, f) in sorted(globals().items()) if name.startswith("bench_")]
+
+def main(args):
+	names = args or [name for (name, _) in BENCHMARKS]
+	for (name, f) in BENCHMARKS:
+		if name in names:
+			print("== %s: %s" % (name, f.__doc__))
+			f()
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
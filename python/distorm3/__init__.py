@@ -16,8 +16,23 @@ __revision__ = "$Id: distorm.py 186 2010-05-01 14:20:41Z gdabah $"
 __all__ = [
     'Decode',
     'DecodeGenerator',
+    'DecodeOne',
     'Decompose',
     'DecomposeGenerator',
+    'DecomposeOne',
+    'DecomposeEvents',
+    'DecomposeRegion',
+    'DecomposeArray',
+    'DecomposeMany',
+    'DecomposeAt',
+    'DecodeLengths',
+    'DecodeBoundaries',
+    'DecodeValidOffsets',
+    'InstructionBitmap',
+    'DecodeStream',
+    'DecomposeStream',
+    'DecodeFilter',
+    'Decoder',
     'Decode16Bits',
     'Decode32Bits',
     'Decode64Bits',
@@ -27,8 +42,10 @@ __all__ = [
 ]
 
 from ctypes import *
+from collections import namedtuple
 import os
 import sys
+import threading
 from ._generated import Registers, Mnemonics, RegisterMasks
 
 if sys.version_info[0] >= 3:
@@ -56,28 +73,72 @@ def _load_distorm():
 
 _distorm = _load_distorm()
 
+def _load_native():
+    # The native entry points are only available in the CPython extension module,
+    # otherwise everything goes through ctypes.
+    if sys.version_info[0] < 3:
+        return None
+    try:
+        import _distorm3
+    except ImportError:
+        return None
+    if not hasattr(_distorm3, "decompose"):
+        return None
+    return _distorm3
+
+_native = _load_native()
+
 # Get the decode C function (try 64 bits version first, only then 32 bits).
 SUPPORT_64BIT_OFFSET = False
 try:
     internal_decode = _distorm.distorm_decode64
     internal_decompose = _distorm.distorm_decompose64
+    internal_decompose_filtered = _distorm.distorm_decompose_filtered64
+    internal_decompose_region = _distorm.distorm_decompose_region64
+    internal_lengths = _distorm.distorm_lengths64
     internal_format = _distorm.distorm_format64
     SUPPORT_64BIT_OFFSET = True
 except AttributeError:
     internal_decode = _distorm.distorm_decode32
     internal_decompose = _distorm.distorm_decompose32
+    internal_decompose_filtered = _distorm.distorm_decompose_filtered32
+    internal_decompose_region = _distorm.distorm_decompose_region32
+    internal_lengths = _distorm.distorm_lengths32
     internal_format = _distorm.distorm_format32
 
+# Version of the diStorm library, eg. 0x030503 for 3.5.3.
+_distorm.distorm_version.restype = c_uint
+DISTORM_VERSION = _distorm.distorm_version()
+
 #==============================================================================
 # diStorm C interface
 
 MAX_TEXT_SIZE       = 48 # See distorm.h for this value.
 MAX_INSTRUCTIONS    = 1000
+MAX_INSTRUCTION_SIZE = 15 # Longest instruction in bytes.
+FILTER_OPCODES_SIZE = 0x10000 // 8 # Bytes of the opcodes bitmap of a _DecodeFilter.
+
+# The generators start with small batches that grow up to MAX_INSTRUCTIONS, see _batchSizes.
+_FIRST_BATCH_SIZE   = 16
+
+# The decoder works with an int length, a call decodes no more than this much of the code, see parse_code_info.
+_MAX_CODE_LENGTH    = 0x7fffffff
 
 DECRES_NONE         = 0
 DECRES_SUCCESS      = 1
 DECRES_MEMORYERR    = 2
 DECRES_INPUTERR     = 3
+DECRES_TRUNCATED    = 4
+
+# Reasons that the decoding of a region stops for, see DecomposeRegion.
+DECSTOP_NONE         = 0 # input error
+DECSTOP_CODE_END     = 1
+DECSTOP_REGION_END   = 2
+DECSTOP_RESULTS_FULL = 3
+DECSTOP_FLOW_CONTROL = 4
+DECSTOP_PRIVILEGED   = 5
+DECSTOP_UNDECODABLE  = 6
+DECSTOP_TRUNCATED    = 7
 
 if SUPPORT_64BIT_OFFSET:
     _OffsetType = c_ulonglong
@@ -179,6 +240,266 @@ class _DInst (Structure):
         ('undefinedFlagsMask', c_uint16) # CPU undefined flags by instruction only set with DF_FILL_EFLAGS
         ]
 
+class _DecodeFilter (Structure):
+    _fields_ = [
+        ('opcodes', c_void_p), # bitmap of FILTER_OPCODES_SIZE bytes, or NULL
+        ('iscMask', c_uint32),
+        ('fcMask', c_uint32),
+        ('usedRegistersMask', c_uint32),
+        ('flags', c_uint16),
+        ]
+
+class _DecodeRegion (Structure):
+    _fields_ = [
+        ('endOffset', _OffsetType),
+        ('stop', c_int), # _DecodeStop, OUT
+        ]
+
+# A decomposed instruction record, same fields as _DInst.
+# imm holds the raw 64 bits of the _Value union and ops holds (type, index, size) tuples.
+# The native module builds _distorm3.DInst records with the same layout.
+DInst = namedtuple("DInst", [name for (name, _) in _DInst._fields_])
+
+def _dinstRecord(di):
+    "Converts a ctypes _DInst structure into a DInst record."
+    return DInst(di.imm.qword, di.disp, di.addr, di.flags, di.unusedPrefixesMask, di.usedRegistersMask,
+        di.opcode, tuple((op.type, op.index, op.size) for op in di.ops), di.opsNo, di.size,
+        di.segment, di.base, di.scale, di.dispSize, di.meta,
+        di.modifiedFlagsMask, di.testedFlagsMask, di.undefinedFlagsMask)
+
+def _dinstStruct(record):
+    "Converts a DInst record back into a ctypes _DInst structure."
+    di = _DInst()
+    (di.imm.qword, di.disp, di.addr, di.flags, di.unusedPrefixesMask, di.usedRegistersMask, di.opcode, ops,
+        di.opsNo, di.size, di.segment, di.base, di.scale, di.dispSize, di.meta,
+        di.modifiedFlagsMask, di.testedFlagsMask, di.undefinedFlagsMask) = record
+    for op, (type, index, size) in zip(di.ops, ops):
+        op.type, op.index, op.size = type, index, size
+    return di
+
+def _codeView(code):
+    """
+    Returns a flat bytes memoryview of the code without copying it.
+    The code can be any object that supports the buffer protocol (bytes, bytearray, mmap, memoryview, numpy uint8 arrays, etc).
+    """
+    if sys.version_info[0] < 3:
+        return code
+    view = code if isinstance(code, memoryview) else memoryview(code)
+    if view.ndim != 1 or view.itemsize != 1:
+        view = view.cast("B")
+    return view
+
+# Per-thread state of the ctypes fallback.
+_locals = threading.local()
+
+# Support cross Python compatibility
+_toUnicode = lambda s: s
+_spaceCh = b" "
+if sys.version_info[0] >= 3:
+    if sys.version_info[1] > 0:
+        _toUnicode = lambda s: s.decode()
+    else:
+        _spaceCh = " "
+
+class _ResultPool (object):
+    """
+    Result buffers that are reused across decoding calls (see L{Decoder}).
+    The scratch buffer is passed to the native entry points, the result array and the _CodeInfo are used by the ctypes ones.
+    """
+    def __init__(self, batchSize = 0):
+        self.scratch = bytearray(batchSize * max(sizeof(_DInst), sizeof(_DecodedInst))) if batchSize else None
+        self.results = {}
+        self.codeInfo = _CodeInfo()
+
+    def resultArray(self, structType, count):
+        result = self.results.get(structType)
+        if result is None or len(result) < count:
+            result = self.results[structType] = (structType * count)()
+        return result
+
+    def fillCodeInfo(self, codeOffset, code, codeLen, dt, features):
+        codeInfo = self.codeInfo
+        codeInfo.codeOffset = codeOffset
+        codeInfo.addrMask = 0
+        codeInfo.nextOffset = 0
+        codeInfo.code = code
+        codeInfo.codeLen = codeLen
+        codeInfo.dt = dt
+        codeInfo.features = features
+        return codeInfo
+
+class _CtypesCode (object):
+    "Holds a ctypes view of the code and the result buffers for the ctypes fallback path."
+    def __init__(self, code, pool = None):
+        self.length = len(code)
+        self.pool = pool if pool is not None else _ResultPool()
+        try:
+            # Writable buffers (bytearray, mmap, numpy, etc) are used in-place.
+            self.buf = (c_char * self.length).from_buffer(code)
+        except TypeError:
+            # Read-only buffers have to be copied, as ctypes only shares writable ones.
+            self.buf = (c_char * self.length).from_buffer_copy(code)
+
+    def window(self, index):
+        "Returns the length of the code from index that a single call decodes."
+        return min(self.length - index, _MAX_CODE_LENGTH)
+
+def _decodedText(di):
+    "Returns the 'MNEMONIC OPERANDS' text of a ctypes _DecodedInst, as the native module does."
+    asm = di.mnemonic.p
+    if len(di.operands.p):
+        asm += _spaceCh + di.operands.p
+    return _toUnicode(asm)
+
+def _textCodeInfo(codeOffset, code, codeLen, dt):
+    "Returns a _CodeInfo for formatting text, the addresses are masked by the decoding mode as distorm_decode does."
+    addrMask = {Decode16Bits: 0xffff, Decode32Bits: 0xffffffff}.get(dt, _OffsetMask)
+    return _CodeInfo(_OffsetType(codeOffset), _OffsetType(addrMask), _OffsetType(0), code, codeLen, dt, DF_USE_ADDR_MASK)
+
+def _decomposeCtypes(codeOffset, code, index, dt, features, maxInstructions, decodeFilter = None):
+    "Same as the native _distorm3.decompose, but code is a _CtypesCode and decodeFilter is a DecodeFilter."
+    result = code.pool.resultArray(_DInst, maxInstructions)
+    usedInstructionsCount = c_uint(0)
+    codeInfo = code.pool.fillCodeInfo(codeOffset, cast(byref(code.buf, index), c_char_p), code.window(index), dt, features)
+    if decodeFilter is None:
+        status = internal_decompose(byref(codeInfo), byref(result), maxInstructions, byref(usedInstructionsCount))
+    else:
+        status = internal_decompose_filtered(byref(codeInfo), byref(decodeFilter._struct), byref(result), maxInstructions, byref(usedInstructionsCount))
+    return (status, [_dinstRecord(result[i]) for i in xrange(usedInstructionsCount.value)], codeInfo.nextOffset)
+
+def _decomposeRegionCtypes(codeOffset, code, index, dt, features, maxInstructions, endOffset):
+    "Same as the native _distorm3.decompose_region, but code is a _CtypesCode."
+    result = code.pool.resultArray(_DInst, maxInstructions)
+    usedInstructionsCount = c_uint(0)
+    codeInfo = code.pool.fillCodeInfo(codeOffset, cast(byref(code.buf, index), c_char_p), code.window(index), dt, features)
+    region = _DecodeRegion(_OffsetType(endOffset), DECSTOP_NONE)
+    status = internal_decompose_region(byref(codeInfo), byref(region), byref(result), maxInstructions, byref(usedInstructionsCount))
+    return (status, [_dinstRecord(result[i]) for i in xrange(usedInstructionsCount.value)], codeInfo.nextOffset, region.stop)
+
+def _decomposeIntoCtypes(codeOffset, code, index, dt, features, out, decodeFilter = None):
+    "Same as the native _distorm3.decompose_into, but code is a _CtypesCode and decodeFilter is a DecodeFilter."
+    maxInstructions = len(out) * out.itemsize // sizeof(_DInst)
+    if maxInstructions == 0:
+        return (DECRES_INPUTERR, 0, 0)
+    result = (_DInst * maxInstructions).from_buffer(out)
+    usedInstructionsCount = c_uint(0)
+    codeInfo = _CodeInfo(_OffsetType(codeOffset), _OffsetType(0), _OffsetType(0), cast(byref(code.buf, index), c_char_p), code.window(index), dt, features)
+    if decodeFilter is None:
+        status = internal_decompose(byref(codeInfo), byref(result), maxInstructions, byref(usedInstructionsCount))
+    else:
+        status = internal_decompose_filtered(byref(codeInfo), byref(decodeFilter._struct), byref(result), maxInstructions, byref(usedInstructionsCount))
+    return (status, usedInstructionsCount.value, codeInfo.nextOffset)
+
+def _lengthsIntoCtypes(codeOffset, code, index, dt, features, out):
+    "Same as the native _distorm3.lengths_into, but code is a _CtypesCode."
+    maxInstructions = min(len(out), 0xffffffff)
+    if maxInstructions == 0:
+        return (DECRES_INPUTERR, 0, 0)
+    result = (c_ubyte * maxInstructions).from_buffer(out)
+    usedInstructionsCount = c_uint(0)
+    codeInfo = _CodeInfo(_OffsetType(codeOffset), _OffsetType(0), _OffsetType(0), cast(byref(code.buf, index), c_char_p), code.window(index), dt, features)
+    status = internal_lengths(byref(codeInfo), byref(result), maxInstructions, byref(usedInstructionsCount))
+    return (status, usedInstructionsCount.value, codeInfo.nextOffset)
+
+def _decomposeTextCtypes(codeOffset, code, index, dt, features, maxInstructions, decodeFilter = None):
+    "Same as the native _distorm3.decompose_text, but code is a _CtypesCode and decodeFilter is a DecodeFilter."
+    status, insts, nextOffset = _decomposeCtypes(codeOffset, code, index, dt, features, maxInstructions, decodeFilter)
+    result = code.pool.results[_DInst]
+    codeInfo = _textCodeInfo(codeOffset, cast(byref(code.buf, index), c_char_p), code.window(index), dt)
+    text = _DecodedInst()
+    texts = []
+    for i in xrange(len(insts)):
+        internal_format(byref(codeInfo), byref(result[i]), byref(text))
+        texts.append(_decodedText(text))
+    return (status, insts, nextOffset, texts)
+
+def _decodeCtypes(codeOffset, code, index, dt, maxInstructions):
+    "Same as the native _distorm3.decode, but code is a _CtypesCode."
+    result = code.pool.resultArray(_DecodedInst, maxInstructions)
+    usedInstructionsCount = c_uint(0)
+    status = internal_decode(_OffsetType(codeOffset), byref(code.buf, index), code.window(index), dt, byref(result), maxInstructions, byref(usedInstructionsCount))
+
+    insts = []
+    nextOffset = codeOffset
+    for i in xrange(usedInstructionsCount.value):
+        di = result[i]
+        insts.append((di.offset, di.size, _decodedText(di), _toUnicode(di.instructionHex.p)))
+        nextOffset += di.size
+    return (status, insts, nextOffset)
+
+def _formatCtypes(code, dt, record):
+    "Same as the native _distorm3.format."
+    di = _dinstStruct(record)
+    code = _CtypesCode(code)
+    if code.length < di.size:
+        raise ValueError("code is shorter than the instruction")
+    codeInfo = _textCodeInfo(di.addr, cast(code.buf, c_char_p), di.size, dt)
+    text = _DecodedInst()
+    internal_format(byref(codeInfo), byref(di), byref(text))
+    return _decodedText(text)
+
+def _localPool():
+    "Returns the calling thread's own result pool, for the single instruction ctypes functions."
+    try:
+        return _locals.pool
+    except AttributeError:
+        pool = _locals.pool = _ResultPool()
+        return pool
+
+def _decomposeOneCtypes(codeOffset, code, dt, features):
+    "Same as the native _distorm3.decompose_one."
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid arguments passed to distorm_decompose()")
+    code = _CtypesCode(code[:MAX_INSTRUCTION_SIZE], _localPool())
+    if code.length == 0:
+        return None
+    status, insts, _ = _decomposeCtypes(codeOffset, code, 0, dt, features, 1)
+    if status == DECRES_INPUTERR:
+        raise ValueError("Invalid arguments passed to distorm_decompose()")
+    return insts[0] if insts else None
+
+def _decodeOneCtypes(codeOffset, code, dt):
+    "Same as the native _distorm3.decode_one."
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid arguments passed to distorm_decompose()")
+    code = _CtypesCode(code[:MAX_INSTRUCTION_SIZE], _localPool())
+    if code.length == 0:
+        return None
+    _, insts, _ = _decodeCtypes(codeOffset, code, 0, dt, 1)
+    return insts[0]
+
+def _format(code, dt, record):
+    "Formats the text of a decomposed DInst record, code holds the bytes of the instruction."
+    if _native is not None:
+        return _native.format(code, dt, record)
+    return _formatCtypes(code, dt, record)
+
+def _getDecoders(code, withText = False, pool = None, decodeFilter = None):
+    """
+    Returns the decompose and decode functions and the code argument they expect,
+    the native ones if available, otherwise the ctypes ones.
+    If withText is set, the decompose function also returns the formatted text of the instructions.
+    The result buffers of the pool are used if it's given, otherwise they are allocated per call.
+    The decompose function returns only the instructions that match the DecodeFilter if it's given.
+    """
+    if _native is not None:
+        decompose = _native.decompose_text if withText else _native.decompose
+        if pool is None and decodeFilter is None:
+            return (decompose, _native.decode, code)
+        scratch = pool.scratch if pool is not None else None
+        filterArgs = decodeFilter._args if decodeFilter is not None else None
+        def decomposeScratch(codeOffset, code, index, dt, features, maxInstructions):
+            return decompose(codeOffset, code, index, dt, features, maxInstructions, scratch, filterArgs)
+        def decodeScratch(codeOffset, code, index, dt, maxInstructions):
+            return _native.decode(codeOffset, code, index, dt, maxInstructions, scratch)
+        return (decomposeScratch, decodeScratch, code)
+    decompose = _decomposeTextCtypes if withText else _decomposeCtypes
+    if decodeFilter is not None:
+        ctypesDecompose = decompose
+        def decompose(codeOffset, code, index, dt, features, maxInstructions):
+            return ctypesDecompose(codeOffset, code, index, dt, features, maxInstructions, decodeFilter)
+    return (decompose, _decodeCtypes, _CtypesCode(code, pool))
+
 #==============================================================================
 # diStorm Python interface
 
@@ -186,6 +507,7 @@ Decode16Bits    = 0     # 80286 decoding
 Decode32Bits    = 1     # IA-32 decoding
 Decode64Bits    = 2     # AMD64 decoding
 OffsetTypeSize  = sizeof(_OffsetType)
+_OffsetMask     = (1 << (OffsetTypeSize * 8)) - 1
 
 # Special case
 R_NONE = 0xFF # -1 in uint8
@@ -221,6 +543,12 @@ D_OF = 0x800 # Overflow #
 
 # Instruction could not be disassembled. Special-case handling
 FLAG_NOT_DECODABLE = 0xFFFF # -1 in uint16
+# The Imm value is signed extended, see FLAGS above.
+FLAG_IMM_SIGNED = 1 << 5
+# The instruction uses RIP-relative indirection.
+FLAG_RIP_RELATIVE = 1 << 7
+# The instruction is privileged and can only be used from Ring0.
+FLAG_PRIVILEGED_INSTRUCTION = 1 << 15
 # Some features
 DF_NONE = 0
 DF_MAXIMUM_ADDR16 = 1
@@ -240,20 +568,87 @@ DF_STOP_ON_UNDECODEABLE = 0x1000
 DF_SINGLE_BYTE_STEP = 0x2000
 DF_FILL_EFLAGS = 0x4000
 DF_USE_ADDR_MASK = 0x8000
+DF_STOP_ON_TRUNCATED = 0x10000
 
 DF_STOP_ON_FLOW_CONTROL = (DF_STOP_ON_CALL | DF_STOP_ON_RET | DF_STOP_ON_SYS | \
     DF_STOP_ON_UNC_BRANCH | DF_STOP_ON_CND_BRANCH | DF_STOP_ON_INT | DF_STOP_ON_CMOV | \
     DF_STOP_ON_HLT)
 
-def DecodeGenerator(codeOffset, code, dt):
+def _endIndex(codeOffset, codeLen, endAddress):
+    "Returns the index in the code where instructions stop starting, according to the end address (if any)."
+    if endAddress is None:
+        return codeLen
+    return max(0, min(codeLen, endAddress - codeOffset))
+
+def _batchSizes(batchSize, maxInstructions, grow = True):
+    """
+    Yields the number of instructions to ask for each time, up to batchSize and maxInstructions in total.
+    Unless grow is False, it starts with a small batch that grows geometrically,
+    so a consumer that stops early doesn't pay for decoding many instructions it never uses.
+    """
+    batch = min(_FIRST_BATCH_SIZE, batchSize) if grow else batchSize
+    while True:
+        if maxInstructions is not None:
+            if maxInstructions <= 0:
+                return
+            batch = min(batch, maxInstructions)
+        yield batch
+        if maxInstructions is not None:
+            maxInstructions -= batch
+        batch = min(batch * 2, batchSize)
+
+def _decodeGenerator(codeOffset, code, dt, batchSize, pool, maxInstructions = None, endAddress = None):
+    "Implements DecodeGenerator, decoding up to batchSize instructions at a time with the result buffers of the pool."
+    code = _codeView(code)
+    if not code:
+        return
+
+    if not codeOffset:
+        codeOffset = 0
+
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (dt,))
+
+    endIndex = _endIndex(codeOffset, len(code), endAddress)
+    # An instruction that starts before the end is decoded whole, its bytes are needed.
+    codeLen  = min(len(code), endIndex + MAX_INSTRUCTION_SIZE - 1)
+    if codeLen < len(code):
+        code = code[:codeLen]
+    index    = 0
+    _, decode, code_arg = _getDecoders(code, pool = pool)
+
+    for batch in _batchSizes(batchSize, maxInstructions):
+        if index >= endIndex:
+            break
+
+        status, insts, nextOffset = decode(codeOffset, code_arg, index, dt, batch)
+
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_decode()")
+
+        if not insts:
+            break
+
+        # The decoded instructions are consecutive, the offsets might be masked to the decoding mode.
+        for pydi in insts:
+            if index >= endIndex:
+                return
+            yield pydi
+            index += pydi[1]
+
+        codeOffset = nextOffset
+        if index >= codeLen:
+            break
+
+def DecodeGenerator(codeOffset, code, dt, max_instructions = None, end_address = None):
     """
     @type  codeOffset: long
     @param codeOffset: Memory address where the code is located.
         This is B{not} an offset into the code!
         It's the actual memory address where it was read from.
 
-    @type  code: str
-    @param code: Code to disassemble.
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
 
     @type  dt: int
     @param dt: Disassembly type. Can be one of the following:
@@ -264,6 +659,13 @@ def DecodeGenerator(codeOffset, code, dt):
 
          * L{Decode64Bits}: AMD64 decoding
 
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, only instructions that start before it are returned.
+        By default it's the end of the code.
+
     @rtype:  generator of tuple( long, int, str, str )
     @return: Generator of tuples. Each tuple represents an assembly instruction
         and contains:
@@ -274,70 +676,17 @@ def DecodeGenerator(codeOffset, code, dt):
 
     @raise ValueError: Invalid arguments.
     """
+    return _decodeGenerator(codeOffset, code, dt, MAX_INSTRUCTIONS, None, max_instructions, end_address)
 
-    if not code:
-        return
-
-    if not codeOffset:
-        codeOffset = 0
-
-    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
-        raise ValueError("Invalid decode type value: %r" % (dt,))
-
-    codeLen         = len(code)
-    code_buf        = create_string_buffer(code)
-    p_code          = byref(code_buf)
-    result          = (_DecodedInst * MAX_INSTRUCTIONS)()
-    p_result        = byref(result)
-    instruction_off = 0
-
-    # Support cross Python compatibility
-    toUnicode = lambda s: s
-    spaceCh = b" "
-    if sys.version_info[0] >= 3:
-        if sys.version_info[1] > 0:
-            toUnicode = lambda s: s.decode()
-        else:
-            spaceCh = " "
-
-    while codeLen > 0:
-
-        usedInstructionsCount = c_uint(0)
-        status = internal_decode(_OffsetType(codeOffset), p_code, codeLen, dt, p_result, MAX_INSTRUCTIONS, byref(usedInstructionsCount))
-
-        if status == DECRES_INPUTERR:
-            raise ValueError("Invalid arguments passed to distorm_decode()")
-
-        used = usedInstructionsCount.value
-        if not used:
-            break
-
-        for index in xrange(used):
-            di   = result[index]
-            asm  = di.mnemonic.p
-            if len(di.operands.p):
-                asm += spaceCh + di.operands.p
-            pydi = (di.offset, di.size, toUnicode(asm), toUnicode(di.instructionHex.p))
-            instruction_off += di.size
-            yield pydi
-
-        di         = result[used - 1]
-        delta      = di.offset - codeOffset + result[used - 1].size
-        if delta <= 0:
-            break
-        codeOffset = codeOffset + delta
-        p_code     = byref(code_buf, instruction_off)
-        codeLen    = codeLen - delta
-
-def Decode(offset, code, type = Decode32Bits):
+def Decode(offset, code, type = Decode32Bits, max_instructions = None, end_address = None):
     """
     @type  offset: long
     @param offset: Memory address where the code is located.
         This is B{not} an offset into the code!
         It's the actual memory address where it was read from.
 
-    @type  code: str
-    @param code: Code to disassemble.
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
 
     @type  type: int
     @param type: Disassembly type. Can be one of the following:
@@ -348,6 +697,13 @@ def Decode(offset, code, type = Decode32Bits):
 
          * L{Decode64Bits}: AMD64 decoding
 
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, only instructions that start before it are returned.
+        By default it's the end of the code.
+
     @rtype:  list of tuple( long, int, str, str )
     @return: List of tuples. Each tuple represents an assembly instruction
         and contains:
@@ -358,7 +714,30 @@ def Decode(offset, code, type = Decode32Bits):
 
     @raise ValueError: Invalid arguments.
     """
-    return list(DecodeGenerator(offset, code, type))
+    return list(DecodeGenerator(offset, code, type, max_instructions, end_address))
+
+def DecodeOne(offset, code, type = Decode32Bits):
+    """
+    Decodes the single instruction at the beginning of the code.
+    It's the fast path for decoding one instruction at a time, no more than its first 15 bytes are looked at.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code of the instruction, only up to L{MAX_INSTRUCTION_SIZE} bytes are used.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @rtype:  tuple( long, int, str, str )
+    @return: The same tuple as L{Decode} returns for the instruction, or None if the code is empty.
+
+    @raise ValueError: Invalid arguments.
+    """
+    if _native is not None:
+        return _native.decode_one(offset or 0, code, type)
+    return _decodeOneCtypes(offset or 0, _codeView(code), type)
 
 OPERAND_NONE = ""
 OPERAND_IMMEDIATE = "Immediate"
@@ -480,6 +859,8 @@ else:
     _unsignedToSigned = _unsignedToSigned32
 
 class Operand (object):
+    __slots__ = ('type', 'index', 'name', 'size', 'value', 'disp', 'dispSize', 'base', 'segment', 'scale', 'seg', 'off')
+
     def __init__(self, type, *args):
         self.type = type
         self.index = None
@@ -545,118 +926,338 @@ class Operand (object):
 
 
 class Instruction (object):
-    def __init__(self, di, instructionBytes, dt):
-        "Expects a filled _DInst structure, and the corresponding byte code of the whole instruction"
-        #self.di = di
-        flags = di.flags
+    """
+    A decomposed instruction.
+    It keeps the raw DInst record and computes most of its attributes from it upon access,
+    the costly ones (operands, flags, registers, etc) are computed only once.
+    """
+    __slots__ = ('_di', 'instructionBytes', 'dt', 'address', 'size', 'opcode', '_operands', '_flags', '_registers', '_text')
+
+    def __init__(self, di, instructionBytes, dt, text = None):
+        """
+        Expects a DInst record (or a filled _DInst structure), and the corresponding byte code of the whole instruction.
+        The text of the instruction can be passed if it's already formatted, otherwise it's formatted upon str().
+        """
+        # Records are tuples, unlike the ctypes structure (and checking for a builtin type is quicker).
+        if not isinstance(di, tuple):
+            di = _dinstRecord(di)
+        if text is not None:
+            self._text = text
+        self._di = di
         self.instructionBytes = instructionBytes
-        self.opcode = di.opcode
-        self.operands = []
-        self.flags = []
-        self.rawFlags = di.flags
-        self.meta = 0
-        self.privileged = False
-        self.instructionClass = _getISC(0)
-        self.flowControl = _getFC(0)
+        self.dt = dt
         self.address = di.addr
         self.size = di.size
-        self.dt = dt
-        self.valid = False
-        if di.segment != R_NONE:
-            self.segment = di.segment & 0x7f
-            self.isSegmentDefault = (di.segment & 0x80) == 0x80
-        else:
-            self.segment = R_NONE
-            self.isSegmentDefault = False
-        self.unusedPrefixesMask = di.unusedPrefixesMask
-        self.usedRegistersMask = di.usedRegistersMask
+        self.opcode = di.opcode
 
+    def __reduce__(self):
+        # instructionBytes might be a memoryview, which can't be pickled.
+        return (Instruction, (self._di, bytes(self.instructionBytes), self.dt))
+
+    @property
+    def valid(self):
+        return self._di.flags != FLAG_NOT_DECODABLE
+
+    @property
+    def rawFlags(self):
+        return self._di.flags
+
+    @property
+    def mnemonic(self):
+        di = self._di
+        if di.flags == FLAG_NOT_DECODABLE:
+            return 'DB 0x%02x' % (di.imm & 0xff)
+        return _getMnem(di.opcode)
+
+    @property
+    def meta(self):
+        di = self._di
+        return di.meta if di.flags != FLAG_NOT_DECODABLE else 0
+
+    @property
+    def privileged(self):
+        return (self.meta & 0x8000) == 0x8000
+
+    @property
+    def instructionClass(self):
+        return _getISC(self.meta)
+
+    @property
+    def flowControl(self):
+        return _getFC(self.meta)
+
+    @property
+    def segment(self):
+        segment = self._di.segment
+        return segment & 0x7f if segment != R_NONE else R_NONE
+
+    @property
+    def isSegmentDefault(self):
+        segment = self._di.segment
+        return segment != R_NONE and (segment & 0x80) == 0x80
+
+    @property
+    def unusedPrefixesMask(self):
+        return self._di.unusedPrefixesMask
+
+    @property
+    def usedRegistersMask(self):
+        return self._di.usedRegistersMask
+
+    @property
+    def modifiedFlags(self):
+        return self._di.modifiedFlagsMask
+
+    @property
+    def undefinedFlags(self):
+        return self._di.undefinedFlagsMask
+
+    @property
+    def testedFlags(self):
+        return self._di.testedFlagsMask
+
+    @property
+    def registers(self):
+        try:
+            return self._registers
+        except AttributeError:
+            pass
         # calculate register masks
-        self.registers = []
+        registers = []
         maskIndex = 1
-        v = self.usedRegistersMask
+        v = self._di.usedRegistersMask
         while (v):
             if (v & maskIndex):
-                self.registers.append(RegisterMasks[maskIndex])
+                registers.append(RegisterMasks[maskIndex])
                 v ^= maskIndex
             maskIndex <<= 1
+        self._registers = registers
+        return registers
 
-        if flags == FLAG_NOT_DECODABLE:
-            self.mnemonic = 'DB 0x%02x' % (di.imm.byte)
-            self.flags = ['FLAG_NOT_DECODABLE']
-            return
-
-        self.valid = True
-        self.mnemonic = _getMnem(self.opcode)
-
-        # decompose the flags for a valid opcode
-        for index, flag in enumerate(FLAGS):
-            if (flags & (1 << index)) != 0:
-                self.flags.append(flag)
-
-        # read the operands
-        for operand in di.ops:
-            if operand.type != O_NONE:
-                self.operands.append(self._extractOperand(di, operand))
-
-        # decode the meta-flags
-        metas = di.meta
-        self.meta = di.meta
-        self.privileged = (metas & 0x8000) == 0x8000
-        self.instructionClass = _getISC(metas)
-        self.flowControl = _getFC(metas)
+    @property
+    def flags(self):
+        try:
+            return self._flags
+        except AttributeError:
+            pass
+        rawFlags = self._di.flags
+        if rawFlags == FLAG_NOT_DECODABLE:
+            flags = ['FLAG_NOT_DECODABLE']
+        else:
+            # decompose the flags for a valid opcode
+            flags = [flag for index, flag in enumerate(FLAGS) if (rawFlags & (1 << index)) != 0]
+        self._flags = flags
+        return flags
 
-        # copy eflags
-        self.modifiedFlags = di.modifiedFlagsMask
-        self.undefinedFlags = di.undefinedFlagsMask
-        self.testedFlags = di.testedFlagsMask
+    @property
+    def operands(self):
+        try:
+            return self._operands
+        except AttributeError:
+            pass
+        di = self._di
+        operands = []
+        if di.flags != FLAG_NOT_DECODABLE:
+            # read the operands
+            for operand in di.ops:
+                if operand[0] != O_NONE:
+                    operands.append(self._extractOperand(di, operand))
+        self._operands = operands
+        return operands
 
     def _extractOperand(self, di, operand):
         # a single operand can be up to: reg1 + reg2*scale + constant
-        if operand.type == O_IMM:
-            if ("FLAG_IMM_SIGNED" in self.flags):
+        # di.imm is the raw _Value union: the immediate (sign-extended to 64 bits), relative offset, ptr or ex pair.
+        type, index, size = operand
+        if type == O_IMM:
+            if (di.flags & FLAG_IMM_SIGNED):
                 # immediate is sign-extended, do your thing. it's already signed, just make it Python-signed.
-                constant = _unsignedToSigned(di.imm.sqword)
+                constant = _unsignedToSigned64(di.imm)
             else:
                 # immediate is zero-extended, though it's already aligned.
-                constant = di.imm.qword
-            return Operand(OPERAND_IMMEDIATE, constant, operand.size)
-        elif operand.type == O_IMM1: # first operand for ENTER
-            return Operand(OPERAND_IMMEDIATE, di.imm.ex.i1, operand.size)
-        elif operand.type == O_IMM2: # second operand for ENTER
-            return Operand(OPERAND_IMMEDIATE, di.imm.ex.i2, operand.size)
-        elif operand.type == O_REG:
-            return Operand(OPERAND_REGISTER, operand.index, operand.size)
-        elif operand.type == O_MEM:
-            return Operand(OPERAND_MEMORY, di.base, operand.index, operand.size, di.scale, _unsignedToSigned(di.disp), di.dispSize, self.segment)
-        elif operand.type == O_SMEM:
-            return Operand(OPERAND_MEMORY, None, operand.index, operand.size, di.scale, _unsignedToSigned(di.disp), di.dispSize, self.segment)
-        elif operand.type == O_DISP:
-            return Operand(OPERAND_ABSOLUTE_ADDRESS, operand.size, di.disp, di.dispSize, self.segment)
-        elif operand.type == O_PC:
-            return Operand(OPERAND_IMMEDIATE, _unsignedToSigned(di.imm.addr) + self.address + self.size, operand.size)
-        elif operand.type == O_PTR:
-            return Operand(OPERAND_FAR_MEMORY, di.imm.ptr.seg, di.imm.ptr.off, operand.size)
+                constant = di.imm
+            return Operand(OPERAND_IMMEDIATE, constant, size)
+        elif type == O_IMM1: # first operand for ENTER
+            return Operand(OPERAND_IMMEDIATE, di.imm & 0xffffffff, size)
+        elif type == O_IMM2: # second operand for ENTER
+            return Operand(OPERAND_IMMEDIATE, di.imm >> 32, size)
+        elif type == O_REG:
+            return Operand(OPERAND_REGISTER, index, size)
+        elif type == O_MEM:
+            return Operand(OPERAND_MEMORY, di.base, index, size, di.scale, _unsignedToSigned(di.disp), di.dispSize, self.segment)
+        elif type == O_SMEM:
+            return Operand(OPERAND_MEMORY, None, index, size, di.scale, _unsignedToSigned(di.disp), di.dispSize, self.segment)
+        elif type == O_DISP:
+            return Operand(OPERAND_ABSOLUTE_ADDRESS, size, di.disp, di.dispSize, self.segment)
+        elif type == O_PC:
+            return Operand(OPERAND_IMMEDIATE, _unsignedToSigned(di.imm & _OffsetMask) + self.address + self.size, size)
+        elif type == O_PTR:
+            return Operand(OPERAND_FAR_MEMORY, di.imm & 0xffff, (di.imm >> 32) & 0xffffffff, size)
         else:
-            raise ValueError("Unknown operand type encountered: %d!" % operand.type)
+            raise ValueError("Unknown operand type encountered: %d!" % type)
 
     def _toText(self):
-        # use the decode which already returns the text formatted well (with prefixes, etc).
-        return Decode(self.address, self.instructionBytes, self.dt)[0][2]
+        try:
+            return self._text
+        except AttributeError:
+            pass
+        # format the decomposed instruction, the same text as Decode returns (with prefixes, etc).
+        text = _format(self.instructionBytes, self.dt, self._di)
+        self._text = text
+        return text
 
     def __str__(self):
         return self._toText()
 
 
-def DecomposeGenerator(codeOffset, code, dt, features = 0):
+def _filterBits(values, names, what):
+    "Returns a mask with the bit of every value, which is an index into names or one of them."
+    mask = 0
+    for value in values:
+        index = names.index(value) if value in names else value
+        if not isinstance(index, int) or not 0 <= index < len(names):
+            raise ValueError("Unknown %s: %r" % (what, value))
+        mask |= 1 << index
+    return mask
+
+_mnemonicOpcodes = None
+
+class DecodeFilter (object):
+    """
+    Decides which instructions are returned, the decoder checks them in C,
+    so the others don't cost anything beyond decoding them (no Python objects or array entries).
+    An instruction is returned if it matches all of the given criteria, eg. the SSE instructions that use RSP:
+
+        DecodeFilter(classes = ["ISC_SSE", "ISC_SSE2"], registers = ["RM_SP"])
+
+    Undecodable bytes are never returned. See L{Decompose}, L{DecomposeGenerator} and L{DecomposeArray}.
+    """
+
+    def __init__(self, opcodes = None, classes = None, flow_control = None, registers = None, rip_relative = False, privileged = False):
+        """
+        @type  opcodes: iterable of int or str
+        @param opcodes: Opcode IDs or mnemonics (see L{Mnemonics}), eg. "MOVAPS", the instruction is one of.
+
+        @type  classes: iterable of int or str
+        @param classes: Instruction set classes (see L{InstructionSetClasses}), eg. "ISC_SSE", the instruction belongs to one of.
+
+        @type  flow_control: iterable of int or str
+        @param flow_control: Flow control types (see L{FlowControlFlags}), eg. "FC_CALL", the instruction is one of.
+            "FC_NONE" stands for the instructions that don't change the flow.
+
+        @type  registers: int, or iterable of str
+        @param registers: Register classes (see L{RegisterMasks}) that the instruction uses at least one of,
+            their mask or names, eg. "RM_SP".
+
+        @type  rip_relative: bool
+        @param rip_relative: The instruction uses RIP-relative indirection.
+
+        @type  privileged: bool
+        @param privileged: The instruction is privileged.
+
+        @raise ValueError: An unknown opcode, class, flow control type or register class.
+        """
+        global _mnemonicOpcodes
+        bitmap = None
+        if opcodes is not None:
+            if _mnemonicOpcodes is None:
+                _mnemonicOpcodes = dict([(name, opcode) for (opcode, name) in Mnemonics.items()])
+            bitmap = bytearray(FILTER_OPCODES_SIZE)
+            for opcode in opcodes:
+                opcode = _mnemonicOpcodes.get(opcode, opcode)
+                if opcode not in Mnemonics:
+                    raise ValueError("Unknown opcode: %r" % (opcode,))
+                bitmap[opcode >> 3] |= 1 << (opcode & 7)
+            bitmap = bytes(bitmap)
+        iscMask = _filterBits(classes, InstructionSetClasses, "instruction set class") if classes is not None else 0
+        fcMask = _filterBits(flow_control, FlowControlFlags, "flow control type") if flow_control is not None else 0
+        if registers is None:
+            registers = 0
+        elif not isinstance(registers, int):
+            maskNames = dict([(name, mask) for (mask, name) in RegisterMasks.items()])
+            mask = 0
+            for name in registers:
+                if name not in maskNames:
+                    raise ValueError("Unknown register class: %r" % (name,))
+                mask |= maskNames[name]
+            registers = mask
+        flags = (FLAG_RIP_RELATIVE if rip_relative else 0) | (FLAG_PRIVILEGED_INSTRUCTION if privileged else 0)
+
+        # The arguments of the native entry points, and the structure for the ctypes ones (that keeps the bitmap alive).
+        self._args = (bitmap, iscMask, fcMask, registers, flags)
+        self._struct = _DecodeFilter(None, iscMask, fcMask, registers, flags)
+        if bitmap is not None:
+            self._opcodes = (c_ubyte * FILTER_OPCODES_SIZE).from_buffer_copy(bitmap)
+            self._struct.opcodes = addressof(self._opcodes)
+
+def _decomposeGenerator(codeOffset, code, dt, features, with_text, batchSize, pool, maxInstructions = None, endAddress = None, decodeFilter = None):
+    "Implements DecomposeGenerator, decomposing up to batchSize instructions at a time with the result buffers of the pool."
+    code = _codeView(code)
+    if not code:
+        return
+
+    if not codeOffset:
+        codeOffset = 0
+
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (dt,))
+
+    endIndex        = _endIndex(codeOffset, len(code), endAddress)
+    # An instruction that starts before the end is decoded whole, its bytes are needed.
+    codeLen         = min(len(code), endIndex + MAX_INSTRUCTION_SIZE - 1)
+    index           = 0
+    startCodeOffset = codeOffset
+    decompose, _, code_arg = _getDecoders(code[:codeLen] if codeLen < len(code) else code, with_text, pool, decodeFilter)
+    # A stop flag ends the decoding after a single batch, so it has to be a full one.
+    stopFlags       = features & (DF_STOP_ON_FLOW_CONTROL | DF_STOP_ON_PRIVILEGED | DF_STOP_ON_UNDECODEABLE)
+
+    for batch in _batchSizes(batchSize, maxInstructions, not stopFlags):
+        if index >= endIndex:
+            break
+
+        if with_text:
+            status, insts, nextOffset, texts = decompose(codeOffset, code_arg, index, dt, features, batch)
+        else:
+            status, insts, nextOffset = decompose(codeOffset, code_arg, index, dt, features, batch)
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_decode()")
+
+        if with_text:
+            for di, text in zip(insts, texts):
+                start = (di.addr - startCodeOffset) & _OffsetMask
+                if start >= endIndex:
+                    return
+                yield Instruction(di, code[start : start + di.size], dt, text)
+        else:
+            for di in insts:
+                # the addresses wrap around at the end of the address space.
+                start = (di.addr - startCodeOffset) & _OffsetMask
+                if start >= endIndex:
+                    return
+                yield Instruction(di, code[start : start + di.size], dt)
+
+        delta      = (nextOffset - codeOffset) & _OffsetMask
+        codeOffset = codeOffset + delta
+        index      = index + delta
+
+        if stopFlags:
+            break # User passed a stop flag.
+
+        # A call might return no instructions (eg. with DF_RETURN_FC_ONLY) but still move forward,
+        # the decoding ends only when it doesn't.
+        if delta == 0:
+            break
+
+def DecomposeGenerator(codeOffset, code, dt, features = 0, with_text = False, max_instructions = None, end_address = None, filter = None):
     """
     @type  codeOffset: long
     @param codeOffset: Memory address where the code is located.
         This is B{not} an offset into the code!
         It's the actual memory address where it was read from.
 
-    @type  code: str, in Py3 bytes
-    @param code: Code to disassemble.
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+        Each instruction's instructionBytes is a memoryview slice of it.
 
     @type  dt: int
     @param dt: Disassembly type. Can be one of the following:
@@ -671,61 +1272,789 @@ def DecomposeGenerator(codeOffset, code, dt, features = 0):
     @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
                      or other features, eg. DF_RETURN_FC_ONLY.
 
+    @type  with_text: bool
+    @param with_text: Format the text of the instructions in the same pass,
+        so str() of the returned instructions doesn't have to do it.
+
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, only instructions that start before it are returned.
+        By default it's the end of the code.
+
+    @type  filter: L{DecodeFilter}
+    @param filter: Return only the instructions that match it.
+
     @rtype:  generator of TODO
     @return: Generator of TODO
 
     @raise ValueError: Invalid arguments.
     """
+    return _decomposeGenerator(codeOffset, code, dt, features, with_text, MAX_INSTRUCTIONS, None, max_instructions, end_address, filter)
 
-    if not code:
+def Decompose(offset, code, type = Decode32Bits, features = 0, with_text = False, max_instructions = None, end_address = None, filter = None):
+    """
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+        This is B{not} an offset into the code!
+        It's the actual memory address where it was read from.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+        Each instruction's instructionBytes is a memoryview slice of it.
+
+    @type  type: int
+    @param type: Disassembly type. Can be one of the following:
+
+         * L{Decode16Bits}: 80286 decoding
+
+         * L{Decode32Bits}: IA-32 decoding
+
+         * L{Decode64Bits}: AMD64 decoding
+
+    @type  features: int
+    @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                     or other features, eg. DF_RETURN_FC_ONLY.
+
+    @type  with_text: bool
+    @param with_text: Format the text of the instructions in the same pass,
+        so str() of the returned instructions doesn't have to do it.
+
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, only instructions that start before it are returned.
+        By default it's the end of the code.
+
+    @type  filter: L{DecodeFilter}
+    @param filter: Return only the instructions that match it.
+
+    @rtype:  TODO
+    @return: TODO
+    @raise ValueError: Invalid arguments.
+    """
+    return list(DecomposeGenerator(offset, code, type, features, with_text, max_instructions, end_address, filter))
+
+def DecomposeOne(offset, code, type = Decode32Bits, features = 0):
+    """
+    Decomposes the single instruction at the beginning of the code.
+    It's the fast path for decomposing one instruction at a time, no more than its first 15 bytes are looked at.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code of the instruction, only up to L{MAX_INSTRUCTION_SIZE} bytes are used.
+        The instructionBytes of the instruction is a slice of it.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @type  features: int
+    @param features: Features for decomposing, eg. DF_MAXIMUM_ADDR32 or DF_FILL_EFLAGS.
+
+    @rtype:  L{Instruction}
+    @return: The decomposed instruction, or None if the code is empty
+        (or the instruction isn't flow control with DF_RETURN_FC_ONLY).
+
+    @raise ValueError: Invalid arguments.
+    """
+    if _native is not None:
+        di = _native.decompose_one(offset or 0, code, type, features)
+    else:
+        code = _codeView(code)
+        di = _decomposeOneCtypes(offset or 0, code, type, features)
+    if di is None:
+        return None
+    return Instruction(di, code[:di.size], type)
+
+def DecomposeRegion(offset, code, type = Decode32Bits, features = 0, end_address = None, max_instructions = None):
+    """
+    Decomposes the code up to the end address, and tells why the decoding stopped, eg. for decoding a basic block:
+
+        insts, stop, next_address = DecomposeRegion(block, code, Decode64Bits, DF_STOP_ON_FLOW_CONTROL, next_block)
+        if stop == DECSTOP_FLOW_CONTROL:
+            ... # insts[-1] is the branch.
+        elif stop == DECSTOP_REGION_END:
+            ... # falls through to next_block.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @type  features: int
+    @param features: Features for decomposing, the DF_STOP_ON_XXX features stop the decoding too.
+
+    @type  end_address: long
+    @param end_address: Memory address where the region ends, by default it's the end of the code.
+        An instruction that starts before it is decoded whole, even if it ends after it.
+        An end address at or below the offset is an empty region, unless the code wraps around
+        the end of the address space and the end address is in its wrapped part.
+
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @rtype:  tuple( list of L{Instruction}, int, long )
+    @return: The decomposed instructions, the reason the decoding stopped for (one of the DECSTOP_XXX values,
+        DECSTOP_RESULTS_FULL when max_instructions were decomposed but there's more of the region),
+        and the memory address where the decoding can be resumed from.
+
+    @raise ValueError: Invalid arguments.
+    """
+    code = _codeView(code)
+    if not offset:
+        offset = 0
+    if type not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (type,))
+    if end_address is None:
+        end_address = offset + len(code)
+
+    if _native is not None:
+        decomposeRegion, code_arg = _native.decompose_region, code
+    else:
+        decomposeRegion, code_arg = _decomposeRegionCtypes, _CtypesCode(code)
+    startOffset  = offset
+    index        = 0
+    instructions = []
+    stop         = DECSTOP_CODE_END
+
+    for batch in _batchSizes(MAX_INSTRUCTIONS, max_instructions):
+        status, insts, nextOffset, stop = decomposeRegion(offset, code_arg, index, type, features, batch, end_address & _OffsetMask)
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_decompose_region()")
+
+        for di in insts:
+            start = (di.addr - startOffset) & _OffsetMask
+            instructions.append(Instruction(di, code[start : start + di.size], type))
+
+        delta  = (nextOffset - offset) & _OffsetMask
+        offset = (offset + delta) & _OffsetMask
+        index  = index + delta
+        if stop != DECSTOP_RESULTS_FULL:
+            break
+
+    return (instructions, stop, offset)
+
+def _stopReason(features, di):
+    "Returns the stop feature (DF_STOP_ON_XXX) that the decoder stops on the instruction record for, or 0."
+    if di.flags == FLAG_NOT_DECODABLE:
+        return features & DF_STOP_ON_UNDECODEABLE
+    if (features & DF_STOP_ON_PRIVILEGED) and (di.flags & FLAG_PRIVILEGED_INSTRUCTION):
+        return DF_STOP_ON_PRIVILEGED
+    fc = di.meta & 0xf
+    if fc == 0 or fc > FlowControl.HLT:
+        return 0
+    # The flow control stop features are in the order of the flow control types.
+    return features & (DF_STOP_ON_CALL << (fc - FlowControl.CALL))
+
+def _decomposeEventsCtypes(codeOffset, code, index, dt, features, maxEvents):
+    "Same as the native _distorm3.decompose_events, but code is a _CtypesCode."
+    insts   = []
+    reasons = []
+    status  = DECRES_SUCCESS
+    while len(insts) < maxEvents and index < code.length:
+        status, batch, nextOffset = _decomposeCtypes(codeOffset, code, index, dt, features, MAX_INSTRUCTIONS)
+        if status == DECRES_INPUTERR:
+            return (status, [], codeOffset, [])
+        reason = _stopReason(features, batch[-1]) if status == DECRES_SUCCESS and batch else 0
+        if reason:
+            insts.append(batch[-1])
+            reasons.append(reason)
+        delta      = (nextOffset - codeOffset) & _OffsetMask
+        codeOffset = (codeOffset + delta) & _OffsetMask
+        index      = index + delta
+        if status not in (DECRES_SUCCESS, DECRES_MEMORYERR) or delta == 0:
+            break
+    return (DECRES_SUCCESS if status == DECRES_MEMORYERR else status, insts, codeOffset, reasons)
+
+def DecomposeEvents(offset, code, type = Decode32Bits, features = DF_STOP_ON_FLOW_CONTROL, max_events = None):
+    """
+    Decomposes the code and yields the instructions that the stop features stop on, along with the feature, eg:
+
+        for inst, reason in DecomposeEvents(0x1000, code, Decode64Bits, DF_STOP_ON_CALL | DF_STOP_ON_PRIVILEGED):
+            ...
+
+    Unlike L{DecomposeGenerator}, which ends on the first stop, the stop features are events here,
+    the decoder goes on right after each one until the code ends, without coming back to Python in between.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @type  features: int
+    @param features: The stop features of the events, eg. DF_STOP_ON_FLOW_CONTROL, DF_STOP_ON_PRIVILEGED
+        or DF_STOP_ON_UNDECODEABLE, along with other features, eg. DF_STOP_ON_TRUNCATED that ends the events
+        at an instruction that the code ends in the middle of.
+
+    @type  max_events: int
+    @param max_events: Maximum number of events to return, unlimited by default.
+
+    @rtype:  generator of tuple( L{Instruction}, int )
+    @return: Every stopping instruction, with the stop feature (DF_STOP_ON_XXX) it stops on.
+
+    @raise ValueError: Invalid arguments.
+    """
+    code = _codeView(code)
+    if not offset:
+        offset = 0
+    if type not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (type,))
+
+    if _native is not None:
+        decomposeEvents, code_arg = _native.decompose_events, code
+    else:
+        decomposeEvents, code_arg = _decomposeEventsCtypes, _CtypesCode(code)
+    startOffset = offset
+    index       = 0
+
+    for batch in _batchSizes(MAX_INSTRUCTIONS, max_events):
+        if index >= len(code):
+            break
+
+        status, insts, nextOffset, reasons = decomposeEvents(offset, code_arg, index, type, features, batch)
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_decompose()")
+
+        for di, reason in zip(insts, reasons):
+            start = (di.addr - startOffset) & _OffsetMask
+            yield (Instruction(di, code[start : start + di.size], type), reason)
+
+        delta  = (nextOffset - offset) & _OffsetMask
+        offset = offset + delta
+        index  = index + delta
+        if delta == 0 or status == DECRES_TRUNCATED:
+            break
+
+# Default number of bytes that the stream functions read at a time.
+STREAM_CHUNK_SIZE = 1 << 20
+
+def _streamChunks(stream, chunkSize):
+    "Yields the chunks of a readable binary stream, or of an iterable of chunks."
+    read = getattr(stream, 'read', None)
+    if read is None:
+        for chunk in stream:
+            if chunk:
+                yield chunk
         return
 
-    if not codeOffset:
-        codeOffset = 0
+    # Hint the OS to read ahead, when the stream is a file.
+    try:
+        os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+    except (AttributeError, OSError, ValueError):
+        pass
+    while True:
+        chunk = read(chunkSize)
+        if not chunk:
+            return
+        yield chunk
+
+def _streamBuffers(codeOffset, stream, chunkSize, state):
+    """
+    Yields the buffers to decode out of a stream, each with the bytes that weren't consumed from the previous one.
+    The decoder tells how many bytes it consumed (and whether it's done) through state, which holds
+    [address of the buffer, number of bytes consumed from it, stop].
+    Yields tuple( buffer, safe end ): instructions that start before the safe end are certainly whole in the buffer,
+    which is all of it for the last buffer.
+    """
+    carry = b""
+    state[0] = codeOffset or 0
+    chunks = _streamChunks(stream, chunkSize)
+    while not state[2]:
+        chunk = next(chunks, None)
+        if chunk is None:
+            if carry:
+                yield (carry, len(carry))
+            return
+        buf = b"".join((carry, chunk))
+        # An instruction is at most MAX_INSTRUCTION_SIZE bytes, so the ones that start earlier can't be cut.
+        safeEnd = len(buf) - (MAX_INSTRUCTION_SIZE - 1)
+        if safeEnd <= 0:
+            carry = buf
+            continue
+        state[1] = 0
+        yield (buf, safeEnd)
+        # At most MAX_INSTRUCTION_SIZE - 1 bytes of an unfinished instruction are carried to the next buffer.
+        carry = buf[state[1]:]
+        state[0] += state[1]
+
+def DecodeStream(codeOffset, stream, dt, chunk_size = STREAM_CHUNK_SIZE):
+    """
+    Decodes the code of a stream, in constant memory, the result is the same as of L{DecodeGenerator} for all of it.
+
+    @type  codeOffset: long
+    @param codeOffset: Memory address where the code is located.
+
+    @type  stream: file-like object, or iterable of str
+    @param stream: Readable binary stream of the code (files are read sequentially),
+        or an iterable of chunks of code, eg. bytes objects.
 
+    @type  dt: int
+    @param dt: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @type  chunk_size: int
+    @param chunk_size: Number of bytes to read from the stream at a time.
+
+    @rtype:  generator of tuple( long, int, str, str )
+    @return: Generator of tuples. Each tuple represents an assembly instruction
+        and contains:
+         - Memory address of instruction.
+         - Size of instruction in bytes.
+         - Disassembly line of instruction.
+         - Hexadecimal dump of instruction.
+
+    @raise ValueError: Invalid arguments.
+    """
     if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
         raise ValueError("Invalid decode type value: %r" % (dt,))
+    pool = _ResultPool()
+    state = [0, 0, False]
+    for buf, safeEnd in _streamBuffers(codeOffset, stream, chunk_size, state):
+        for inst in _decodeGenerator(state[0], buf, dt, MAX_INSTRUCTIONS, pool, None, state[0] + safeEnd):
+            yield inst
+            # The decoded instructions are consecutive.
+            state[1] += inst[1]
+
+def DecomposeStream(codeOffset, stream, dt, features = 0, with_text = False, chunk_size = STREAM_CHUNK_SIZE):
+    """
+    Decomposes the code of a stream, in constant memory, the result is the same as of L{DecomposeGenerator} for all of it
+    (except that the stop flags stop the decoding on the first stopping instruction, rather than after a batch).
 
-    codeLen         = len(code)
-    code_buf        = create_string_buffer(code)
-    p_code          = byref(code_buf)
-    result          = (_DInst * MAX_INSTRUCTIONS)()
-    startCodeOffset = codeOffset
+    @type  codeOffset: long
+    @param codeOffset: Memory address where the code is located.
 
-    while codeLen > 0:
+    @type  stream: file-like object, or iterable of str
+    @param stream: Readable binary stream of the code (files are read sequentially),
+        or an iterable of chunks of code, eg. bytes objects.
 
-        usedInstructionsCount = c_uint(0)
-        codeInfo = _CodeInfo(_OffsetType(codeOffset), _OffsetType(0), _OffsetType(0), cast(p_code, c_char_p), codeLen, dt, features)
-        status = internal_decompose(byref(codeInfo), byref(result), MAX_INSTRUCTIONS, byref(usedInstructionsCount))
-        if status == DECRES_INPUTERR:
-            raise ValueError("Invalid arguments passed to distorm_decode()")
+    @type  dt: int
+    @param dt: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
 
-        used = usedInstructionsCount.value
-        if not used:
-            break
+    @type  features: int
+    @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                     or other features, eg. DF_RETURN_FC_ONLY.
 
-        for index in range(used):
-            di = result[index]
-            yield Instruction(di, code[di.addr - startCodeOffset : di.addr - startCodeOffset + di.size], dt)
+    @type  with_text: bool
+    @param with_text: Format the text of the instructions while decomposing them, see L{DecomposeGenerator}.
 
-        lastInst = result[used - 1]
-        delta = lastInst.addr + lastInst.size - codeOffset
-        codeOffset = codeOffset + delta
-        p_code     = byref(code_buf, codeOffset - startCodeOffset)
-        codeLen    = codeLen - delta
+    @type  chunk_size: int
+    @param chunk_size: Number of bytes to read from the stream at a time.
+
+    @rtype:  generator of L{Instruction}
+    @return: Generator of the decomposed instructions, their instructionBytes are slices of the buffer they were decoded from.
+
+    @raise ValueError: Invalid arguments.
+    """
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (dt,))
+    # The instructions that DF_RETURN_FC_ONLY drops are filtered here instead,
+    # as the ones that end a buffer have to be seen to know where the next buffer starts.
+    fcOnly = features & DF_RETURN_FC_ONLY
+    if fcOnly:
+        features &= ~(DF_RETURN_FC_ONLY | DF_STOP_ON_UNDECODEABLE)
+    pool = _ResultPool()
+    state = [0, 0, False]
+    for buf, safeEnd in _streamBuffers(codeOffset, stream, chunk_size, state):
+        address = state[0]
+        decompose, _, code_arg = _getDecoders(buf, with_text, pool)
+        view = _codeView(buf)
+        index = 0
+        while index < safeEnd:
+            results = decompose(address, code_arg, index, dt, features, MAX_INSTRUCTIONS)
+            status, insts, nextOffset = results[:3]
+            if status == DECRES_INPUTERR:
+                raise ValueError("Invalid arguments passed to distorm_decode()")
+            texts = results[3] if with_text else [None] * len(insts)
+
+            nextIndex = index + ((nextOffset - address) & _OffsetMask)
+            for di, text in zip(insts, texts):
+                start = index + ((di.addr - address) & _OffsetMask)
+                if start >= safeEnd:
+                    # It might be cut, it's decoded again along with the next chunk.
+                    nextIndex = start
+                    break
+                if fcOnly and not (di.meta & 0xf): # FC_NONE
+                    continue
+                yield Instruction(di, view[start : start + di.size], dt, text)
+            else:
+                # A stop flag ended the decoding before the end of the code.
+                if status == DECRES_SUCCESS and nextIndex < len(buf) and not state[2]:
+                    state[2] = True
+            address = (address + nextIndex - index) & _OffsetMask
+            index = nextIndex
+            if state[2] or not insts:
+                break
+        state[1] = index
+
+_dinstDtype = None
+
+def _getDInstDtype(numpy):
+    "Returns the NumPy dtype that mirrors the _DInst structure, imm is its raw 64 bits."
+    global _dinstDtype
+    # Threads that race here (without a GIL too) build equal dtypes, it doesn't matter which one is kept.
+    if _dinstDtype is None:
+        names = [name for (name, _) in _DInst._fields_]
+        formats = [numpy.uint64 if name == 'imm' else numpy.dtype(ctype) for (name, ctype) in _DInst._fields_]
+        offsets = [getattr(_DInst, name).offset for name in names]
+        _dinstDtype = numpy.dtype({'names': names, 'formats': formats, 'offsets': offsets, 'itemsize': sizeof(_DInst)})
+    return _dinstDtype
+
+def DecomposeArray(offset, code, type = Decode32Bits, features = 0, filter = None):
+    """
+    Decomposes the code into a NumPy structured array, the C decoder fills it directly.
+    Its dtype mirrors the _DInst structure (addr, size, opcode, flags, meta, ops, imm, disp, usedRegistersMask, etc),
+    where imm is the raw 64 bits of the immediate union and ops is a (type, index, size) sub-array.
+    That's useful for vectorized queries over whole binaries, eg. numpy.bincount(a['opcode']).
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+        This is B{not} an offset into the code!
+        It's the actual memory address where it was read from.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type. Can be one of the following:
+
+         * L{Decode16Bits}: 80286 decoding
+
+         * L{Decode32Bits}: IA-32 decoding
+
+         * L{Decode64Bits}: AMD64 decoding
+
+    @type  features: int
+    @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                     or other features, eg. DF_RETURN_FC_ONLY.
+
+    @type  filter: L{DecodeFilter}
+    @param filter: Return only the instructions that match it.
+
+    @rtype:  numpy.ndarray
+    @return: Structured array of the decomposed instructions.
+
+    @raise ValueError: Invalid arguments.
+    @raise ImportError: NumPy isn't installed.
+    """
+    import numpy
+
+    dtype = _getDInstDtype(numpy)
+    code = _codeView(code)
+    if not offset:
+        offset = 0
+
+    if type not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (type,))
+
+    codeLen = len(code)
+    # Most instructions are longer than a few bytes, the array grows if needed and is trimmed eventually.
+    # Only a few of the instructions are returned with DF_RETURN_FC_ONLY or a filter, so it starts small.
+    if filter is None and not (features & DF_RETURN_FC_ONLY):
+        result = numpy.empty(codeLen // 4 + 16, dtype = dtype)
+    else:
+        result = numpy.empty(min(codeLen // 4 + 16, 1024), dtype = dtype)
+    count  = 0
+    index  = 0
+    if _native is not None:
+        decomposeInto, code_arg = _native.decompose_into, code
+        filterArg = filter._args if filter is not None else None
+    else:
+        decomposeInto, code_arg = _decomposeIntoCtypes, _CtypesCode(code)
+        filterArg = filter
+
+    while index < codeLen:
+
+        if count == len(result):
+            result.resize(count * 2, refcheck = False)
+
+        status, used, nextOffset = decomposeInto(offset, code_arg, index, type, features, result[count:], filterArg)
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_decompose()")
+
+        count += used
+
+        delta  = (nextOffset - offset) & _OffsetMask
+        offset = offset + delta
+        index  = index + delta
 
         if (features & (DF_STOP_ON_FLOW_CONTROL | DF_STOP_ON_PRIVILEGED | DF_STOP_ON_UNDECODEABLE)) != 0:
             break # User passed a stop flag.
 
-def Decompose(offset, code, type = Decode32Bits, features = 0):
+        # A filtered call might return no instructions but still move forward, the decoding ends only when it doesn't.
+        if delta == 0:
+            break
+
+    result.resize(count, refcheck = False)
+    return result
+
+def DecodeLengths(code, type = Decode32Bits, features = 0):
+    """
+    Decodes only the length of every instruction in the code, without decomposing or formatting it.
+    That's all that scanning for instruction boundaries needs (code caves, hooks, patch sizes),
+    and it's much faster than decomposing the instructions, as no structures or objects are created for them.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type. Can be one of the following:
+
+         * L{Decode16Bits}: 80286 decoding
+
+         * L{Decode32Bits}: IA-32 decoding
+
+         * L{Decode64Bits}: AMD64 decoding
+
+    @type  features: int
+    @param features: DF_SINGLE_BYTE_STEP for the length of the instruction at every byte of the code,
+        DF_STOP_ON_TRUNCATED to leave out an instruction that the code ends in the middle of.
+        Other features don't apply.
+
+    @rtype:  bytearray
+    @return: The length of every instruction, in the order of the instructions.
+        An undecodable byte has a zero length, and it's skipped like a one byte instruction,
+        so the instructions start at the running sum of the lengths (counting a zero as one).
+
+    @raise ValueError: Invalid arguments.
+    """
+    code = _codeView(code)
+    if type not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (type,))
+
+    codeLen = len(code)
+    # An instruction is at least a byte long, so there's a length per byte at the most.
+    result = bytearray(codeLen)
+    count  = 0
+    index  = 0
+    if _native is not None:
+        lengthsInto, code_arg = _native.lengths_into, code
+    else:
+        lengthsInto, code_arg = _lengthsIntoCtypes, _CtypesCode(code)
+
+    # The decoder stops at every 2GB of code, see parse_code_info.
+    while index < codeLen:
+        status, used, nextOffset = lengthsInto(index, code_arg, index, type, features, memoryview(result)[count:])
+        if status == DECRES_INPUTERR:
+            raise ValueError("Invalid arguments passed to distorm_lengths()")
+        count += used
+        if used == 0 or status == DECRES_TRUNCATED:
+            break
+        index = nextOffset
+
+    del result[count:]
+    return result
+
+def _bitmapIntoCtypes(codeOffset, code, dt, features, out):
+    "Same as the native _distorm3.bitmap_into, from the lengths of DecodeLengths."
+    lengths = DecodeLengths(code, dt, features & DF_SINGLE_BYTE_STEP)
+    out[:] = bytearray(len(out))
+    index = 0
+    for length in lengths:
+        if length:
+            out[index >> 3] |= 1 << (index & 7)
+        index += 1 if (features & DF_SINGLE_BYTE_STEP) or not length else length
+
+class InstructionBitmap (object):
+    """
+    A bit per byte of code, that is set if an instruction starts at that byte, see L{DecodeBoundaries}.
+    It takes an eighth of the code's size, and answers whether an address is an instruction's start quickly:
+
+        if address in bitmap:
+            ...
+
+    Bitmaps of the same code can be combined with & and |, eg. the valid offsets that a linear sweep missed:
+
+        valid & ~boundaries
+
+    The bits are in the bits bytearray, the bits of a byte are from its least significant,
+    eg. numpy.unpackbits(numpy.frombuffer(bitmap.bits, numpy.uint8), bitorder = "little").
+    """
+
+    def __init__(self, offset, length, bits):
+        """
+        @type  offset: long
+        @param offset: Memory address of the first byte.
+
+        @type  length: int
+        @param length: Number of bytes the bitmap covers.
+
+        @type  bits: bytearray
+        @param bits: The bits, (length + 7) // 8 bytes of them, the bits beyond length must be clear.
+        """
+        self.offset = offset
+        self.length = length
+        self.bits = bits
+
+    def __contains__(self, address):
+        index = (address - self.offset) & _OffsetMask
+        return (index < self.length) and (self.bits[index >> 3] >> (index & 7)) & 1 == 1
+
+    def __len__(self):
+        "Returns the number of bytes the bitmap covers."
+        return self.length
+
+    def __iter__(self):
+        "Yields the addresses of the set bits, in order."
+        bits = self.bits
+        offset = self.offset
+        for i in xrange(len(bits)):
+            byte = bits[i]
+            if byte:
+                for j in xrange(8):
+                    if (byte >> j) & 1:
+                        yield (offset + (i << 3) + j) & _OffsetMask
+
+    def __eq__(self, other):
+        return isinstance(other, InstructionBitmap) and (self.offset, self.length, self.bits) == (other.offset, other.length, other.bits)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<InstructionBitmap of %d bytes at 0x%x, %d set>" % (self.length, self.offset, self.count())
+
+    def _toInt(self):
+        return int.from_bytes(self.bits, "little")
+
+    def _fromInt(self, n):
+        return InstructionBitmap(self.offset, self.length, bytearray(n.to_bytes(len(self.bits), "little")))
+
+    def _operand(self, other):
+        if not isinstance(other, InstructionBitmap):
+            return NotImplemented
+        if (self.offset, self.length) != (other.offset, other.length):
+            raise ValueError("The bitmaps cover different code")
+        return other._toInt()
+
+    def __and__(self, other):
+        n = self._operand(other)
+        if n is NotImplemented:
+            return n
+        return self._fromInt(self._toInt() & n)
+
+    def __or__(self, other):
+        n = self._operand(other)
+        if n is NotImplemented:
+            return n
+        return self._fromInt(self._toInt() | n)
+
+    def __invert__(self):
+        return self._fromInt(~self._toInt() & ((1 << self.length) - 1))
+
+    def count(self):
+        "Returns the number of set bits."
+        return bin(self._toInt()).count("1")
+
+def _instructionBitmap(offset, code, dt, features):
+    code = _codeView(code)
+    if not offset:
+        offset = 0
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid decode type value: %r" % (dt,))
+    bits = bytearray((len(code) + 7) // 8)
+    if _native is not None:
+        _native.bitmap_into(offset, code, dt, features, bits)
+    else:
+        _bitmapIntoCtypes(offset, code, dt, features, bits)
+    return InstructionBitmap(offset, len(code), bits)
+
+def DecodeBoundaries(offset, code, type = Decode32Bits):
     """
+    Returns the start of every instruction that a linear sweep of the code finds (undecodable bytes aren't instructions),
+    as a bitmap with a bit per byte. That's what "is this address an instruction's start?" tests need,
+    without keeping the instructions themselves around.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @rtype:  L{InstructionBitmap}
+    @return: The bitmap of the instructions' starts.
+
+    @raise ValueError: Invalid arguments.
+    """
+    return _instructionBitmap(offset, code, type, 0)
+
+def DecodeValidOffsets(offset, code, type = Decode32Bits):
+    """
+    Returns every byte of the code that a valid instruction starts at, when decoding from each byte (see DF_SINGLE_BYTE_STEP),
+    as a bitmap with a bit per byte. Overlapping instructions are all there, not only the ones a linear sweep finds.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+    @rtype:  L{InstructionBitmap}
+    @return: The bitmap of the valid offsets.
+
+    @raise ValueError: Invalid arguments.
+    """
+    return _instructionBitmap(offset, code, type, DF_SINGLE_BYTE_STEP)
+
+def _decomposeAtCtypes(codeOffset, code, dt, features, addresses, out):
+    "Same as the native _distorm3.decompose_at, addresses is a uint64 array."
+    if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+        raise ValueError("Invalid arguments passed to distorm_decompose()")
+    code = _codeView(code)
+    result = (_DInst * len(addresses)).from_buffer(out)
+    pool = _localPool()
+    decoded = 0
+    for i, address in enumerate(addresses):
+        address = int(address)
+        if i > 0 and address == int(addresses[i - 1]):
+            result[i] = result[i - 1]
+            continue
+        index = (address - codeOffset) & _OffsetMask
+        insts = []
+        if index < len(code):
+            _, insts, _ = _decomposeCtypes(address, _CtypesCode(code[index : index + MAX_INSTRUCTION_SIZE], pool), 0, dt, features, 1)
+        if insts:
+            result[i] = _dinstStruct(insts[0])
+            decoded += 1
+        else:
+            result[i] = _DInst()
+            result[i].addr = address
+            result[i].flags = FLAG_NOT_DECODABLE
+    return decoded
+
+def DecomposeAt(offset, code, addresses, type = Decode32Bits, features = 0):
+    """
+    Decomposes the single instruction at each of the given addresses of the code, all in one native call.
+    That's what trace post-processing, cross references validation and gadgets lookup need,
+    instead of running a generator per address.
+
     @type  offset: long
     @param offset: Memory address where the code is located.
         This is B{not} an offset into the code!
         It's the actual memory address where it was read from.
 
-    @type  code: str, in Py3 bytes
-    @param code: Code to disassemble.
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  addresses: sequence of long, or a NumPy array
+    @param addresses: Sorted memory addresses of the instructions to decompose.
+        A repeated address is decoded only once.
 
     @type  type: int
     @param type: Disassembly type. Can be one of the following:
@@ -736,12 +2065,160 @@ def Decompose(offset, code, type = Decode32Bits, features = 0):
 
          * L{Decode64Bits}: AMD64 decoding
 
+    @type  features: int
+    @param features: Decoding features, eg. DF_RETURN_FC_ONLY.
+
+    @rtype:  numpy.ndarray
+    @return: Structured array (see L{DecomposeArray}) with an entry per address, in the same order,
+        so each field is a column, eg. a['size'] or a['opcode'].
+        An address that is outside of the code (or filtered out by the features) has a zero size entry.
+
+    @raise ValueError: Invalid arguments.
+    @raise ImportError: NumPy isn't installed.
+    """
+    import numpy
+
+    dtype = _getDInstDtype(numpy)
+    addresses = numpy.ascontiguousarray(addresses, dtype = numpy.uint64)
+    result = numpy.empty(len(addresses), dtype = dtype)
+    if len(addresses) == 0:
+        return result
+    if not offset:
+        offset = 0
+    if _native is not None:
+        _native.decompose_at(offset, _codeView(code), type, features, addresses, result)
+    else:
+        _decomposeAtCtypes(offset, code, type, features, addresses, result)
+    return result
+
+def _decomposeManyCtypes(regions, features, raw):
+    "Same as the native _distorm3.decompose_many, region by region."
+    pool = _localPool()
+    results = []
+    for (address, code, dt) in regions:
+        if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+            raise ValueError("Invalid arguments for region %d" % len(results))
+        results.append([inst._di for inst in _decomposeGenerator(address, code, dt, features, False, MAX_INSTRUCTIONS, pool)])
+    if not raw:
+        return results
+    buf = bytearray()
+    offsets = [0]
+    for insts in results:
+        for di in insts:
+            buf += bytearray(_dinstStruct(di))
+        offsets.append(offsets[-1] + len(insts))
+    return (buf, offsets)
+
+def DecomposeMany(regions, features = 0, as_array = False):
+    """
+    Decomposes many independent regions of code in a single native call.
+    It saves the call overhead of decomposing many small regions (functions, basic blocks, etc) one by one.
+
+    @type  regions: sequence of tuple( long, str, int )
+    @param regions: The (address, code, dt) of every region, see L{Decompose} for their meaning.
+        Every region is decomposed entirely (or up to the stopping instruction if there's a stop flag).
+
     @type  features: int
     @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
                      or other features, eg. DF_RETURN_FC_ONLY.
 
-    @rtype:  TODO
-    @return: TODO
+    @type  as_array: bool
+    @param as_array: Return a NumPy structured array (see L{DecomposeArray}) of the instructions of all the regions,
+        instead of lists of L{Instruction} objects.
+
+    @rtype:  list of list of L{Instruction}, or tuple( numpy.ndarray, numpy.ndarray )
+    @return: The instructions of every region.
+        Or if as_array is set, the array of all the instructions and an array of len(regions) + 1 indexes,
+        so the instructions of region i are array[offsets[i]:offsets[i + 1]].
+
     @raise ValueError: Invalid arguments.
+    @raise ImportError: as_array is set and NumPy isn't installed.
+    """
+    if as_array:
+        import numpy
+        dtype = _getDInstDtype(numpy)
+    regions = [(address or 0, _codeView(code), dt) for (address, code, dt) in regions]
+    if _native is not None:
+        results = _native.decompose_many(regions, features, as_array)
+    else:
+        results = _decomposeManyCtypes(regions, features, as_array)
+
+    if as_array:
+        buf, offsets = results
+        return (numpy.frombuffer(buf, dtype = dtype), numpy.array(offsets, dtype = numpy.intp))
+
+    regionsInsts = []
+    for (address, code, dt), insts in zip(regions, results):
+        regionInsts = []
+        for di in insts:
+            start = (di.addr - address) & _OffsetMask
+            regionInsts.append(Instruction(di, code[start : start + di.size], dt))
+        regionsInsts.append(regionInsts)
+    return regionsInsts
+
+class Decoder (object):
     """
-    return list(DecomposeGenerator(offset, code, type, features))
+    Decodes and decomposes code with the same settings, reusing its result buffers across calls.
+    That saves allocating them over and over when many small regions are decoded.
+
+    A Decoder isn't thread-safe, each thread should use its own instance, see L{Decoder.local}.
+    """
+    _locals = threading.local()
+
+    def __init__(self, dt = Decode32Bits, features = 0, batch_size = MAX_INSTRUCTIONS):
+        """
+        @type  dt: int
+        @param dt: Disassembly type, one of L{Decode16Bits}, L{Decode32Bits} or L{Decode64Bits}.
+
+        @type  features: int
+        @param features: Features for decomposing, eg. DF_STOP_ON_CALL or DF_RETURN_FC_ONLY.
+
+        @type  batch_size: int
+        @param batch_size: Maximum number of instructions that are decoded by a single C call,
+            the result buffers are allocated for that many instructions.
+
+        @raise ValueError: Invalid arguments.
+        """
+        if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+            raise ValueError("Invalid decode type value: %r" % (dt,))
+        if batch_size <= 0:
+            raise ValueError("Invalid batch size: %r" % (batch_size,))
+        self.dt = dt
+        self.features = features
+        self.batchSize = batch_size
+        self._pool = _ResultPool(batch_size)
+
+    @classmethod
+    def local(cls, dt = Decode32Bits, features = 0, batch_size = MAX_INSTRUCTIONS):
+        """
+        Returns the calling thread's own Decoder with these settings, it's created upon first use.
+
+        @rtype:  L{Decoder}
+        """
+        try:
+            decoders = cls._locals.decoders
+        except AttributeError:
+            decoders = cls._locals.decoders = {}
+        key = (cls, dt, features, batch_size)
+        decoder = decoders.get(key)
+        if decoder is None:
+            decoder = decoders[key] = cls(dt, features, batch_size)
+        return decoder
+
+    def decodeGenerator(self, offset, code, max_instructions = None, end_address = None):
+        "Same as L{DecodeGenerator} with the settings of this decoder."
+        return _decodeGenerator(offset, code, self.dt, self.batchSize, self._pool, max_instructions, end_address)
+
+    def decode(self, offset, code, max_instructions = None, end_address = None):
+        "Same as L{Decode} with the settings of this decoder."
+        return list(_decodeGenerator(offset, code, self.dt, self.batchSize, self._pool, max_instructions, end_address))
+
+    def decomposeGenerator(self, offset, code, with_text = False, max_instructions = None, end_address = None):
+        "Same as L{DecomposeGenerator} with the settings of this decoder."
+        return _decomposeGenerator(offset, code, self.dt, self.features, with_text, self.batchSize, self._pool,
+            max_instructions, end_address)
+
+    def decompose(self, offset, code, with_text = False, max_instructions = None, end_address = None):
+        "Same as L{Decompose} with the settings of this decoder."
+        return list(_decomposeGenerator(offset, code, self.dt, self.features, with_text, self.batchSize, self._pool,
+            max_instructions, end_address))
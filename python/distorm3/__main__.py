@@ -2,6 +2,21 @@
 
 import distorm3
 import argparse
+import csv
+import io
+import itertools
+import json
+import mmap
+import os
+import sys
+
+# Size of the output buffer, the output is written in big blocks rather than line by line.
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Number of instructions whose lines are joined and written at once.
+OUTPUT_BATCH_SIZE = 4096
+
+FIELDS = ("offset", "size", "instruction", "hexdump")
 
 
 def parse_args():
@@ -27,28 +42,122 @@ def parse_args():
         dest="dt",
         const=distorm3.Decode64Bits,
     )
+    parser.add_argument(
+        "--start",
+        help="index in the file where decoding starts [default: 0]",
+        type=lambda s: int(s, 0),
+        default=0,
+    )
+    parser.add_argument(
+        "--length",
+        help="number of bytes to decode [default: until the end of the file]",
+        type=lambda s: int(s, 0),
+    )
+    parser.add_argument(
+        "--format",
+        help="output format [default: text]",
+        choices=("text", "jsonl", "csv", "tsv"),
+        default="text",
+    )
     parser.add_argument("file",)
     parser.add_argument(
-        "offset", type=int, nargs="?",
+        "offset", type=int, nargs="?", help="memory address of the beginning of the file",
     )
     parser.set_defaults(dt=distorm3.Decode32Bits)
     args = parser.parse_args()
+    if args.start < 0:
+        parser.error("--start can't be negative")
+    if args.length is not None and args.length < 0:
+        parser.error("--length can't be negative")
     return args
 
 
+def batches(iterable, size):
+    iterator = iter(iterable)
+    batch = list(itertools.islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(iterator, size))
+
+
+def write_text(out, instructions):
+    for batch in batches(instructions, OUTPUT_BATCH_SIZE):
+        out.write(
+            "".join(
+                [
+                    "%.8x: %-32s %s\n" % (offset, hexdump, instruction)
+                    for (offset, size, instruction, hexdump) in batch
+                ]
+            )
+        )
+
+
+def write_jsonl(out, instructions):
+    string = json.JSONEncoder().encode
+    for batch in batches(instructions, OUTPUT_BATCH_SIZE):
+        out.write(
+            "".join(
+                [
+                    '{"offset": %d, "size": %d, "instruction": %s, "hexdump": "%s"}\n'
+                    % (offset, size, string(instruction), hexdump)
+                    for (offset, size, instruction, hexdump) in batch
+                ]
+            )
+        )
+
+
+def write_delimited(out, instructions, delimiter):
+    writer = csv.writer(out, delimiter=delimiter, lineterminator="\n")
+    writer.writerow(FIELDS)
+    for batch in batches(instructions, OUTPUT_BATCH_SIZE):
+        writer.writerows(batch)
+
+
+def write_instructions(out, instructions, format):
+    if format == "text":
+        write_text(out, instructions)
+    elif format == "jsonl":
+        write_jsonl(out, instructions)
+    else:
+        write_delimited(out, instructions, "," if format == "csv" else "\t")
+
+
 def main():
     args = parse_args()
-    offset = args.offset
+    offset = args.offset or 0
 
-    # Read the code from the file
-    with open(args.file, "rb") as infp:
-        code = infp.read()
+    # The output goes straight to the standard output's file, through a big buffer.
+    out = io.open(sys.stdout.fileno(), "w", buffering=OUTPUT_BUFFER_SIZE, closefd=False)
 
-    # Print each decoded instruction
-    # This shows how to use the DecodeGenerator
-    iterable = distorm3.DecodeGenerator(offset, code, args.dt)
-    for (offset, size, instruction, hexdump) in iterable:
-        print("%.8x: %-32s %s" % (offset, hexdump, instruction))
+    # Map the code of the file instead of reading it, only the pages that are decoded are read
+    with open(args.file, "rb") as infp:
+        size = os.fstat(infp.fileno()).st_size
+        start = min(args.start, size)
+        end = size if args.length is None else min(start + args.length, size)
+        if start == end:
+            # Nothing to decode (and an empty file can't be mapped), the output still gets its header if any.
+            write_instructions(out, [], args.format)
+            out.close()
+            return
+        with mmap.mmap(infp.fileno(), 0, access=mmap.ACCESS_READ) as code:
+            # The instruction that starts last in the window is decoded whole, even if it ends after the window.
+            view = memoryview(code)[start:]
+            # This shows how to use the DecodeGenerator
+            iterable = distorm3.DecodeGenerator(offset + start, view, args.dt, end_address=offset + end)
+            try:
+                write_instructions(out, iterable, args.format)
+                out.flush()
+            except BrokenPipeError:
+                # The reader is gone (eg. piped to head), anything left in the buffer is dropped.
+                devnull = os.open(os.devnull, os.O_WRONLY)
+                os.dup2(devnull, out.fileno())
+                os.close(devnull)
+                sys.exit(1)
+            finally:
+                # The generator and the view have to let go of the mapping before it's closed.
+                iterable.close()
+                view.release()
+                out.close()
 
     # It could also be used as a returned list:
     # l = distorm3.Decode(offset, code, options.dt)
@@ -0,0 +1,123 @@
+"""
+Decoding in asyncio applications without blocking the event loop.
+
+The instructions are decoded (and their objects are built) in batches by an executor,
+and the native decoder doesn't hold the GIL while it decodes, so the event loop keeps running meanwhile.
+While the instructions of a batch are consumed, the next batch is already being decoded.
+Async generators need Python 3.6 or above.
+
+An iteration that is stopped early should be closed (eg. with contextlib.aclosing),
+so the decoding generator and its view of the code are released right away.
+"""
+
+import asyncio
+import itertools
+
+from . import DecodeGenerator, DecomposeGenerator, Decode32Bits, MAX_INSTRUCTIONS
+
+__all__ = ['adecode', 'adecompose']
+
+def _nextBatch(instructions, batchSize):
+    return list(itertools.islice(instructions, batchSize))
+
+async def _batches(instructions, executor, batchSize):
+    """
+    Yields the items of the generator, which are taken from it in batches by the executor.
+    A batch is taken only once the previous one was, so the generator is never run by two threads at once.
+    If the iteration is cancelled while a batch is taken, the batch is finished (a batch can't be interrupted)
+    and thrown away, then the executor releases the generator.
+    """
+    if batchSize <= 0:
+        raise ValueError("Invalid batch size: %r" % (batchSize,))
+    loop = asyncio.get_running_loop()
+    pending = loop.run_in_executor(executor, _nextBatch, instructions, batchSize)
+    while True:
+        batch = await pending
+        if not batch:
+            return
+        pending = loop.run_in_executor(executor, _nextBatch, instructions, batchSize)
+        if pending.done():
+            # Awaiting a done future doesn't suspend, let the other tasks run between the batches anyway.
+            await asyncio.sleep(0)
+        for inst in batch:
+            yield inst
+
+async def adecode(offset, code, type = Decode32Bits, max_instructions = None, end_address = None, executor = None, batch_size = MAX_INSTRUCTIONS):
+    """
+    Async version of L{distorm3.DecodeGenerator}.
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It mustn't be modified during the iteration.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{distorm3.Decode16Bits}, L{distorm3.Decode32Bits} or L{distorm3.Decode64Bits}.
+
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, by default it's the end of the code.
+
+    @type  executor: concurrent.futures.Executor
+    @param executor: Executor that decodes the batches, the event loop's default executor by default.
+        It has to be a thread pool.
+
+    @type  batch_size: int
+    @param batch_size: Number of instructions that are decoded at a time.
+
+    @rtype:  async generator of tuple( long, int, str, str )
+    @return: The (offset, size, instruction, hexdump) of every instruction, see L{distorm3.DecodeGenerator}.
+
+    @raise ValueError: Invalid arguments.
+    """
+    instructions = DecodeGenerator(offset, code, type, max_instructions, end_address)
+    async for inst in _batches(instructions, executor, batch_size):
+        yield inst
+
+async def adecompose(offset, code, type = Decode32Bits, features = 0, with_text = False, max_instructions = None, end_address = None, executor = None, batch_size = MAX_INSTRUCTIONS):
+    """
+    Async version of L{distorm3.DecomposeGenerator}:
+
+        async for inst in adecompose(0x1000, code, Decode64Bits):
+            ...
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It mustn't be modified during the iteration.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{distorm3.Decode16Bits}, L{distorm3.Decode32Bits} or L{distorm3.Decode64Bits}.
+
+    @type  features: int
+    @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                     or other features, eg. DF_RETURN_FC_ONLY.
+
+    @type  with_text: bool
+    @param with_text: Format the text of the instructions in the executor too.
+
+    @type  max_instructions: int
+    @param max_instructions: Maximum number of instructions to return, unlimited by default.
+
+    @type  end_address: long
+    @param end_address: Memory address where decoding stops, by default it's the end of the code.
+
+    @type  executor: concurrent.futures.Executor
+    @param executor: Executor that decodes the batches, the event loop's default executor by default.
+        It has to be a thread pool.
+
+    @type  batch_size: int
+    @param batch_size: Number of instructions that are decoded at a time.
+
+    @rtype:  async generator of L{distorm3.Instruction}
+    @return: The decomposed instructions.
+
+    @raise ValueError: Invalid arguments.
+    """
+    instructions = DecomposeGenerator(offset, code, type, features, with_text, max_instructions, end_address)
+    async for inst in _batches(instructions, executor, batch_size):
+        yield inst
@@ -0,0 +1,393 @@
+"""
+A cache of decoded code, for applications that decode the same (hot) code over and over,
+like debuggers, emulators and trace replayers.
+
+The entries are keyed on the bytes of the code, the decoding mode and the features, but not on the address:
+a decomposed instruction is position independent besides its address (the targets of O_PC operands are relative),
+so an entry is reused at any address by relocating its records, only the text of the instructions
+with O_PC operands is formatted again.
+At the address an entry was decoded at, its results are returned as they are (see L{DecodeCache}).
+
+L{DiskCache} keeps the raw _DInst arrays of decomposed code in files, for processes that analyze the same binaries again.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+import binascii
+import hashlib
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from . import Instruction, DInst, DecomposeGenerator, DecomposeArray, _codeView, _getDInstDtype, _toUnicode, _OffsetMask, \
+    _endIndex, Decode16Bits, Decode32Bits, Decode64Bits, O_PC, DISTORM_VERSION, _DInst, sizeof
+
+__all__ = ['DecodeCache', 'DiskCache']
+
+# The memory budget of a cache by default.
+DEFAULT_MAX_BYTES = 64 << 20
+
+# Rough number of bytes an entry takes besides its instructions and key.
+_ENTRY_OVERHEAD = 256
+
+def _addrMask(dt):
+    "Returns the mask of the addresses that distorm_decode returns, they wrap around in the decoding mode."
+    return {Decode16Bits: 0xffff, Decode32Bits: 0xffffffff}.get(dt, _OffsetMask)
+
+def _relocated(record, addr):
+    "Returns a copy of the DInst record at another address."
+    # The ctypes records are named tuples, the native ones are struct sequences.
+    if isinstance(record, DInst):
+        return record._replace(addr = addr)
+    fields = list(record)
+    fields[2] = addr
+    return type(record)(fields)
+
+def _instructionSize(inst):
+    di = inst._di
+    return sys.getsizeof(inst) + sys.getsizeof(di) + sys.getsizeof(di.ops) + sys.getsizeof(inst.instructionBytes)
+
+class _Entry (object):
+    """
+    The decomposed instructions of a piece of code, at the address they were decoded at.
+    Their instruction bytes are views of the entry's copy of the code.
+    """
+    __slots__ = ('offset', 'instructions', 'pcIndexes', 'decoded', 'size')
+
+    def __init__(self, offset, instructions, keySize):
+        self.offset = offset
+        self.instructions = instructions
+        # The instructions whose text depends on their address.
+        self.pcIndexes = frozenset([i for (i, inst) in enumerate(instructions) if any([op[0] == O_PC for op in inst._di.ops])])
+        self.decoded = None
+        self.size = _ENTRY_OVERHEAD + keySize + sum([_instructionSize(inst) for inst in instructions])
+
+def _decomposeRegion(offset, code, dt, features, maxInstructions, endAddress):
+    insts = list(DecomposeGenerator(offset, code, dt, features, False, maxInstructions, endAddress))
+    return _Entry(offset, insts, sys.getsizeof(code))
+
+class DecodeCache (object):
+    """
+    An LRU cache of decoded code with a memory budget, it's thread-safe.
+
+    Concurrent identical requests are decoded once, the other requesting threads wait for the result
+    (and count as hits). The sizes of the entries are estimates of the memory that their Python objects take.
+
+    The same Instruction objects are returned for the same code at the same address (the entry's),
+    and their instructionBytes are views of the cache's own copy of the code, not of the code that was passed.
+    """
+
+    def __init__(self, max_bytes = DEFAULT_MAX_BYTES):
+        """
+        @type  max_bytes: int
+        @param max_bytes: Memory budget of the entries, the least recently used entries are evicted beyond it.
+
+        @raise ValueError: Invalid arguments.
+        """
+        if max_bytes <= 0:
+            raise ValueError("Invalid cache size: %r" % (max_bytes,))
+        self.maxBytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        "Estimated number of bytes the entries take."
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        "Evicts all the entries, the counters are kept."
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _evict(self):
+        while self._size > self.maxBytes and self._entries:
+            _, entry = self._entries.popitem(last = False)
+            self._size -= entry.size
+            self.evictions += 1
+
+    def _lookup(self, key, decompose, *args):
+        "Returns the entry of the key, it's decomposed by calling decompose with the args upon a miss."
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+                self.misses += 1
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            entry = decompose(*args)
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            del self._inflight[key]
+            if entry.size <= self.maxBytes:
+                self._entries[key] = entry
+                self._size += entry.size
+                self._evict()
+        future.set_result(entry)
+        return entry
+
+    def _decodedOf(self, key, entry, dt):
+        "Returns the (offset, size, text, hexdump) of the entry's instructions, they're computed once."
+        decoded = entry.decoded
+        if decoded is not None:
+            return decoded
+        mask = _addrMask(dt)
+        decoded = [(inst.address & mask, inst.size, str(inst), _toUnicode(binascii.hexlify(inst.instructionBytes)))
+            for inst in entry.instructions]
+        with self._lock:
+            if entry.decoded is None:
+                entry.decoded = decoded
+                size = sum([sys.getsizeof(d) + sys.getsizeof(d[2]) + sys.getsizeof(d[3]) for d in decoded])
+                entry.size += size
+                if self._entries.get(key) is entry:
+                    self._size += size
+                    self._evict()
+            return entry.decoded
+
+    def _relocatedInstructions(self, entry, offset, dt):
+        "Returns new instructions of the entry at the offset."
+        delta = (offset - entry.offset) & _OffsetMask
+        insts = []
+        for (i, inst) in enumerate(entry.instructions):
+            # The text that was already formatted is kept, unless it has the target of a branch.
+            text = getattr(inst, "_text", None) if i not in entry.pcIndexes else None
+            insts.append(Instruction(_relocated(inst._di, (inst.address + delta) & _OffsetMask), inst.instructionBytes, dt, text))
+        return insts
+
+    def _decompose(self, entry, offset, dt):
+        if offset == entry.offset:
+            return list(entry.instructions)
+        return self._relocatedInstructions(entry, offset, dt)
+
+    def _decode(self, key, entry, offset, dt):
+        decoded = self._decodedOf(key, entry, dt)
+        if offset == entry.offset:
+            return list(decoded)
+        mask = _addrMask(dt)
+        delta = offset - entry.offset
+        result = [((address + delta) & mask, size, text, hexdump) for (address, size, text, hexdump) in decoded]
+        for i in entry.pcIndexes:
+            inst = entry.instructions[i]
+            result[i] = result[i][:2] + (str(Instruction(_relocated(inst._di, (inst.address + delta) & _OffsetMask), inst.instructionBytes, dt)),) + result[i][3:]
+        return result
+
+    def _regionEntry(self, offset, code, dt, features, maxInstructions, endAddress):
+        code = bytes(_codeView(code))
+        key = (code, dt, features, maxInstructions, _endIndex(offset, len(code), endAddress))
+        return (key, self._lookup(key, _decomposeRegion, offset, code, dt, features, maxInstructions, endAddress))
+
+    def decompose(self, offset, code, type = Decode32Bits, features = 0, with_text = False, max_instructions = None, end_address = None):
+        """
+        Cached L{distorm3.Decompose}, the arguments and the result are the same.
+        The text of the instructions is formatted upon str() and kept in the entry, with_text doesn't matter.
+
+        @rtype:  list of L{distorm3.Instruction}
+        @raise ValueError: Invalid arguments.
+        """
+        offset = offset or 0
+        key, entry = self._regionEntry(offset, code, type, features, max_instructions, end_address)
+        return self._decompose(entry, offset, type)
+
+    def decode(self, offset, code, type = Decode32Bits, max_instructions = None, end_address = None):
+        """
+        Cached L{distorm3.Decode}, the arguments and the result are the same.
+        It shares the entries of decompose without features.
+
+        @rtype:  list of tuple( long, int, str, str )
+        @raise ValueError: Invalid arguments.
+        """
+        offset = offset or 0
+        key, entry = self._regionEntry(offset, code, type, 0, max_instructions, end_address)
+        return self._decode(key, entry, offset, type)
+
+# The header of a cache file: magic, the address the instructions were decoded at and their number.
+_FILE_HEADER = struct.Struct("<8sQQ")
+_FILE_MAGIC = b"DSTMDINS"
+_FILE_SUFFIX = ".dinst"
+
+class DiskCache (object):
+    """
+    A cache of decomposed code in a directory, that's shared by processes and kept across runs.
+
+    Every entry is a file with the raw _DInst array of a piece of code, named after the SHA-256 of the code,
+    the decoding mode, the features and the diStorm version (and its _DInst layout).
+    The files are mapped rather than read. At the address the code was decoded at, the array is a read-only view
+    of the mapped file, at other addresses it's a relocated copy.
+    The files are written whole and renamed into place, so concurrent processes never see partial files.
+
+    Eviction removes the files that weren't used for longer than max_age seconds,
+    then the least recently used ones beyond max_bytes. Use updates the modification times of the files.
+    """
+
+    def __init__(self, directory, max_bytes = None, max_age = None):
+        """
+        @type  directory: str
+        @param directory: Directory of the cache files, it's created if it doesn't exist.
+
+        @type  max_bytes: int
+        @param max_bytes: Maximum total size of the files, unlimited by default.
+
+        @type  max_age: float
+        @param max_age: Maximum number of seconds since a file was used, unlimited by default.
+
+        @raise ValueError: Invalid arguments.
+        @raise ImportError: NumPy isn't installed.
+        """
+        import numpy
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("Invalid cache size: %r" % (max_bytes,))
+        if max_age is not None and max_age <= 0:
+            raise ValueError("Invalid cache age: %r" % (max_age,))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.maxBytes = max_bytes
+        self.maxAge = max_age
+        self.hits = 0
+        self.misses = 0
+        self._numpy = numpy
+        self._dtype = _getDInstDtype(numpy)
+
+    def _path(self, code, dt, features):
+        key = "%s-%d-%d-%x-%d" % (hashlib.sha256(code).hexdigest(), dt, features, DISTORM_VERSION, sizeof(_DInst))
+        return os.path.join(self.directory, hashlib.sha256(key.encode("ascii")).hexdigest() + _FILE_SUFFIX)
+
+    def _read(self, path):
+        "Returns the address and the mapped array of a cache file, or None if it's missing or invalid."
+        try:
+            with open(path, "rb") as f:
+                # The mapping stays alive as long as the array does.
+                data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            return None
+        if len(data) < _FILE_HEADER.size:
+            data.close()
+            return None
+        magic, offset, count = _FILE_HEADER.unpack_from(data)
+        if magic != _FILE_MAGIC or len(data) != _FILE_HEADER.size + count * self._dtype.itemsize:
+            data.close()
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return (offset, self._numpy.frombuffer(data, dtype = self._dtype, count = count, offset = _FILE_HEADER.size))
+
+    def _write(self, path, offset, insts):
+        fd, tempPath = tempfile.mkstemp(suffix = ".tmp", dir = self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(_FILE_HEADER.pack(_FILE_MAGIC, offset, len(insts)))
+                f.write(insts.view("B") if len(insts) else b"")
+            os.replace(tempPath, path)
+        except:
+            os.remove(tempPath)
+            raise
+
+    def decomposeArray(self, offset, code, type = Decode32Bits, features = 0):
+        """
+        Cached L{distorm3.DecomposeArray}, the arguments and the result are the same,
+        but the array is read-only at the address the code was decoded at.
+
+        @rtype:  numpy.ndarray
+        @raise ValueError: Invalid arguments.
+        """
+        if type not in (Decode16Bits, Decode32Bits, Decode64Bits):
+            raise ValueError("Invalid decode type value: %r" % (type,))
+        offset = offset or 0
+        code = _codeView(code)
+        path = self._path(code, type, features)
+        entry = self._read(path)
+        if entry is None:
+            self.misses += 1
+            insts = DecomposeArray(offset, code, type, features)
+            self._write(path, offset, insts)
+            self.evict()
+            return insts
+
+        self.hits += 1
+        entryOffset, insts = entry
+        if offset == entryOffset:
+            return insts
+        # Copying the structures as opaque records is much faster than field by field.
+        insts = insts.view((self._numpy.void, self._dtype.itemsize)).copy().view(self._dtype)
+        addrs = insts['addr']
+        # The unsigned addresses wrap around like the decoder's.
+        addrs += addrs.dtype.type((offset - entryOffset) & _OffsetMask)
+        return insts
+
+    def _files(self):
+        "Returns the (modification time, size, path) of every cache file."
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(_FILE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            # Another process removed it, or it's mapped on Windows.
+            return False
+
+    def evict(self):
+        "Removes the files that are too old, and then the least recently used ones beyond the size limit."
+        if self.maxBytes is None and self.maxAge is None:
+            return
+        files = sorted(self._files())
+        if self.maxAge is not None:
+            oldest = time.time() - self.maxAge
+            while files and files[0][0] < oldest:
+                self._remove(files.pop(0)[2])
+        if self.maxBytes is not None:
+            total = sum([size for (_, size, _) in files])
+            for (_, size, path) in files:
+                if total <= self.maxBytes:
+                    break
+                if self._remove(path):
+                    total -= size
+
+    @property
+    def size(self):
+        "Total size of the files."
+        return sum([size for (_, size, _) in self._files()])
+
+    def clear(self):
+        "Removes all the files."
+        for (_, _, path) in self._files():
+            self._remove(path)
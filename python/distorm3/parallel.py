@@ -0,0 +1,200 @@
+"""
+Decomposing many independent regions of code in parallel threads.
+
+The native decoder doesn't hold the GIL while it decodes (and the ctypes fallback doesn't either),
+so the decoding itself runs in parallel, only building the Python results is serialized.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from . import DecomposeMany, DecomposeArray, _codeView, MAX_INSTRUCTION_SIZE, Decode32Bits, \
+    DF_RETURN_FC_ONLY, DF_STOP_ON_FLOW_CONTROL, DF_STOP_ON_PRIVILEGED, DF_STOP_ON_UNDECODEABLE, DF_SINGLE_BYTE_STEP
+
+__all__ = ['ParallelDecompose', 'ParallelSweep']
+
+# Every worker gets a few chunks of regions, so a slow chunk doesn't keep the others waiting.
+_CHUNKS_PER_WORKER = 4
+
+def _chunks(regions, chunkSize):
+    return [regions[i : i + chunkSize] for i in range(0, len(regions), chunkSize)]
+
+def ParallelDecompose(regions, workers = None, features = 0, as_array = False, chunk_size = None):
+    """
+    Decomposes many independent regions of code in a pool of threads, see L{distorm3.DecomposeMany}.
+    The regions are split into chunks, each chunk is decomposed by a single native call.
+
+    @type  regions: iterable of tuple( long, str, int )
+    @param regions: The (address, code, dt) of every region.
+
+    @type  workers: int
+    @param workers: Number of threads, the number of CPUs by default.
+
+    @type  features: int
+    @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                     or other features, eg. DF_RETURN_FC_ONLY.
+
+    @type  as_array: bool
+    @param as_array: Return a NumPy structured array of the instructions of all the regions
+        and their offsets, like L{distorm3.DecomposeMany} does.
+        It scales better with the number of threads, as there are no Python objects to create per instruction.
+
+    @type  chunk_size: int
+    @param chunk_size: Number of regions per chunk, by default there are a few chunks per thread.
+
+    @rtype:  list of list of L{distorm3.Instruction}, or tuple( numpy.ndarray, numpy.ndarray )
+    @return: The instructions of every region, in the order of the regions.
+
+    @raise ValueError: Invalid arguments.
+    @raise ImportError: as_array is set and NumPy isn't installed.
+    """
+    regions = list(regions)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 0:
+        raise ValueError("Invalid number of workers: %r" % (workers,))
+    if chunk_size is None:
+        chunk_size = -(-len(regions) // (workers * _CHUNKS_PER_WORKER)) or 1
+    if chunk_size <= 0:
+        raise ValueError("Invalid chunk size: %r" % (chunk_size,))
+
+    chunks = _chunks(regions, chunk_size)
+    if workers == 1 or len(chunks) <= 1:
+        results = [DecomposeMany(chunk, features, as_array) for chunk in chunks]
+    else:
+        with ThreadPoolExecutor(max_workers = min(workers, len(chunks))) as executor:
+            # map yields the results in the order of the chunks, whichever finishes first.
+            results = list(executor.map(lambda chunk: DecomposeMany(chunk, features, as_array), chunks))
+
+    if not as_array:
+        return [insts for chunkInsts in results for insts in chunkInsts]
+
+    import numpy
+    if not results:
+        return DecomposeMany([], features, True)
+    arrays = [a for (a, _) in results]
+    offsets = [numpy.zeros(1, dtype = numpy.intp)]
+    base = 0
+    for (a, chunkOffsets) in results:
+        offsets.append(chunkOffsets[1:] + base)
+        base += len(a)
+    return (numpy.concatenate(arrays), numpy.concatenate(offsets))
+
+# The features that change which instructions a linear sweep returns, the chunks can't be stitched with them.
+_SWEEP_UNSUPPORTED_FEATURES = DF_RETURN_FC_ONLY | DF_STOP_ON_FLOW_CONTROL | DF_STOP_ON_PRIVILEGED | \
+    DF_STOP_ON_UNDECODEABLE | DF_SINGLE_BYTE_STEP
+
+# Chunks are decoded again in steps of this many bytes while resynchronizing, streams usually converge within a few instructions.
+_RESYNC_BATCH_SIZE = 256
+
+def _sweepChunk(numpy, offset, code, dt, features, start, end):
+    """
+    Linearly decomposes the instructions that start in code[start:end], assuming an instruction starts at start.
+    Returns them and their indexes into the code.
+    """
+    # An instruction that starts before end sees all of its bytes, the ones that start after it are dropped.
+    insts = DecomposeArray(offset + start, code[start : end + MAX_INSTRUCTION_SIZE - 1], dt, features)
+    indexes = numpy.empty(len(insts), dtype = numpy.int64)
+    if len(insts):
+        indexes[0] = start
+        numpy.cumsum(insts['size'][:-1], out = indexes[1:])
+        indexes[1:] += start
+    count = numpy.searchsorted(indexes, end)
+    return (insts[:count], indexes[:count])
+
+def _resync(numpy, offset, code, dt, features, start, end, indexes):
+    """
+    Decomposes from start, the real instruction boundary, until it reaches an index of the chunk's instructions
+    (from then on both instruction streams are the same) or the end of the chunk.
+    Returns the instructions decoded until then, and the index where the streams converged (or of the next chunk).
+    """
+    fixed = []
+    while start < end:
+        insts, instsIndexes = _sweepChunk(numpy, offset, code, dt, features, start, min(start + _RESYNC_BATCH_SIZE, end))
+        positions = numpy.searchsorted(indexes, instsIndexes)
+        positions[positions == len(indexes)] = 0
+        converged = numpy.nonzero(indexes[positions] == instsIndexes)[0]
+        if len(converged):
+            fixed.append(insts[:converged[0]])
+            return (fixed, int(instsIndexes[converged[0]]))
+        fixed.append(insts)
+        if len(insts) == 0:
+            break
+        start = int(instsIndexes[-1]) + int(insts['size'][-1])
+    return (fixed, max(start, end))
+
+def ParallelSweep(offset, code, type = Decode32Bits, features = 0, workers = None, chunk_size = None):
+    """
+    Linearly decomposes a single big buffer of code in a pool of threads,
+    the result is identical to that of L{distorm3.DecomposeArray}.
+
+    The code is split into chunks that are decomposed in parallel, each as if an instruction starts at its beginning.
+    Then the chunks are stitched in order: when the previous chunk's last instruction doesn't end exactly
+    where the chunk begins, the chunk is decoded again from there, until the two instruction streams converge
+    on the same instruction boundary (that happens within a few instructions for x86 code).
+
+    @type  offset: long
+    @param offset: Memory address where the code is located.
+
+    @type  code: str, in Py3 any object that supports the buffer protocol
+    @param code: Code to disassemble. It's decoded in-place, without being copied.
+
+    @type  type: int
+    @param type: Disassembly type, one of L{distorm3.Decode16Bits}, L{distorm3.Decode32Bits} or L{distorm3.Decode64Bits}.
+
+    @type  features: int
+    @param features: Decoding features, the stop features, DF_RETURN_FC_ONLY and DF_SINGLE_BYTE_STEP aren't supported.
+
+    @type  workers: int
+    @param workers: Number of threads, the number of CPUs by default.
+
+    @type  chunk_size: int
+    @param chunk_size: Number of bytes per chunk, by default there are a few chunks per thread.
+
+    @rtype:  numpy.ndarray
+    @return: Structured array of the decomposed instructions, see L{distorm3.DecomposeArray}.
+
+    @raise ValueError: Invalid arguments.
+    @raise ImportError: NumPy isn't installed.
+    """
+    import numpy
+
+    if features & _SWEEP_UNSUPPORTED_FEATURES:
+        raise ValueError("Features aren't supported by a parallel sweep: %r" % (features & _SWEEP_UNSUPPORTED_FEATURES,))
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 0:
+        raise ValueError("Invalid number of workers: %r" % (workers,))
+    code = _codeView(code)
+    codeLen = len(code)
+    if chunk_size is None:
+        chunk_size = -(-codeLen // (workers * _CHUNKS_PER_WORKER))
+    # Smaller chunks would spend more time resynchronizing than decoding.
+    chunk_size = max(chunk_size, _RESYNC_BATCH_SIZE)
+    offset = offset or 0
+
+    bounds = [(start, min(start + chunk_size, codeLen)) for start in range(0, codeLen, chunk_size)]
+    sweep = lambda bound: _sweepChunk(numpy, offset, code, type, features, bound[0], bound[1])
+    if workers == 1 or len(bounds) <= 1:
+        chunks = [sweep(bound) for bound in bounds]
+    else:
+        with ThreadPoolExecutor(max_workers = min(workers, len(bounds))) as executor:
+            chunks = list(executor.map(sweep, bounds))
+
+    result = []
+    nextIndex = 0
+    for (start, end), (insts, indexes) in zip(bounds, chunks):
+        if nextIndex != start:
+            # The previous chunk's last instruction crossed into this chunk.
+            fixed, nextIndex = _resync(numpy, offset, code, type, features, nextIndex, end, indexes)
+            result.extend(fixed)
+            first = numpy.searchsorted(indexes, nextIndex)
+            insts, indexes = insts[first:], indexes[first:]
+        result.append(insts)
+        if len(insts):
+            nextIndex = int(indexes[-1]) + int(insts['size'][-1])
+    if not result:
+        return DecomposeArray(offset, b"", type, features)
+    # Concatenating the structures as opaque records is much faster than field by field.
+    dtype = result[0].dtype
+    return numpy.concatenate([insts.view((numpy.void, dtype.itemsize)) for insts in result]).view(dtype)
@@ -0,0 +1,246 @@
+"""
+Decomposing many files in a pool of processes.
+
+The workers map the files themselves and send the decomposed _DInst structures back through shared memory blocks,
+so the only things that are pickled between the processes are the file names and the names of the blocks.
+Elsewhere than on POSIX a block is freed once its creator closes it, before the parent could open it,
+so there the structures are pickled instead.
+The results are NumPy structured arrays, see L{distorm3.DecomposeArray}.
+"""
+
+from multiprocessing import resource_tracker, shared_memory
+import multiprocessing
+import collections
+import gc
+import itertools
+import mmap
+import os
+
+from . import DecomposeArray, _getDInstDtype, Decode16Bits, Decode32Bits, Decode64Bits
+
+__all__ = ['DecomposePool', 'DecomposeFiles']
+
+# A shared memory block outlives the worker's handle to it only on POSIX, where it's unlinked explicitly.
+_SHARED_MEMORY = os.name == "posix"
+
+def _fileTask(f, dt, features):
+    "Returns the (path, address, dt, features) task of a file entry, which is a path or a (path, address) tuple."
+    if isinstance(f, tuple):
+        path, address = f
+    else:
+        path, address = f, 0
+    return (path, address, dt, features)
+
+def _decomposeFile(task):
+    """
+    Runs in a worker process, decomposes a whole file into a new shared memory block.
+    Returns the path, the name of the block (None if there are no instructions) and the number of instructions.
+    Without shared memory (see _SHARED_MEMORY) the bytes of the instructions are returned instead of a block name.
+    """
+    path, address, dt, features = task
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            insts = DecomposeArray(address, b"", dt, features)
+        else:
+            with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as code:
+                insts = DecomposeArray(address, code, dt, features)
+    if len(insts) == 0:
+        return (path, None, 0)
+    if not _SHARED_MEMORY:
+        return (path, insts.tobytes(), len(insts))
+
+    shm = shared_memory.SharedMemory(create = True, size = insts.nbytes)
+    try:
+        shm.buf[:insts.nbytes] = insts.view("B")
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    # The parent process unlinks the block once it took the instructions.
+    shm.close()
+    return (path, shm.name, len(insts))
+
+def _freeBlocks(results):
+    "Frees the shared memory blocks of results that aren't taken."
+    for path, block, count in results:
+        if block is not None and not isinstance(block, bytes):
+            shm = shared_memory.SharedMemory(name = block)
+            shm.close()
+            shm.unlink()
+
+def _decomposeFiles(tasks):
+    "Runs in a worker process, decomposes a chunk of files. If one of them fails, the blocks of the others are freed."
+    results = []
+    try:
+        for task in tasks:
+            results.append(_decomposeFile(task))
+    except:
+        _freeBlocks(results)
+        raise
+    return results
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+def _takeResult(numpy, dtype, result):
+    "Copies the instructions out of the shared memory block of a worker's result (or its bytes), and frees the block."
+    path, block, count = result
+    if block is None:
+        return (path, numpy.empty(0, dtype = dtype))
+    if isinstance(block, bytes):
+        return (path, numpy.frombuffer(block, dtype = dtype, count = count).copy())
+    shm = shared_memory.SharedMemory(name = block)
+    try:
+        insts = numpy.frombuffer(shm.buf, dtype = dtype, count = count).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+    return (path, insts)
+
+def _dropResults(chunks, timeout = None):
+    """
+    Takes the chunks of results that are left in an imap iterator and frees their blocks, the chunks that failed are skipped.
+    With a timeout it stops at the first chunk that isn't ready by then.
+    """
+    while True:
+        try:
+            results = chunks.next(timeout)
+        except (StopIteration, multiprocessing.TimeoutError):
+            return
+        except Exception:
+            # A chunk that failed has no blocks left, see _decomposeFiles.
+            continue
+        _freeBlocks(results)
+
+def _warmUp():
+    "Decodes a little code in every mode, so the library, NumPy and the tables are loaded before forking."
+    import numpy
+    _getDInstDtype(numpy)
+    for dt in (Decode16Bits, Decode32Bits, Decode64Bits):
+        DecomposeArray(0, b"\x48\x8b\x05\x78\x56\x34\x12\xc5\xf9\x6f\xc1\xf3\x0f\xb8\xc0\x90", dt)
+
+class DecomposePool (object):
+    """
+    A pool of processes that decompose files.
+
+    In prefork mode the decoder is warmed up in the parent process and its objects are frozen (see gc.freeze)
+    right before the workers are forked, so they start ready and share the parent's memory pages copy-on-write,
+    without the garbage collector touching (and copying) them. It's only supported where fork is.
+    """
+
+    def __init__(self, processes = None, dt = Decode32Bits, features = 0, prefork = False):
+        """
+        @type  processes: int
+        @param processes: Number of worker processes, the number of CPUs by default.
+
+        @type  dt: int
+        @param dt: Disassembly type, one of L{distorm3.Decode16Bits}, L{distorm3.Decode32Bits} or L{distorm3.Decode64Bits}.
+
+        @type  features: int
+        @param features: A flow control stopping criterion, eg. DF_STOP_ON_CALL.
+                         or other features, eg. DF_RETURN_FC_ONLY.
+
+        @type  prefork: bool
+        @param prefork: Fork warmed up workers, see above.
+
+        @raise ValueError: Invalid arguments, or prefork isn't supported on this platform.
+        @raise ImportError: NumPy isn't installed.
+        """
+        import numpy
+        if dt not in (Decode16Bits, Decode32Bits, Decode64Bits):
+            raise ValueError("Invalid decode type value: %r" % (dt,))
+        self.dt = dt
+        self.features = features
+        self._numpy = numpy
+        self._dtype = _getDInstDtype(numpy)
+        # The imap iterators of the iterations that are in progress, see terminate.
+        self._pending = set()
+        self._running = True
+        # The workers have to register their blocks with the parent's resource tracker, which unregisters them once
+        # they're unlinked. Otherwise every forked worker starts a tracker of its own that reports them as leaked.
+        # The tracker only exists on POSIX, elsewhere there are no blocks.
+        if _SHARED_MEMORY:
+            resource_tracker.ensure_running()
+
+        if not prefork:
+            self._pool = multiprocessing.Pool(processes)
+            return
+        context = multiprocessing.get_context("fork")
+        _warmUp()
+        gc.freeze()
+        try:
+            self._pool = context.Pool(processes)
+        finally:
+            gc.unfreeze()
+
+    def decompose_files(self, files, chunksize = 1):
+        """
+        Decomposes the files in the worker processes.
+
+        @type  files: iterable of str, or of tuple( str, long )
+        @param files: Paths of the files, or (path, address) tuples where address is the memory address of the file's code.
+
+        @type  chunksize: int
+        @param chunksize: Number of files that are sent to a worker at once.
+
+        @rtype:  generator of tuple( str, numpy.ndarray )
+        @return: The path and the instructions of every file, in the order of the files.
+            If a file fails or the iteration stops early, the rest of the files are still decomposed
+            (all the tasks are sent to the workers at once), and their results are dropped.
+        """
+        tasks = (_fileTask(f, self.dt, self.features) for f in files)
+        # The files are chunked here rather than by imap, so every chunk of results can be freed on its own.
+        chunks = self._pool.imap(_decomposeFiles, _chunks(tasks, chunksize))
+        self._pending.add(chunks)
+        results = collections.deque()
+        try:
+            for chunk in chunks:
+                results.extend(chunk)
+                while results:
+                    yield _takeResult(self._numpy, self._dtype, results.popleft())
+        finally:
+            # The results that aren't taken would keep their blocks until the interpreter exits.
+            self._pending.discard(chunks)
+            _freeBlocks(results)
+            _dropResults(chunks, None if self._running else 0)
+
+    def close(self):
+        "Waits for the workers to finish and stops them."
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        "Stops the workers immediately."
+        self._pool.terminate()
+        self._pool.join()
+        self._running = False
+        # Only the results that the workers already sent are left to free, the other tasks died with them.
+        for chunks in list(self._pending):
+            self._pending.discard(chunks)
+            _dropResults(chunks, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.terminate()
+
+def DecomposeFiles(files, dt = Decode32Bits, features = 0, processes = None, prefork = False):
+    """
+    Decomposes the files in a new L{DecomposePool}.
+
+    @type  files: iterable of str, or of tuple( str, long )
+    @param files: Paths of the files, or (path, address) tuples.
+
+    @rtype:  list of tuple( str, numpy.ndarray )
+    @return: The path and the instructions of every file, in the order of the files.
+
+    @raise ValueError: Invalid arguments.
+    @raise ImportError: NumPy isn't installed.
+    """
+    with DecomposePool(processes, dt, features, prefork) as pool:
+        return list(pool.decompose_files(files))
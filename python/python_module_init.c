@@ -1,28 +1,1377 @@
+/*
+python_module_init.c
+
+diStorm3 - Powerful disassembler for X86/AMD64
+http://ragestorm.net/distorm/
+distorm at gmail dot com
+Copyright (C) 2003-2021 Gil Dabah
+This library is licensed under the BSD license. See the file COPYING.
+*/
+
+/*
+ * The _distorm3 extension module.
+ * Besides being the shared object that the ctypes binding loads, it exposes native entry points
+ * that call the decoder directly and build the Python results in C, skipping the ctypes marshalling.
+ * The distorm3 package falls back to ctypes when these entry points aren't available.
+ */
+
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
+#include "config.h"
+#include "decoder.h"
+#include "x86defs.h"
+
+/* The text formatting function is exported by distorm.c, but isn't declared for DISTORM_DYNAMIC builds. */
+#ifdef SUPPORT_64BIT_OFFSET
+	void distorm_format64(const _CodeInfo* ci, const _DInst* di, _DecodedInst* result);
+	#define distorm_format distorm_format64
+#else
+	void distorm_format32(const _CodeInfo* ci, const _DInst* di, _DecodedInst* result);
+	#define distorm_format distorm_format32
+#endif
+
 #if PY_MAJOR_VERSION == 2
 PyMODINIT_FUNC init_distorm3(void)
 {
     (void)Py_InitModule("_distorm3", NULL);
 }
 #else
+
+/* Use the vectorcall (fastcall) convention where it's available, otherwise unpack the args tuple ourselves. */
+#ifdef METH_FASTCALL
+#define NATIVE_FUNC(name) \
+	static PyObject* name(PyObject* self, PyObject* const* args, Py_ssize_t nargs)
+#define NATIVE_METHOD(name, doc) { #name, (PyCFunction)(void(*)(void))native_##name, METH_FASTCALL, doc }
+#else
+#define NATIVE_FUNC(name) \
+	static PyObject* name##_fast(PyObject* self, PyObject** args, Py_ssize_t nargs); \
+	static PyObject* name(PyObject* self, PyObject* tuple) \
+	{ \
+		return name##_fast(self, &PyTuple_GET_ITEM(tuple, 0), PyTuple_GET_SIZE(tuple)); \
+	} \
+	static PyObject* name##_fast(PyObject* self, PyObject** args, Py_ssize_t nargs)
+#define NATIVE_METHOD(name, doc) { #name, (PyCFunction)native_##name, METH_VARARGS, doc }
+#endif
+
+/*
+ * The state of the module, every (sub)interpreter that imports it has its own.
+ * Nothing else is shared between calls, so they're safe to run concurrently without the GIL as well.
+ */
+typedef struct {
+	/* The record type of a decomposed instruction, it mirrors the _DInst structure. */
+	PyTypeObject* DInstType;
+	/* Shared (type, index, size) tuple of an unused operand. */
+	PyObject* EmptyOperand;
+} ModuleState;
+
+#define get_state(module) ((ModuleState*)PyModule_GetState(module))
+
+static PyStructSequence_Field dinst_fields[] = {
+	{ "imm", "Immediate value, the raw 64 bits of the _Value union" },
+	{ "disp", "Displacement, its size is dispSize" },
+	{ "addr", "Virtual address of first byte of instruction" },
+	{ "flags", "General flags of instruction, FLAG_NOT_DECODABLE if invalid" },
+	{ "unusedPrefixesMask", "Unused prefixes mask" },
+	{ "usedRegistersMask", "Mask of registers that were used in the operands" },
+	{ "opcode", "ID of opcode in the global opcode table" },
+	{ "ops", "Tuple of (type, index, size) operands" },
+	{ "opsNo", "Number of valid ops entries" },
+	{ "size", "Size of the whole instruction in bytes" },
+	{ "segment", "Segment information of memory indirection" },
+	{ "base", "Base global register index" },
+	{ "scale", "Scale size" },
+	{ "dispSize", "Size of the displacement" },
+	{ "meta", "Instruction set class and flow control flags" },
+	{ "modifiedFlagsMask", "CPU modified (output) flags by instruction" },
+	{ "testedFlagsMask", "CPU tested (input) flags by instruction" },
+	{ "undefinedFlagsMask", "CPU undefined flags by instruction" },
+	{ NULL, NULL }
+};
+
+static PyStructSequence_Desc dinst_desc = {
+	"_distorm3.DInst",
+	"A decomposed instruction, mirrors the _DInst structure.",
+	dinst_fields,
+	18
+};
+
+/* Returns a new (a, b, c) tuple, stealing the references. */
+static PyObject* tuple3(PyObject* a, PyObject* b, PyObject* c)
+{
+	PyObject* t;
+	if ((a == NULL) || (b == NULL) || (c == NULL) || ((t = PyTuple_New(3)) == NULL)) {
+		Py_XDECREF(a);
+		Py_XDECREF(b);
+		Py_XDECREF(c);
+		return NULL;
+	}
+	PyTuple_SET_ITEM(t, 0, a);
+	PyTuple_SET_ITEM(t, 1, b);
+	PyTuple_SET_ITEM(t, 2, c);
+	return t;
+}
+
+static PyObject* operand_to_tuple(ModuleState* st, const _Operand* op)
+{
+	if ((op->type == O_NONE) && (op->index == 0) && (op->size == 0)) {
+		Py_INCREF(st->EmptyOperand);
+		return st->EmptyOperand;
+	}
+	/* Cheaper than Py_BuildValue, it's called for every operand. The small ints are cached by Python anyway. */
+	return tuple3(PyLong_FromLong(op->type), PyLong_FromLong(op->index), PyLong_FromLong(op->size));
+}
+
+static PyObject* dinst_to_record(ModuleState* st, const _DInst* di)
+{
+	PyObject* rec;
+	PyObject* ops;
+	PyObject* o;
+	unsigned int i;
+
+	rec = PyStructSequence_New(st->DInstType);
+	if (rec == NULL) return NULL;
+
+	ops = PyTuple_New(OPERANDS_NO);
+	if (ops == NULL) goto error;
+	PyStructSequence_SET_ITEM(rec, 7, ops);
+	for (i = 0; i < OPERANDS_NO; i++) {
+		if ((o = operand_to_tuple(st, &di->ops[i])) == NULL) goto error;
+		PyTuple_SET_ITEM(ops, i, o);
+	}
+
+#define SET_FIELD(index, value) \
+	if ((o = (value)) == NULL) goto error; \
+	PyStructSequence_SET_ITEM(rec, index, o);
+
+	SET_FIELD(0, PyLong_FromUnsignedLongLong(di->imm.qword));
+	SET_FIELD(1, PyLong_FromUnsignedLongLong(di->disp));
+	SET_FIELD(2, PyLong_FromUnsignedLongLong(di->addr));
+	SET_FIELD(3, PyLong_FromLong(di->flags));
+	SET_FIELD(4, PyLong_FromLong(di->unusedPrefixesMask));
+	SET_FIELD(5, PyLong_FromUnsignedLong(di->usedRegistersMask));
+	SET_FIELD(6, PyLong_FromLong(di->opcode));
+	SET_FIELD(8, PyLong_FromLong(di->opsNo));
+	SET_FIELD(9, PyLong_FromLong(di->size));
+	SET_FIELD(10, PyLong_FromLong(di->segment));
+	SET_FIELD(11, PyLong_FromLong(di->base));
+	SET_FIELD(12, PyLong_FromLong(di->scale));
+	SET_FIELD(13, PyLong_FromLong(di->dispSize));
+	SET_FIELD(14, PyLong_FromLong(di->meta));
+	SET_FIELD(15, PyLong_FromLong(di->modifiedFlagsMask));
+	SET_FIELD(16, PyLong_FromLong(di->testedFlagsMask));
+	SET_FIELD(17, PyLong_FromLong(di->undefinedFlagsMask));
+
+#undef SET_FIELD
+
+	return rec;
+
+error:
+	Py_DECREF(rec);
+	return NULL;
+}
+
+/*
+ * Returns a new reference to the sequence as a tuple, or NULL with a TypeError of the message.
+ * Tuples (and so DInst records) are taken as they are, other sequences are copied,
+ * because without the GIL the items of a list could change (and be freed) while they're used.
+ */
+static PyObject* as_tuple(PyObject* seq, const char* message)
+{
+	if (PyTuple_Check(seq)) {
+		Py_INCREF(seq);
+		return seq;
+	}
+	if (!PySequence_Check(seq)) {
+		PyErr_SetString(PyExc_TypeError, message);
+		return NULL;
+	}
+	return PySequence_Tuple(seq);
+}
+
+/*
+ * Fills a _DInst from a record, any sequence with the DInst fields will do.
+ * Returns 0 on success, or -1 with a Python exception set.
+ */
+static int record_to_dinst(PyObject* rec, _DInst* di)
+{
+	PyObject* seq;
+	PyObject* ops = NULL;
+	PyObject** items;
+	unsigned long long v[18];
+	unsigned int i;
+
+	seq = as_tuple(rec, "record must be a DInst");
+	if (seq == NULL) return -1;
+	if (PyTuple_GET_SIZE(seq) != 18) {
+		PyErr_SetString(PyExc_TypeError, "record must be a DInst");
+		goto error;
+	}
+	items = &PyTuple_GET_ITEM(seq, 0);
+	for (i = 0; i < 18; i++) {
+		if (i == 7) continue;
+		v[i] = PyLong_AsUnsignedLongLongMask(items[i]);
+		if (PyErr_Occurred()) goto error;
+	}
+
+	memset(di, 0, sizeof(*di));
+	di->imm.qword = v[0];
+	di->disp = v[1];
+	di->addr = (_OffsetType)v[2];
+	di->flags = (uint16_t)v[3];
+	di->unusedPrefixesMask = (uint16_t)v[4];
+	di->usedRegistersMask = (uint32_t)v[5];
+	di->opcode = (uint16_t)v[6];
+	di->opsNo = (uint8_t)v[8];
+	di->size = (uint8_t)v[9];
+	di->segment = (uint8_t)v[10];
+	di->base = (uint8_t)v[11];
+	di->scale = (uint8_t)v[12];
+	di->dispSize = (uint8_t)v[13];
+	di->meta = (uint16_t)v[14];
+	di->modifiedFlagsMask = (uint16_t)v[15];
+	di->testedFlagsMask = (uint16_t)v[16];
+	di->undefinedFlagsMask = (uint16_t)v[17];
+
+	ops = as_tuple(items[7], "ops must be a sequence of (type, index, size)");
+	if (ops == NULL) goto error;
+	if ((PyTuple_GET_SIZE(ops) > OPERANDS_NO) || (di->opsNo > OPERANDS_NO)) {
+		PyErr_SetString(PyExc_ValueError, "too many operands");
+		goto error;
+	}
+	for (i = 0; i < (unsigned int)PyTuple_GET_SIZE(ops); i++) {
+		unsigned int type, index, size;
+		if (!PyArg_ParseTuple(PyTuple_GET_ITEM(ops, i), "III", &type, &index, &size)) goto error;
+		di->ops[i].type = (uint8_t)type;
+		di->ops[i].index = (uint8_t)index;
+		di->ops[i].size = (uint16_t)size;
+	}
+
+	Py_DECREF(ops);
+	Py_DECREF(seq);
+	return 0;
+
+error:
+	Py_XDECREF(ops);
+	Py_DECREF(seq);
+	return -1;
+}
+
+/* Same setup as distorm_decode does, the text interface needs the full addresses masked by the decoding mode. */
+static void set_text_addr_mask(_CodeInfo* ci)
+{
+	ci->features = DF_USE_ADDR_MASK;
+	if (ci->dt == Decode16Bits) ci->addrMask = 0xffff;
+	else if (ci->dt == Decode32Bits) ci->addrMask = 0xffffffff;
+	else ci->addrMask = (_OffsetType)-1;
+}
+
+/* Returns the "MNEMONIC OPERANDS" text of a formatted instruction, like distorm3.Decode does. */
+static PyObject* decoded_text(const _DecodedInst* di)
+{
+	/* Join them in a local buffer, both strings are bounded by MAX_TEXT_SIZE. */
+	char text[MAX_TEXT_SIZE * 2];
+	Py_ssize_t len = di->mnemonic.length;
+
+	memcpy(text, di->mnemonic.p, len);
+	if (di->operands.length) {
+		text[len++] = ' ';
+		memcpy(&text[len], di->operands.p, di->operands.length);
+		len += di->operands.length;
+	}
+	return PyUnicode_FromStringAndSize(text, len);
+}
+
+/*
+ * Parses the common codeOffset, code, index, dt, features and maxInstructions arguments into a _CodeInfo.
+ * The code can be any object that supports the buffer protocol, it's borrowed (not copied) into view.
+ * A NULL indexObj stands for 0, a NULL featuresObj stands for DF_NONE, a NULL maxObj leaves maxInstructions to the caller.
+ * Returns DECRES_SUCCESS, DECRES_INPUTERR for bad decoding arguments, or DECRES_NONE if a Python exception was set.
+ * Only upon DECRES_SUCCESS the caller has to release the view.
+ */
+static _DecodeResult parse_code_info(PyObject* offsetObj, PyObject* codeObj, PyObject* indexObj, PyObject* dtObj,
+	PyObject* featuresObj, PyObject* maxObj, _CodeInfo* ci, unsigned int* maxInstructions, Py_buffer* view)
+{
+	Py_ssize_t codeLen, index = 0;
+	long dt, features = DF_NONE, maxInsts = 1;
+
+	memset(ci, 0, sizeof(*ci));
+
+	ci->codeOffset = (_OffsetType)PyLong_AsUnsignedLongLongMask(offsetObj);
+	if (PyErr_Occurred()) return DECRES_NONE;
+	if (indexObj != NULL) {
+		index = PyLong_AsSsize_t(indexObj);
+		if ((index == -1) && PyErr_Occurred()) return DECRES_NONE;
+	}
+	dt = PyLong_AsLong(dtObj);
+	if ((dt == -1) && PyErr_Occurred()) return DECRES_NONE;
+	if (featuresObj != NULL) {
+		features = PyLong_AsLong(featuresObj);
+		if ((features == -1) && PyErr_Occurred()) return DECRES_NONE;
+	}
+	if (maxObj != NULL) {
+		maxInsts = PyLong_AsLong(maxObj);
+		if ((maxInsts == -1) && PyErr_Occurred()) return DECRES_NONE;
+	}
+
+	if (PyObject_GetBuffer(codeObj, view, PyBUF_SIMPLE) < 0) return DECRES_NONE;
+	codeLen = view->len;
+
+	/* Same input validation as distorm_decompose does. */
+	if ((index < 0) || (index > codeLen) ||
+		(dt < Decode16Bits) || (dt > Decode64Bits) ||
+		(maxInsts <= 0) ||
+		((features & (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32)) == (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32))) {
+		PyBuffer_Release(view);
+		return DECRES_INPUTERR;
+	}
+
+	codeLen -= index;
+	/* The decoder works with an int length, bigger inputs are continued by the caller from nextOffset. */
+	if (codeLen > INT_MAX) codeLen = INT_MAX;
+
+	ci->code = (const uint8_t*)view->buf + index;
+	ci->codeLen = (int)codeLen;
+	ci->dt = (_DecodeType)dt;
+	ci->features = (unsigned int)features;
+	if (maxObj != NULL) *maxInstructions = (unsigned int)maxInsts;
+	return DECRES_SUCCESS;
+}
+
+/*
+ * Parses an (opcodes, iscMask, fcMask, usedRegistersMask, flags) filter tuple, see distorm3.DecodeFilter.
+ * opcodes is None or a buffer of FILTER_OPCODES_SIZE bytes, which is borrowed into view.
+ * Returns the filter, NULL if filterObj is NULL or None, or NULL with a Python exception set.
+ * The caller has to release the view if view->obj isn't NULL.
+ */
+static const _DecodeFilter* parse_filter(PyObject* filterObj, _DecodeFilter* filter, Py_buffer* view)
+{
+	PyObject* opcodesObj;
+
+	view->obj = NULL;
+	if ((filterObj == NULL) || (filterObj == Py_None)) return NULL;
+	memset(filter, 0, sizeof(*filter));
+	if (!PyTuple_Check(filterObj) ||
+		!PyArg_ParseTuple(filterObj, "OIIIH", &opcodesObj, &filter->iscMask, &filter->fcMask, &filter->usedRegistersMask, &filter->flags)) {
+		PyErr_SetString(PyExc_TypeError, "filter must be an (opcodes, iscMask, fcMask, usedRegistersMask, flags) tuple");
+		return NULL;
+	}
+	if (opcodesObj != Py_None) {
+		if (PyObject_GetBuffer(opcodesObj, view, PyBUF_SIMPLE) < 0) return NULL;
+		if (view->len < FILTER_OPCODES_SIZE) {
+			PyBuffer_Release(view);
+			view->obj = NULL;
+			PyErr_SetString(PyExc_ValueError, "The opcodes bitmap of the filter is too short");
+			return NULL;
+		}
+		filter->opcodes = (const uint8_t*)view->buf;
+	}
+	return filter;
+}
+
+/*
+ * The result array of a decoding call.
+ * It's the caller's scratch buffer when one big enough is passed (see distorm3.Decoder), otherwise it's allocated.
+ */
+typedef struct {
+	void* buf;
+	Py_buffer scratch; /* Valid as long as scratch.obj isn't NULL. */
+} ResultBuffer;
+
+static int result_buffer_get(ResultBuffer* rb, PyObject* scratchObj, size_t size)
+{
+	rb->scratch.obj = NULL;
+	if ((scratchObj != NULL) && (scratchObj != Py_None)) {
+		if (PyObject_GetBuffer(scratchObj, &rb->scratch, PyBUF_WRITABLE) < 0) return -1;
+		if ((size_t)rb->scratch.len >= size) {
+			rb->buf = rb->scratch.buf;
+			return 0;
+		}
+		PyBuffer_Release(&rb->scratch);
+	}
+	rb->buf = PyMem_Malloc(size);
+	if (rb->buf == NULL) {
+		PyErr_NoMemory();
+		return -1;
+	}
+	return 0;
+}
+
+static void result_buffer_release(ResultBuffer* rb)
+{
+	if (rb->scratch.obj != NULL) PyBuffer_Release(&rb->scratch);
+	else PyMem_Free(rb->buf);
+}
+
+NATIVE_FUNC(native_decompose)
+{
+	_CodeInfo ci;
+	Py_buffer view;
+	ResultBuffer rb;
+	_DInst* result;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0, i;
+	PyObject* insts;
+	_DecodeFilter filterData;
+	const _DecodeFilter* filter;
+	Py_buffer opcodes;
+	ModuleState* st = get_state(self);
+
+	if ((nargs < 6) || (nargs > 8)) {
+		PyErr_SetString(PyExc_TypeError, "decompose(codeOffset, code, index, dt, features, maxInstructions[, scratch[, filter]])");
+		return NULL;
+	}
+
+	filter = parse_filter((nargs > 7) ? args[7] : NULL, &filterData, &opcodes);
+	if ((filter == NULL) && PyErr_Occurred()) return NULL;
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], args[5], &ci, &maxInstructions, &view);
+	if (res != DECRES_SUCCESS) {
+		if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+		if (res == DECRES_NONE) return NULL;
+		return Py_BuildValue("(i[]K)", res, (unsigned long long)ci.codeOffset);
+	}
+
+	if (result_buffer_get(&rb, (nargs > 6) ? args[6] : NULL, (size_t)maxInstructions * sizeof(_DInst)) < 0) {
+		if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+		PyBuffer_Release(&view);
+		return NULL;
+	}
+	result = (_DInst*)rb.buf;
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_internal(&ci, FALSE, filter, NULL, result, maxInstructions, &usedInstructionsCount);
+	Py_END_ALLOW_THREADS
+	if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+	PyBuffer_Release(&view);
+
+	insts = PyList_New(usedInstructionsCount);
+	if (insts == NULL) goto error;
+	for (i = 0; i < usedInstructionsCount; i++) {
+		PyObject* rec = dinst_to_record(st, &result[i]);
+		if (rec == NULL) goto error;
+		PyList_SET_ITEM(insts, i, rec);
+	}
+	result_buffer_release(&rb);
+
+	return Py_BuildValue("(iNK)", res, insts, (unsigned long long)ci.nextOffset);
+
+error:
+	Py_XDECREF(insts);
+	result_buffer_release(&rb);
+	return NULL;
+}
+
+NATIVE_FUNC(native_decompose_region)
+{
+	_CodeInfo ci;
+	Py_buffer view;
+	_DInst* result;
+	_DecodeRegion region;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0, i;
+	PyObject* insts;
+	ModuleState* st = get_state(self);
+
+	if (nargs != 7) {
+		PyErr_SetString(PyExc_TypeError, "decompose_region(codeOffset, code, index, dt, features, maxInstructions, endOffset)");
+		return NULL;
+	}
+
+	region.endOffset = (_OffsetType)PyLong_AsUnsignedLongLongMask(args[6]);
+	if (PyErr_Occurred()) return NULL;
+	region.stop = DECSTOP_NONE;
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], args[5], &ci, &maxInstructions, &view);
+	if (res == DECRES_NONE) return NULL;
+	if (res == DECRES_INPUTERR) return Py_BuildValue("(i[]Ki)", res, (unsigned long long)ci.codeOffset, region.stop);
+
+	result = PyMem_New(_DInst, maxInstructions);
+	if (result == NULL) {
+		PyBuffer_Release(&view);
+		return PyErr_NoMemory();
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_internal(&ci, FALSE, NULL, &region, result, maxInstructions, &usedInstructionsCount);
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&view);
+
+	insts = PyList_New(usedInstructionsCount);
+	if (insts == NULL) goto error;
+	for (i = 0; i < usedInstructionsCount; i++) {
+		PyObject* rec = dinst_to_record(st, &result[i]);
+		if (rec == NULL) goto error;
+		PyList_SET_ITEM(insts, i, rec);
+	}
+	PyMem_Free(result);
+
+	return Py_BuildValue("(iNKi)", res, insts, (unsigned long long)ci.nextOffset, region.stop);
+
+error:
+	Py_XDECREF(insts);
+	PyMem_Free(result);
+	return NULL;
+}
+
+NATIVE_FUNC(native_decode)
+{
+	_CodeInfo ci;
+	Py_buffer view;
+	ResultBuffer rb;
+	_DecodedInst* result;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0, i;
+	PyObject* insts;
+
+	(void)self;
+	if ((nargs != 5) && (nargs != 6)) {
+		PyErr_SetString(PyExc_TypeError, "decode(codeOffset, code, index, dt, maxInstructions[, scratch])");
+		return NULL;
+	}
+
+	res = parse_code_info(args[0], args[1], args[2], args[3], NULL, args[4], &ci, &maxInstructions, &view);
+	if (res == DECRES_NONE) return NULL;
+	if (res == DECRES_INPUTERR) return Py_BuildValue("(i[]K)", res, (unsigned long long)ci.codeOffset);
+
+	set_text_addr_mask(&ci);
+
+	if (result_buffer_get(&rb, (nargs > 5) ? args[5] : NULL, (size_t)maxInstructions * sizeof(_DecodedInst)) < 0) {
+		PyBuffer_Release(&view);
+		return NULL;
+	}
+	result = (_DecodedInst*)rb.buf;
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_internal(&ci, TRUE, NULL, NULL, (_DInst*)result, maxInstructions, &usedInstructionsCount);
+	/* distorm_format works in-place, it needs the code for the hex dump. */
+	for (i = 0; i < usedInstructionsCount; i++) {
+		distorm_format(&ci, (_DInst*)&result[i], &result[i]);
+	}
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&view);
+
+	insts = PyList_New(usedInstructionsCount);
+	if (insts == NULL) goto error;
+	for (i = 0; i < usedInstructionsCount; i++) {
+		_DecodedInst* di = &result[i];
+		PyObject* inst = Py_BuildValue("(KINs#)", (unsigned long long)di->offset, di->size, decoded_text(di),
+			di->instructionHex.p, (Py_ssize_t)di->instructionHex.length);
+		if (inst == NULL) goto error;
+		PyList_SET_ITEM(insts, i, inst);
+	}
+	result_buffer_release(&rb);
+
+	return Py_BuildValue("(iNK)", res, insts, (unsigned long long)ci.nextOffset);
+
+error:
+	Py_XDECREF(insts);
+	result_buffer_release(&rb);
+	return NULL;
+}
+
+NATIVE_FUNC(native_decompose_text)
+{
+	_CodeInfo ci, textCi;
+	Py_buffer view;
+	ResultBuffer rb;
+	_DInst* result;
+	_DecodedInst* text = NULL;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0, i;
+	PyObject* insts = NULL;
+	PyObject* texts = NULL;
+	_DecodeFilter filterData;
+	const _DecodeFilter* filter;
+	Py_buffer opcodes;
+	ModuleState* st = get_state(self);
+
+	if ((nargs < 6) || (nargs > 8)) {
+		PyErr_SetString(PyExc_TypeError, "decompose_text(codeOffset, code, index, dt, features, maxInstructions[, scratch[, filter]])");
+		return NULL;
+	}
+
+	filter = parse_filter((nargs > 7) ? args[7] : NULL, &filterData, &opcodes);
+	if ((filter == NULL) && PyErr_Occurred()) return NULL;
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], args[5], &ci, &maxInstructions, &view);
+	if (res != DECRES_SUCCESS) {
+		if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+		if (res == DECRES_NONE) return NULL;
+		return Py_BuildValue("(i[]K[])", res, (unsigned long long)ci.codeOffset);
+	}
+
+	if (result_buffer_get(&rb, (nargs > 6) ? args[6] : NULL, (size_t)maxInstructions * sizeof(_DInst)) < 0) {
+		if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+		PyBuffer_Release(&view);
+		return NULL;
+	}
+	result = (_DInst*)rb.buf;
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_internal(&ci, FALSE, filter, NULL, result, maxInstructions, &usedInstructionsCount);
+	Py_END_ALLOW_THREADS
+	if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+
+	/* The texts are formatted into their own array, so that's done without holding the GIL as well. */
+	text = PyMem_New(_DecodedInst, usedInstructionsCount ? usedInstructionsCount : 1);
+	if (text == NULL) {
+		PyErr_NoMemory();
+		goto error;
+	}
+	/* The text is formatted like distorm_decode does, whatever features were used for decomposing. */
+	textCi = ci;
+	set_text_addr_mask(&textCi);
+	Py_BEGIN_ALLOW_THREADS
+	for (i = 0; i < usedInstructionsCount; i++) {
+		distorm_format(&textCi, &result[i], &text[i]);
+	}
+	Py_END_ALLOW_THREADS
+
+	insts = PyList_New(usedInstructionsCount);
+	if (insts == NULL) goto error;
+	texts = PyList_New(usedInstructionsCount);
+	if (texts == NULL) goto error;
+	for (i = 0; i < usedInstructionsCount; i++) {
+		PyObject* o = dinst_to_record(st, &result[i]);
+		if (o == NULL) goto error;
+		PyList_SET_ITEM(insts, i, o);
+		if ((o = decoded_text(&text[i])) == NULL) goto error;
+		PyList_SET_ITEM(texts, i, o);
+	}
+	PyMem_Free(text);
+	PyBuffer_Release(&view);
+	result_buffer_release(&rb);
+
+	return Py_BuildValue("(iNKN)", res, insts, (unsigned long long)ci.nextOffset, texts);
+
+error:
+	Py_XDECREF(insts);
+	Py_XDECREF(texts);
+	PyMem_Free(text);
+	PyBuffer_Release(&view);
+	result_buffer_release(&rb);
+	return NULL;
+}
+
+NATIVE_FUNC(native_decompose_into)
+{
+	_CodeInfo ci;
+	Py_buffer view, out;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0;
+	Py_ssize_t count;
+	_DecodeFilter filterData;
+	const _DecodeFilter* filter;
+	Py_buffer opcodes;
+
+	(void)self;
+	if ((nargs != 6) && (nargs != 7)) {
+		PyErr_SetString(PyExc_TypeError, "decompose_into(codeOffset, code, index, dt, features, out[, filter])");
+		return NULL;
+	}
+
+	/* The output is any writable buffer, the _DInst structures are written into it directly. */
+	if (PyObject_GetBuffer(args[5], &out, PyBUF_WRITABLE) < 0) return NULL;
+	count = out.len / (Py_ssize_t)sizeof(_DInst);
+	if (count > UINT_MAX) count = UINT_MAX;
+	if (count == 0) {
+		PyBuffer_Release(&out);
+		return Py_BuildValue("(iIK)", DECRES_INPUTERR, 0, (unsigned long long)0);
+	}
+	maxInstructions = (unsigned int)count;
+
+	filter = parse_filter((nargs > 6) ? args[6] : NULL, &filterData, &opcodes);
+	if ((filter == NULL) && PyErr_Occurred()) {
+		PyBuffer_Release(&out);
+		return NULL;
+	}
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], NULL, &ci, &maxInstructions, &view);
+	if (res != DECRES_SUCCESS) {
+		if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+		PyBuffer_Release(&out);
+		if (res == DECRES_NONE) return NULL;
+		return Py_BuildValue("(iIK)", res, 0, (unsigned long long)ci.codeOffset);
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_internal(&ci, FALSE, filter, NULL, (_DInst*)out.buf, maxInstructions, &usedInstructionsCount);
+	Py_END_ALLOW_THREADS
+	if (opcodes.obj != NULL) PyBuffer_Release(&opcodes);
+	PyBuffer_Release(&view);
+	PyBuffer_Release(&out);
+
+	return Py_BuildValue("(iIK)", res, usedInstructionsCount, (unsigned long long)ci.nextOffset);
+}
+
+NATIVE_FUNC(native_lengths_into)
+{
+	_CodeInfo ci;
+	Py_buffer view, out;
+	_DecodeResult res;
+	unsigned int maxInstructions = 0, usedInstructionsCount = 0;
+	Py_ssize_t count;
+
+	(void)self;
+	if (nargs != 6) {
+		PyErr_SetString(PyExc_TypeError, "lengths_into(codeOffset, code, index, dt, features, out)");
+		return NULL;
+	}
+
+	if (PyObject_GetBuffer(args[5], &out, PyBUF_WRITABLE) < 0) return NULL;
+	count = (out.len > UINT_MAX) ? UINT_MAX : out.len;
+	if (count == 0) {
+		PyBuffer_Release(&out);
+		return Py_BuildValue("(iIK)", DECRES_INPUTERR, 0, (unsigned long long)0);
+	}
+	maxInstructions = (unsigned int)count;
+
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], NULL, &ci, &maxInstructions, &view);
+	if (res != DECRES_SUCCESS) {
+		PyBuffer_Release(&out);
+		if (res == DECRES_NONE) return NULL;
+		return Py_BuildValue("(iIK)", res, 0, (unsigned long long)ci.codeOffset);
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	res = decode_lengths(&ci, (uint8_t*)out.buf, maxInstructions, &usedInstructionsCount);
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&view);
+	PyBuffer_Release(&out);
+
+	return Py_BuildValue("(iIK)", res, usedInstructionsCount, (unsigned long long)ci.nextOffset);
+}
+
+/* Number of lengths that native_bitmap_into decodes at a time, they're turned into bits right away. */
+#define BITMAP_LENGTHS_BATCH 4096
+
+NATIVE_FUNC(native_bitmap_into)
+{
+	_CodeInfo ci;
+	Py_buffer view, out;
+	_DecodeResult res;
+	uint8_t lengths[BITMAP_LENGTHS_BATCH];
+	uint8_t* bits;
+	const uint8_t* code;
+	Py_ssize_t codeLen, index = 0, i;
+	unsigned int usedInstructionsCount;
+	int singleByteStep;
+
+	(void)self;
+	if (nargs != 5) {
+		PyErr_SetString(PyExc_TypeError, "bitmap_into(codeOffset, code, dt, features, out)");
+		return NULL;
+	}
+
+	if (PyObject_GetBuffer(args[4], &out, PyBUF_WRITABLE) < 0) return NULL;
+	res = parse_code_info(args[0], args[1], NULL, args[2], args[3], NULL, &ci, NULL, &view);
+	if (res != DECRES_SUCCESS) {
+		PyBuffer_Release(&out);
+		if (res == DECRES_INPUTERR) PyErr_SetString(PyExc_ValueError, "Invalid arguments passed to distorm_lengths()");
+		return NULL;
+	}
+	codeLen = view.len;
+	if (out.len < (codeLen + 7) / 8) {
+		PyBuffer_Release(&view);
+		PyBuffer_Release(&out);
+		PyErr_SetString(PyExc_ValueError, "out must have room for a bit per byte of code");
+		return NULL;
+	}
+
+	bits = (uint8_t*)out.buf;
+	code = ci.code;
+	singleByteStep = (ci.features & DF_SINGLE_BYTE_STEP) != 0;
+	/* Nothing else applies, the whole code is decoded. */
+	ci.features &= DF_SINGLE_BYTE_STEP;
+	Py_BEGIN_ALLOW_THREADS
+	memset(bits, 0, (size_t)out.len);
+	while (index < codeLen) {
+		ci.code = code + index;
+		ci.codeLen = (codeLen - index > INT_MAX) ? INT_MAX : (int)(codeLen - index);
+		ci.codeOffset = (_OffsetType)index;
+		usedInstructionsCount = 0;
+		decode_lengths(&ci, lengths, BITMAP_LENGTHS_BATCH, &usedInstructionsCount);
+		for (i = 0; i < (Py_ssize_t)usedInstructionsCount; i++) {
+			/* A zero length is an undecodable byte, which isn't an instruction. */
+			if (lengths[i]) bits[index >> 3] |= (uint8_t)(1 << (index & 7));
+			index += (singleByteStep || !lengths[i]) ? 1 : lengths[i];
+		}
+		if (usedInstructionsCount == 0) break;
+	}
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&view);
+	PyBuffer_Release(&out);
+	Py_RETURN_NONE;
+}
+
+/* Number of instructions that native_decompose_events decodes at a time, only the stopping ones are kept. */
+#define EVENTS_SCRATCH_SIZE 256
+
+/*
+ * Returns the stop feature (DF_STOP_ON_XXX) that the instruction made decode_internal stop on, or 0.
+ * The checks are in the same order as decode_internal's.
+ */
+static unsigned int stop_reason(unsigned int features, const _DInst* di)
+{
+	unsigned int fc;
+
+	if (di->flags == FLAG_NOT_DECODABLE) return features & DF_STOP_ON_UNDECODEABLE;
+	if ((features & DF_STOP_ON_PRIVILEGED) && FLAG_GET_PRIVILEGED(di->flags)) return DF_STOP_ON_PRIVILEGED;
+	fc = META_GET_FC(di->meta);
+	/* The DF_STOP_ON_XXX flow control features are in the order of the FC_XXX types, from DF_STOP_ON_CALL. */
+	if ((fc == FC_NONE) || (fc > FC_HLT)) return 0;
+	return features & (DF_STOP_ON_CALL << (fc - FC_CALL));
+}
+
+NATIVE_FUNC(native_decompose_events)
+{
+	_CodeInfo ci;
+	Py_buffer view;
+	_DInst* scratch = NULL;
+	_DInst* events = NULL;
+	unsigned int* reasons = NULL;
+	_DecodeResult res = DECRES_SUCCESS;
+	unsigned int maxEvents = 0, eventsCount = 0, usedInstructionsCount, reason, i;
+	_OffsetType delta;
+	PyObject* insts = NULL;
+	PyObject* reasonsList = NULL;
+	PyObject* o;
+	ModuleState* st = get_state(self);
+
+	if (nargs != 6) {
+		PyErr_SetString(PyExc_TypeError, "decompose_events(codeOffset, code, index, dt, features, maxEvents)");
+		return NULL;
+	}
+
+	res = parse_code_info(args[0], args[1], args[2], args[3], args[4], args[5], &ci, &maxEvents, &view);
+	if (res == DECRES_NONE) return NULL;
+	if (res == DECRES_INPUTERR) return Py_BuildValue("(i[]K[])", res, (unsigned long long)ci.codeOffset);
+
+	scratch = PyMem_New(_DInst, EVENTS_SCRATCH_SIZE);
+	events = PyMem_New(_DInst, maxEvents);
+	reasons = PyMem_New(unsigned int, maxEvents);
+	if ((scratch == NULL) || (events == NULL) || (reasons == NULL)) {
+		PyErr_NoMemory();
+		goto error;
+	}
+
+	/*
+	 * decode_internal returns on every stop, with the stopping instruction last, and it's resumed right away.
+	 * The other instructions are only decoded into the scratch array.
+	 */
+	Py_BEGIN_ALLOW_THREADS
+	while ((eventsCount < maxEvents) && (ci.codeLen > 0)) {
+		usedInstructionsCount = 0;
+		res = decode_internal(&ci, FALSE, NULL, NULL, scratch, EVENTS_SCRATCH_SIZE, &usedInstructionsCount);
+		if ((res == DECRES_SUCCESS) && usedInstructionsCount &&
+			((reason = stop_reason(ci.features, &scratch[usedInstructionsCount - 1])) != 0)) {
+			events[eventsCount] = scratch[usedInstructionsCount - 1];
+			reasons[eventsCount++] = reason;
+		}
+
+		delta = ci.nextOffset - ci.codeOffset;
+		if (delta > (_OffsetType)ci.codeLen) break;
+		ci.code += delta;
+		ci.codeLen -= (int)delta;
+		ci.codeOffset = ci.nextOffset;
+		/* DECRES_TRUNCATED leaves the rest of the code to the caller. */
+		if (((res != DECRES_SUCCESS) && (res != DECRES_MEMORYERR)) || (delta == 0)) break;
+	}
+	Py_END_ALLOW_THREADS
+	PyBuffer_Release(&view);
+	view.obj = NULL;
+
+	insts = PyList_New(eventsCount);
+	if (insts == NULL) goto error;
+	reasonsList = PyList_New(eventsCount);
+	if (reasonsList == NULL) goto error;
+	for (i = 0; i < eventsCount; i++) {
+		if ((o = dinst_to_record(st, &events[i])) == NULL) goto error;
+		PyList_SET_ITEM(insts, i, o);
+		if ((o = PyLong_FromUnsignedLong(reasons[i])) == NULL) goto error;
+		PyList_SET_ITEM(reasonsList, i, o);
+	}
+	PyMem_Free(scratch);
+	PyMem_Free(events);
+	PyMem_Free(reasons);
+
+	return Py_BuildValue("(iNKN)", (res == DECRES_MEMORYERR) ? DECRES_SUCCESS : res, insts, (unsigned long long)ci.codeOffset, reasonsList);
+
+error:
+	Py_XDECREF(insts);
+	Py_XDECREF(reasonsList);
+	if (view.obj != NULL) PyBuffer_Release(&view);
+	PyMem_Free(scratch);
+	PyMem_Free(events);
+	PyMem_Free(reasons);
+	return NULL;
+}
+
+/*
+ * Decodes the single instruction at the beginning of code, it's never longer than INST_MAXIMUM_SIZE bytes.
+ * The GIL is kept, releasing it would cost more than decoding a single instruction.
+ * Returns DECRES_SUCCESS if an instruction was decoded into di, DECRES_NONE if a Python exception was set,
+ * or DECRES_MEMORYERR if there was no instruction (no code, or filtered out by DF_RETURN_FC_ONLY).
+ * Unless a Python exception was set, view holds the code (that ci->code points into) and the caller releases it.
+ */
+static _DecodeResult decode_one(PyObject* const* args, PyObject* featuresObj, _CodeInfo* ci, _DInst* di, Py_buffer* view)
+{
+	unsigned int usedInstructionsCount = 0;
+	_DecodeResult res;
+
+	res = parse_code_info(args[0], args[1], NULL, args[2], featuresObj, NULL, ci, NULL, view);
+	if (res == DECRES_NONE) return DECRES_NONE;
+	if (res == DECRES_INPUTERR) {
+		PyErr_SetString(PyExc_ValueError, "Invalid arguments passed to distorm_decompose()");
+		return DECRES_NONE;
+	}
+
+	if (ci->codeLen > INST_MAXIMUM_SIZE) ci->codeLen = INST_MAXIMUM_SIZE;
+	if (ci->codeLen > 0) decode_internal(ci, FALSE, NULL, NULL, di, 1, &usedInstructionsCount);
+
+	return usedInstructionsCount ? DECRES_SUCCESS : DECRES_MEMORYERR;
+}
+
+NATIVE_FUNC(native_decompose_one)
+{
+	_CodeInfo ci;
+	_DInst di;
+	_DecodeResult res;
+	Py_buffer view;
+	ModuleState* st = get_state(self);
+
+	if (nargs != 4) {
+		PyErr_SetString(PyExc_TypeError, "decompose_one(codeOffset, code, dt, features)");
+		return NULL;
+	}
+
+	res = decode_one(args, args[3], &ci, &di, &view);
+	if (res == DECRES_NONE) return NULL;
+	PyBuffer_Release(&view);
+	if (res != DECRES_SUCCESS) Py_RETURN_NONE;
+	return dinst_to_record(st, &di);
+}
+
+NATIVE_FUNC(native_decode_one)
+{
+	_CodeInfo ci;
+	_DInst di;
+	_DecodedInst text;
+	_DecodeResult res;
+	Py_buffer view;
+
+	(void)self;
+	if (nargs != 3) {
+		PyErr_SetString(PyExc_TypeError, "decode_one(codeOffset, code, dt)");
+		return NULL;
+	}
+
+	res = decode_one(args, NULL, &ci, &di, &view);
+	if (res == DECRES_NONE) return NULL;
+	if (res != DECRES_SUCCESS) {
+		PyBuffer_Release(&view);
+		Py_RETURN_NONE;
+	}
+
+	/* The same view of the code is kept for the hex dump, a buffer can't be resized while it's exported. */
+	ci.code = (const uint8_t*)view.buf;
+	set_text_addr_mask(&ci);
+	distorm_format(&ci, &di, &text);
+	PyBuffer_Release(&view);
+
+	return Py_BuildValue("(KINs#)", (unsigned long long)text.offset, text.size, decoded_text(&text),
+		text.instructionHex.p, (Py_ssize_t)text.instructionHex.length);
+}
+
+/*
+ * Decomposes a whole region, appending its instructions to the growing *result array.
+ * The region's code length is given separately, as the _CodeInfo can only hold an int.
+ * It runs without the GIL, so the array is (re)allocated with the raw allocator.
+ * Returns 0 on success, or -1 when out of memory.
+ */
+static int decompose_region(_CodeInfo* ci, Py_ssize_t codeLen, _DInst** result, size_t* count, size_t* capacity)
+{
+	unsigned int usedInstructionsCount;
+	_DecodeResult res;
+	_OffsetType delta;
+
+	while (codeLen > 0) {
+		if (*count == *capacity) {
+			size_t newCapacity = *capacity ? *capacity * 2 : 256;
+			_DInst* newResult = (_DInst*)PyMem_RawRealloc(*result, newCapacity * sizeof(_DInst));
+			if (newResult == NULL) return -1;
+			*result = newResult;
+			*capacity = newCapacity;
+		}
+
+		ci->codeLen = (codeLen > INT_MAX) ? INT_MAX : (int)codeLen;
+		usedInstructionsCount = 0;
+		res = decode_internal(ci, FALSE, NULL, NULL, &(*result)[*count],
+			(*capacity - *count > UINT_MAX) ? UINT_MAX : (unsigned int)(*capacity - *count), &usedInstructionsCount);
+		*count += usedInstructionsCount;
+		/* Only a full result buffer leaves code behind, anything else (end of code, stop flags) ends the region. */
+		if ((res != DECRES_MEMORYERR) || (usedInstructionsCount == 0)) break;
+
+		delta = ci->nextOffset - ci->codeOffset;
+		if ((delta == 0) || ((Py_ssize_t)delta > codeLen)) break;
+		ci->code += delta;
+		ci->codeOffset = ci->nextOffset;
+		codeLen -= (Py_ssize_t)delta;
+	}
+	return 0;
+}
+
+NATIVE_FUNC(native_decompose_many)
+{
+	PyObject* regions;
+	PyObject* out = NULL;
+	PyObject* o;
+	_DInst* result = NULL;
+	size_t* offsets = NULL;
+	size_t count = 0, capacity = 0;
+	Py_ssize_t regionsNo, i;
+	int raw;
+	ModuleState* st = get_state(self);
+
+	if (nargs != 3) {
+		PyErr_SetString(PyExc_TypeError, "decompose_many(regions, features, raw)");
+		return NULL;
+	}
+	raw = PyObject_IsTrue(args[2]);
+	if (raw < 0) return NULL;
+
+	regions = as_tuple(args[0], "regions must be a sequence of (address, code, dt)");
+	if (regions == NULL) return NULL;
+	regionsNo = PyTuple_GET_SIZE(regions);
+	offsets = PyMem_New(size_t, regionsNo + 1);
+	if (offsets == NULL) {
+		PyErr_NoMemory();
+		goto error;
+	}
+
+	for (i = 0; i < regionsNo; i++) {
+		_CodeInfo ci;
+		Py_buffer view;
+		_DecodeResult res;
+		int failed;
+		PyObject* region = PySequence_Tuple(PyTuple_GET_ITEM(regions, i));
+		if (region == NULL) goto error;
+		if (PyTuple_GET_SIZE(region) != 3) {
+			Py_DECREF(region);
+			PyErr_Format(PyExc_ValueError, "region %zd isn't an (address, code, dt) tuple", i);
+			goto error;
+		}
+
+		offsets[i] = count;
+		res = parse_code_info(PyTuple_GET_ITEM(region, 0), PyTuple_GET_ITEM(region, 1), NULL, PyTuple_GET_ITEM(region, 2),
+			args[1], NULL, &ci, NULL, &view);
+		Py_DECREF(region);
+		if (res == DECRES_NONE) goto error;
+		if (res == DECRES_INPUTERR) {
+			PyErr_Format(PyExc_ValueError, "Invalid arguments for region %zd", i);
+			goto error;
+		}
+		Py_BEGIN_ALLOW_THREADS
+		failed = decompose_region(&ci, view.len, &result, &count, &capacity);
+		Py_END_ALLOW_THREADS
+		PyBuffer_Release(&view);
+		if (failed) {
+			PyErr_NoMemory();
+			goto error;
+		}
+	}
+	offsets[regionsNo] = count;
+
+	if (raw) {
+		/* The _DInst array as is, along with the index of the first instruction of every region. */
+		PyObject* offsetsList = PyList_New(regionsNo + 1);
+		if (offsetsList == NULL) goto error;
+		for (i = 0; i <= regionsNo; i++) {
+			if ((o = PyLong_FromSize_t(offsets[i])) == NULL) {
+				Py_DECREF(offsetsList);
+				goto error;
+			}
+			PyList_SET_ITEM(offsetsList, i, o);
+		}
+		out = Py_BuildValue("(NN)", PyByteArray_FromStringAndSize((const char*)result, count * sizeof(_DInst)), offsetsList);
+		if (out == NULL) goto error;
+	}
+	else {
+		out = PyList_New(regionsNo);
+		if (out == NULL) goto error;
+		for (i = 0; i < regionsNo; i++) {
+			size_t j;
+			PyObject* insts = PyList_New(offsets[i + 1] - offsets[i]);
+			if (insts == NULL) goto error;
+			PyList_SET_ITEM(out, i, insts);
+			for (j = offsets[i]; j < offsets[i + 1]; j++) {
+				if ((o = dinst_to_record(st, &result[j])) == NULL) goto error;
+				PyList_SET_ITEM(insts, j - offsets[i], o);
+			}
+		}
+	}
+
+	PyMem_RawFree(result);
+	PyMem_Free(offsets);
+	Py_DECREF(regions);
+	return out;
+
+error:
+	Py_XDECREF(out);
+	PyMem_RawFree(result);
+	PyMem_Free(offsets);
+	Py_DECREF(regions);
+	return NULL;
+}
+
+NATIVE_FUNC(native_decompose_at)
+{
+	_CodeInfo ci;
+	Py_buffer view, addrs, out;
+	_DecodeResult res;
+	const uint64_t* addresses;
+	_DInst* result;
+	Py_ssize_t count, i;
+	unsigned int decoded = 0;
+	_OffsetType codeOffset, index;
+	const uint8_t* code;
+	Py_ssize_t codeLen;
+
+	(void)self;
+	if (nargs != 6) {
+		PyErr_SetString(PyExc_TypeError, "decompose_at(codeOffset, code, dt, features, addresses, out)");
+		return NULL;
+	}
+
+	if (PyObject_GetBuffer(args[4], &addrs, PyBUF_SIMPLE) < 0) return NULL;
+	if (PyObject_GetBuffer(args[5], &out, PyBUF_WRITABLE) < 0) {
+		PyBuffer_Release(&addrs);
+		return NULL;
+	}
+	count = addrs.len / (Py_ssize_t)sizeof(uint64_t);
+	if ((addrs.len % (Py_ssize_t)sizeof(uint64_t)) || (out.len < count * (Py_ssize_t)sizeof(_DInst))) {
+		PyBuffer_Release(&addrs);
+		PyBuffer_Release(&out);
+		PyErr_SetString(PyExc_ValueError, "addresses must be a uint64 array and out must have room for a _DInst per address");
+		return NULL;
+	}
+
+	res = parse_code_info(args[0], args[1], NULL, args[2], args[3], NULL, &ci, NULL, &view);
+	if (res != DECRES_SUCCESS) {
+		PyBuffer_Release(&addrs);
+		PyBuffer_Release(&out);
+		if (res == DECRES_INPUTERR) PyErr_SetString(PyExc_ValueError, "Invalid arguments passed to distorm_decompose()");
+		return NULL;
+	}
+
+	addresses = (const uint64_t*)addrs.buf;
+	result = (_DInst*)out.buf;
+	codeOffset = ci.codeOffset;
+	code = ci.code;
+	codeLen = view.len;
+	Py_BEGIN_ALLOW_THREADS
+	for (i = 0; i < count; i++) {
+		unsigned int usedInstructionsCount = 0;
+
+		/* The addresses are sorted, so a duplicate follows its first occurrence and is copied rather than decoded again. */
+		if ((i > 0) && (addresses[i] == addresses[i - 1])) {
+			result[i] = result[i - 1];
+			continue;
+		}
+
+		/* An address outside of the code, or an instruction filtered out by DF_RETURN_FC_ONLY, gets an empty entry. */
+		index = (_OffsetType)addresses[i] - codeOffset;
+		if (index < (_OffsetType)codeLen) {
+			ci.code = code + index;
+			ci.codeLen = (codeLen - (Py_ssize_t)index > INST_MAXIMUM_SIZE) ? INST_MAXIMUM_SIZE : (int)(codeLen - (Py_ssize_t)index);
+			ci.codeOffset = (_OffsetType)addresses[i];
+			decode_internal(&ci, FALSE, NULL, NULL, &result[i], 1, &usedInstructionsCount);
+		}
+		if (usedInstructionsCount) decoded++;
+		else {
+			memset(&result[i], 0, sizeof(_DInst));
+			result[i].addr = (_OffsetType)addresses[i];
+			result[i].flags = FLAG_NOT_DECODABLE;
+		}
+	}
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&view);
+	PyBuffer_Release(&addrs);
+	PyBuffer_Release(&out);
+	return PyLong_FromUnsignedLong(decoded);
+}
+
+NATIVE_FUNC(native_format)
+{
+	_CodeInfo ci;
+	Py_buffer view;
+	_DInst di;
+	_DecodedInst text;
+	long dt;
+
+	(void)self;
+	if (nargs != 3) {
+		PyErr_SetString(PyExc_TypeError, "format(code, dt, record)");
+		return NULL;
+	}
+
+	dt = PyLong_AsLong(args[1]);
+	if ((dt == -1) && PyErr_Occurred()) return NULL;
+	if ((dt < Decode16Bits) || (dt > Decode64Bits)) {
+		PyErr_SetString(PyExc_ValueError, "Invalid decode type value");
+		return NULL;
+	}
+	if (record_to_dinst(args[2], &di) < 0) return NULL;
+
+	if (PyObject_GetBuffer(args[0], &view, PyBUF_SIMPLE) < 0) return NULL;
+	/* The code is the instruction's bytes, distorm_format reads them for the hex dump. */
+	if (view.len < di.size) {
+		PyBuffer_Release(&view);
+		PyErr_SetString(PyExc_ValueError, "code is shorter than the instruction");
+		return NULL;
+	}
+
+	memset(&ci, 0, sizeof(ci));
+	ci.codeOffset = di.addr;
+	ci.code = (const uint8_t*)view.buf;
+	ci.codeLen = (int)di.size;
+	ci.dt = (_DecodeType)dt;
+	set_text_addr_mask(&ci);
+	distorm_format(&ci, &di, &text);
+	PyBuffer_Release(&view);
+
+	return decoded_text(&text);
+}
+
+static PyMethodDef _distorm3_methods[] = {
+	NATIVE_METHOD(decompose,
+		"decompose(codeOffset, code, index, dt, features, maxInstructions[, scratch[, filter]]) -> (status, [DInst], nextOffset)\n"
+		"Decomposes up to maxInstructions from code[index:], codeOffset is the address of code[index].\n"
+		"code can be any object that supports the buffer protocol, it isn't copied.\n"
+		"scratch is an optional writable buffer for the results array, it's allocated if it's missing (or None) or too small.\n"
+		"filter is an optional (opcodes, iscMask, fcMask, usedRegistersMask, flags) tuple, only the matching instructions are returned."),
+	NATIVE_METHOD(decompose_region,
+		"decompose_region(codeOffset, code, index, dt, features, maxInstructions, endOffset) -> (status, [DInst], nextOffset, stop)\n"
+		"Same as decompose, but the instructions that start at endOffset or after it aren't decoded,\n"
+		"and stop is the reason that the decoding stopped for, one of the DECSTOP_XXX values."),
+	NATIVE_METHOD(decode,
+		"decode(codeOffset, code, index, dt, maxInstructions[, scratch]) -> (status, [(offset, size, text, hex)], nextOffset)\n"
+		"Decodes up to maxInstructions from code[index:] into text, codeOffset is the address of code[index].\n"
+		"code can be any object that supports the buffer protocol, it isn't copied.\n"
+		"scratch is an optional writable buffer for the results array, it's allocated if it's missing or too small."),
+	NATIVE_METHOD(decompose_text,
+		"decompose_text(codeOffset, code, index, dt, features, maxInstructions[, scratch[, filter]]) -> (status, [DInst], nextOffset, [text])\n"
+		"Same as decompose, but also formats the text of each instruction in the same pass."),
+	NATIVE_METHOD(decompose_into,
+		"decompose_into(codeOffset, code, index, dt, features, out[, filter]) -> (status, count, nextOffset)\n"
+		"Same as decompose, but writes the _DInst structures into the writable buffer out,\n"
+		"as many as fit in it, without creating any Python objects for them."),
+	NATIVE_METHOD(lengths_into,
+		"lengths_into(codeOffset, code, index, dt, features, out) -> (status, count, nextOffset)\n"
+		"Same as decompose_into, but writes only the length of every instruction into out, a byte each,\n"
+		"which is zero for an undecodable byte."),
+	NATIVE_METHOD(bitmap_into,
+		"bitmap_into(codeOffset, code, dt, features, out) -> None\n"
+		"Sets a bit in out for every byte of code that an instruction starts at, the bits of a byte are from its least significant.\n"
+		"The instructions are the ones a linear sweep finds, or with DF_SINGLE_BYTE_STEP, the ones at every byte."),
+	NATIVE_METHOD(decompose_events,
+		"decompose_events(codeOffset, code, index, dt, features, maxEvents) -> (status, [DInst], nextOffset, [reason])\n"
+		"Decomposes code[index:] and returns up to maxEvents of the instructions that the stop features (DF_STOP_ON_XXX) stop on,\n"
+		"along with the feature that each one stops on. The decoding goes on after every stop.\n"
+		"nextOffset is where the decoding can be resumed from, it's the end of the code unless maxEvents were returned."),
+	NATIVE_METHOD(decompose_one,
+		"decompose_one(codeOffset, code, dt, features) -> DInst or None\n"
+		"Decomposes the single instruction at the beginning of code, it doesn't look beyond its first 15 bytes."),
+	NATIVE_METHOD(decode_one,
+		"decode_one(codeOffset, code, dt) -> (offset, size, text, hex) or None\n"
+		"Decodes the single instruction at the beginning of code, it doesn't look beyond its first 15 bytes."),
+	NATIVE_METHOD(decompose_many,
+		"decompose_many(regions, features, raw) -> [[DInst]] or (bytearray, [index])\n"
+		"Decomposes every (address, code, dt) region of regions entirely.\n"
+		"Returns a list of the DInst records of every region, or if raw is set,\n"
+		"the _DInst structures of all the regions in one array and the index of the first one of every region (and the total)."),
+	NATIVE_METHOD(decompose_at,
+		"decompose_at(codeOffset, code, dt, features, addresses, out) -> count\n"
+		"Decomposes the single instruction at each address of the sorted uint64 buffer addresses into the _DInst buffer out.\n"
+		"A repeated address is decoded once, an address without an instruction gets a zero sized FLAG_NOT_DECODABLE entry.\n"
+		"Returns how many instructions were decoded."),
+	NATIVE_METHOD(format,
+		"format(code, dt, record) -> text\n"
+		"Formats the text of an already decomposed DInst record, code holds the bytes of the instruction."),
+	{ NULL, NULL, 0, NULL }
+};
+
+static int _distorm3_traverse(PyObject* m, visitproc visit, void* arg)
+{
+    ModuleState* st = get_state(m);
+    Py_VISIT(st->DInstType);
+    Py_VISIT(st->EmptyOperand);
+    return 0;
+}
+
+static int _distorm3_clear(PyObject* m)
+{
+    ModuleState* st = get_state(m);
+    Py_CLEAR(st->DInstType);
+    Py_CLEAR(st->EmptyOperand);
+    return 0;
+}
+
+static void _distorm3_free(void* m)
+{
+    (void)_distorm3_clear((PyObject*)m);
+}
+
+static int _distorm3_exec(PyObject* m)
+{
+    ModuleState* st = get_state(m);
+
+    st->DInstType = PyStructSequence_NewType(&dinst_desc);
+    if (st->DInstType == NULL)
+        return -1;
+    st->EmptyOperand = Py_BuildValue("(iii)", O_NONE, 0, 0);
+    if (st->EmptyOperand == NULL)
+        return -1;
+
+    Py_INCREF(st->DInstType);
+    if (PyModule_AddObject(m, "DInst", (PyObject*)st->DInstType) < 0) {
+        Py_DECREF(st->DInstType);
+        return -1;
+    }
+    if (PyModule_AddIntConstant(m, "OFFSET_SIZE", sizeof(_OffsetType)) < 0)
+        return -1;
+    if (PyModule_AddIntConstant(m, "DINST_SIZE", sizeof(_DInst)) < 0)
+        return -1;
+    if (PyModule_AddIntConstant(m, "DECODEDINST_SIZE", sizeof(_DecodedInst)) < 0)
+        return -1;
+    return 0;
+}
+
+static PyModuleDef_Slot _distorm3_slots[] = {
+    { Py_mod_exec, (void*)_distorm3_exec },
+#ifdef Py_mod_multiple_interpreters
+    { Py_mod_multiple_interpreters, Py_MOD_PER_INTERPRETER_GIL_SUPPORTED },
+#endif
+#ifdef Py_mod_gil
+    /* The decoder is reentrant and the module has no global state, it runs in free-threaded builds as is. */
+    { Py_mod_gil, Py_MOD_GIL_NOT_USED },
+#endif
+    { 0, NULL }
+};
+
 static struct PyModuleDef _distorm3_module = {
     PyModuleDef_HEAD_INIT,
     "_distorm3",
     NULL,
-    -1,
-    NULL,
+    sizeof(ModuleState),
+    _distorm3_methods,
+    _distorm3_slots,
+    _distorm3_traverse,
+    _distorm3_clear,
+    _distorm3_free
 };
 
 PyMODINIT_FUNC PyInit__distorm3(void)
 {
-    PyObject *m;
-
-    m = PyModule_Create(&_distorm3_module);
-    if (m == NULL)
-        return NULL;
-
-    return m;
+    return PyModuleDef_Init(&_distorm3_module);
 }
 #endif
@@ -3,16 +3,24 @@
 # Tests for diStorm3
 #
 
+import asyncio
+import csv
+import io
+import json
 import os
 import random
 import struct
 import subprocess
 import sys
 import tempfile
+import threading
 import unittest
 import ctypes
 
 import distorm3
+import distorm3.aio
+import distorm3.cache
+import distorm3.parallel
 from distorm3._generated import Registers, Mnemonics
 
 # We require YASM assembler to work.
@@ -1911,6 +1919,12 @@ class TestInvalid(unittest.TestCase):
 		# We had a temporary code with a prefix length bug that wouldn't return an instruction.
 		# So make sure we get an instruction where stream ends with last code byte.
 		self.assertEqual(IB32("66af").insts[0].mnemonic, "SCAS")
+	def test_wait_regression(self):
+		# A WAIT that isn't followed by an FPU instruction used to lose the last byte of the stream.
+		insts = IB32("9b909090").insts
+		self.assertEqual(len(insts), 4)
+		self.assertEqual(insts[0].mnemonic, "WAIT")
+		self.assertEqual(insts[3].address, 3)
 
 class TestFeatures(unittest.TestCase):
 	def test_addr16(self):
@@ -2118,6 +2132,1013 @@ class TestAPI(unittest.TestCase):
 		self.assertEqual(s, distorm3.DECRES_SUCCESS)
 		self.assertEqual(count, 0)
 
+def _withoutNative(f, *args):
+	# Runs f with the pure ctypes path.
+	native = distorm3._native
+	distorm3._native = None
+	try:
+		return f(*args)
+	finally:
+		distorm3._native = native
+
+def _instTuple(i):
+	return (i.address, i.size, i.mnemonic, i.flags, [str(o) for o in i.operands], i.registers,
+		i.instructionClass, i.flowControl, bytes(i.instructionBytes), i.segment, i.isSegmentDefault, i.valid)
+
+class TestNative(unittest.TestCase):
+	def test_same_as_ctypes(self):
+		data = bytes(bytearray([random.randint(0, 255) for i in range(1 << 14)]))
+		for dt in [distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits]:
+			for features in [0, distorm3.DF_RETURN_FC_ONLY, distorm3.DF_FILL_EFLAGS, distorm3.DF_SINGLE_BYTE_STEP]:
+				native = [_instTuple(i) for i in distorm3.Decompose(0x1000, data, dt, features)]
+				ctypes = [_instTuple(i) for i in _withoutNative(distorm3.Decompose, 0x1000, data, dt, features)]
+				self.assertEqual(native, ctypes)
+			self.assertEqual(distorm3.Decode(0x1000, data, dt), _withoutNative(distorm3.Decode, 0x1000, data, dt))
+	def test_single_step_batches(self):
+		# Every byte is an instruction start, also across result batches.
+		insts = IB32("90" * 2500, distorm3.DF_SINGLE_BYTE_STEP).insts
+		self.assertEqual(len(insts), 2500)
+		self.assertEqual(insts[-1].address, 2499)
+	@unittest.skipIf(distorm3._native is None, "native module isn't available")
+	def test_records(self):
+		status, insts, nextOffset = distorm3._native.decompose(0x100, b"\x90\xc3\x33\xc0", 1, distorm3.Decode32Bits, 0, 1)
+		self.assertEqual(status, distorm3.DECRES_MEMORYERR)
+		self.assertEqual(len(insts), 1)
+		self.assertEqual(insts[0].addr, 0x100)
+		self.assertEqual(Mnemonics[insts[0].opcode], "RET")
+		self.assertEqual(nextOffset, 0x101)
+		status, insts, nextOffset = distorm3._native.decompose(0, b"\x90", 0, 3, 0, 1)
+		self.assertEqual(status, distorm3.DECRES_INPUTERR)
+	@unittest.skipIf(distorm3._native is None, "native module isn't available")
+	def test_module_state(self):
+		# Every instance of the module has its own state.
+		import importlib.util
+		spec = importlib.util.find_spec("_distorm3")
+		module = importlib.util.module_from_spec(spec)
+		spec.loader.exec_module(module)
+		self.assertFalse(module.DInst is distorm3._native.DInst)
+		insts = module.decompose(0, b"\x90\xc3", 0, distorm3.Decode32Bits, 0, 2)[1]
+		self.assertTrue(type(insts[0]) is module.DInst)
+		self.assertEqual(tuple(insts[1]), tuple(distorm3._native.decompose(0, b"\x90\xc3", 0, distorm3.Decode32Bits, 0, 2)[1][1]))
+
+class TestBuffers(unittest.TestCase):
+	code = b"\x55\x8b\xec\x33\xc0\xe8\x00\x00\x00\x00\xc3"
+	def check_buffer(self, code):
+		expected = [_instTuple(i) for i in distorm3.Decompose(0x1000, self.code, distorm3.Decode32Bits)]
+		self.assertEqual([_instTuple(i) for i in distorm3.Decompose(0x1000, code, distorm3.Decode32Bits)], expected)
+		self.assertEqual([_instTuple(i) for i in _withoutNative(distorm3.Decompose, 0x1000, code, distorm3.Decode32Bits)], expected)
+		expected = distorm3.Decode(0x1000, self.code, distorm3.Decode32Bits)
+		self.assertEqual(distorm3.Decode(0x1000, code, distorm3.Decode32Bits), expected)
+		self.assertEqual(_withoutNative(distorm3.Decode, 0x1000, code, distorm3.Decode32Bits), expected)
+	def test_bytearray(self):
+		self.check_buffer(bytearray(self.code))
+	def test_memoryview(self):
+		self.check_buffer(memoryview(b"\xcc" + self.code)[1:])
+	def test_array(self):
+		import array
+		self.check_buffer(array.array("B", self.code))
+	def test_mmap(self):
+		import mmap
+		m = mmap.mmap(-1, len(self.code))
+		m.write(self.code)
+		self.check_buffer(m)
+	def test_numpy(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		self.check_buffer(numpy.frombuffer(self.code, dtype=numpy.uint8))
+	def test_instruction_bytes_view(self):
+		code = bytearray(self.code)
+		inst = distorm3.Decompose(0x1000, code, distorm3.Decode32Bits)[1]
+		self.assertTrue(isinstance(inst.instructionBytes, memoryview))
+		self.assertEqual(inst.instructionBytes.tobytes(), b"\x8b\xec")
+		# It's a view, not a copy.
+		code[1] = 0x89
+		self.assertEqual(bytes(inst.instructionBytes), b"\x89\xec")
+
+class TestLazyInstruction(unittest.TestCase):
+	def test_cached_attributes(self):
+		# mov eax, [ebx+ecx*4+0x10]
+		inst = distorm3.Decompose(0x1000, b"\x8b\x44\x8b\x10", distorm3.Decode32Bits)[0]
+		self.assertTrue(inst.operands is inst.operands)
+		self.assertTrue(inst.flags is inst.flags)
+		self.assertTrue(inst.registers is inst.registers)
+		self.assertEqual(inst.mnemonic, "MOV")
+		self.assertEqual(inst.operands[1].scale, 4)
+		self.assertEqual(inst.operands[1].disp, 0x10)
+		self.assertEqual(inst.instructionClass, "ISC_INTEGER")
+		self.assertFalse(hasattr(inst, "__dict__"))
+		self.assertFalse(hasattr(inst.operands[0], "__dict__"))
+	def test_signed_imm(self):
+		# push -1
+		inst = distorm3.Decompose(0, b"\x6a\xff", distorm3.Decode32Bits)[0]
+		self.assertTrue("FLAG_IMM_SIGNED" in inst.flags)
+		self.assertEqual(inst.operands[0].value, -1)
+	def test_invalid(self):
+		inst = distorm3.Decompose(0, b"\xd6", distorm3.Decode64Bits)[0]
+		self.assertFalse(inst.valid)
+		self.assertEqual(inst.mnemonic, "DB 0xd6")
+		self.assertEqual(inst.flags, ["FLAG_NOT_DECODABLE"])
+		self.assertEqual(inst.operands, [])
+		self.assertEqual(inst.meta, 0)
+		self.assertEqual(inst.instructionClass, "ISC_UNKNOWN")
+		self.assertEqual(inst.flowControl, "FC_NONE")
+		self.assertFalse(inst.privileged)
+	def test_pickle(self):
+		import pickle
+		inst = distorm3.Decompose(0x1000, bytearray(b"\xf4"), distorm3.Decode64Bits)[0]
+		copy = pickle.loads(pickle.dumps(inst))
+		self.assertEqual(_instTuple(copy), _instTuple(inst))
+		self.assertEqual(copy.instructionBytes, b"\xf4")
+		self.assertTrue(copy.privileged)
+
+class TestText(unittest.TestCase):
+	def setUp(self):
+		self.data = bytes(bytearray([random.randint(0, 255) for i in range(1 << 12)]))
+	def check_text(self, dt, offset):
+		expected = [text for (_, _, text, _) in distorm3.Decode(offset, self.data, dt)]
+		self.assertEqual([str(i) for i in distorm3.Decompose(offset, self.data, dt)], expected)
+		self.assertEqual([str(i) for i in distorm3.Decompose(offset, self.data, dt, with_text = True)], expected)
+		self.assertEqual([str(i) for i in _withoutNative(distorm3.Decompose, offset, self.data, dt)], expected)
+		self.assertEqual([str(i) for i in _withoutNative(distorm3.Decompose, offset, self.data, dt, 0, True)], expected)
+	def test_text16(self):
+		self.check_text(distorm3.Decode16Bits, 0xff00)
+	def test_text32(self):
+		self.check_text(distorm3.Decode32Bits, 0x401000)
+	def test_text64(self):
+		self.check_text(distorm3.Decode64Bits, 0x7fff00001000)
+	def test_invalid(self):
+		inst = distorm3.Decompose(0, b"\xd6", distorm3.Decode64Bits, with_text = True)[0]
+		self.assertEqual(str(inst), "DB 0xd6")
+		self.assertEqual(str(distorm3.Decompose(0, b"\xd6", distorm3.Decode64Bits)[0]), "DB 0xd6")
+	def test_address_wrap(self):
+		insts = distorm3.Decompose(0xfffffffffffffffe, b"\x90\x90\xeb\xfc", distorm3.Decode64Bits)
+		self.assertEqual([bytes(i.instructionBytes) for i in insts], [b"\x90", b"\x90", b"\xeb\xfc"])
+		self.assertEqual(str(insts[2]), "JMP 0xfffffffffffffffe")
+
+class TestArray(unittest.TestCase):
+	def setUp(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		self.data = bytes(bytearray([random.randint(0, 255) for i in range(1 << 14)]))
+	def check_same(self, a, insts):
+		self.assertEqual(len(a), len(insts))
+		for r, i in zip(a, insts):
+			self.assertEqual(int(r["addr"]), i.address)
+			self.assertEqual(int(r["size"]), i.size)
+			self.assertEqual(int(r["opcode"]), i.opcode)
+			self.assertEqual(int(r["flags"]), i.rawFlags)
+			self.assertEqual(int(r["usedRegistersMask"]), i.usedRegistersMask)
+			self.assertEqual(tuple(tuple(int(x) for x in op) for op in r["ops"]), tuple(i._di.ops))
+	def test_same_as_decompose(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			for features in (0, distorm3.DF_SINGLE_BYTE_STEP, distorm3.DF_RETURN_FC_ONLY):
+				self.check_same(distorm3.DecomposeArray(0x1000, self.data, dt, features), distorm3.Decompose(0x1000, self.data, dt, features))
+	def test_ctypes(self):
+		self.check_same(_withoutNative(distorm3.DecomposeArray, 0x1000, self.data, distorm3.Decode64Bits),
+			distorm3.Decompose(0x1000, self.data, distorm3.Decode64Bits))
+	def test_growth(self):
+		# Every byte is an instruction, more than the initial estimate.
+		a = distorm3.DecomposeArray(0, b"\x90" * 5000, distorm3.Decode32Bits)
+		self.assertEqual(len(a), 5000)
+		self.assertEqual(list(a["addr"][:3]), [0, 1, 2])
+		# With DF_RETURN_FC_ONLY the array starts small, and grows as well.
+		a = distorm3.DecomposeArray(0, b"\xc3\x90" * 5000, distorm3.Decode32Bits, distorm3.DF_RETURN_FC_ONLY)
+		self.assertEqual(list(a["addr"]), list(range(0, 10000, 2)))
+	def test_query(self):
+		import numpy
+		# call rel32; nop; call rax; ret
+		a = distorm3.DecomposeArray(0x1000, b"\xe8\x00\x00\x00\x00\x90\xff\xd0\xc3", distorm3.Decode64Bits)
+		callOpcode = [k for (k, v) in distorm3.Mnemonics.items() if v == "CALL"][0]
+		calls = a[(a["opcode"] == callOpcode) & (a["ops"]["type"][:, 0] == distorm3.O_PC)]
+		self.assertEqual(list(calls["addr"]), [0x1000])
+		self.assertEqual(numpy.bincount(a["size"]).tolist(), [0, 2, 1, 0, 0, 1])
+	def test_empty(self):
+		self.assertEqual(len(distorm3.DecomposeArray(0, b"", distorm3.Decode32Bits)), 0)
+
+class TestDecoder(unittest.TestCase):
+	def setUp(self):
+		self.data = bytes(bytearray([random.randint(0, 255) for i in range(1 << 12)]))
+	def check_same(self, decoder):
+		self.assertEqual(decoder.decode(0x1000, self.data), distorm3.Decode(0x1000, self.data, decoder.dt))
+		expected = [_instTuple(i) for i in distorm3.Decompose(0x1000, self.data, decoder.dt, decoder.features)]
+		self.assertEqual([_instTuple(i) for i in decoder.decompose(0x1000, self.data)], expected)
+		self.assertEqual([_instTuple(i) for i in decoder.decomposeGenerator(0x1000, self.data, with_text = True)], expected)
+	def test_same_as_functions(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			decoder = distorm3.Decoder(dt)
+			# Reuses the same buffers over and over.
+			for i in range(3):
+				self.check_same(decoder)
+	def test_small_batches(self):
+		self.check_same(distorm3.Decoder(distorm3.Decode64Bits, distorm3.DF_RETURN_FC_ONLY, batch_size = 7))
+		self.check_same(distorm3.Decoder(distorm3.Decode32Bits, batch_size = 1))
+	def test_ctypes(self):
+		_withoutNative(self.check_same, distorm3.Decoder(distorm3.Decode64Bits, batch_size = 10))
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.Decoder, 3)
+		self.assertRaises(ValueError, distorm3.Decoder, distorm3.Decode32Bits, 0, 0)
+	def test_local(self):
+		import threading
+		decoder = distorm3.Decoder.local(distorm3.Decode64Bits)
+		self.assertTrue(decoder is distorm3.Decoder.local(distorm3.Decode64Bits))
+		self.assertFalse(decoder is distorm3.Decoder.local(distorm3.Decode32Bits))
+		others = []
+		t = threading.Thread(target = lambda: others.append(distorm3.Decoder.local(distorm3.Decode64Bits)))
+		t.start()
+		t.join()
+		self.assertFalse(decoder is others[0])
+
+class TestLimits(unittest.TestCase):
+	def setUp(self):
+		self.data = bytes(bytearray([random.randint(0, 255) for i in range(1 << 12)]))
+	def test_max_instructions(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			insts = distorm3.Decompose(0x1000, self.data, dt)
+			decoded = distorm3.Decode(0x1000, self.data, dt)
+			for n in (0, 1, 3, 16, 17, 100, len(insts), len(insts) + 1):
+				self.assertEqual([_instTuple(i) for i in distorm3.Decompose(0x1000, self.data, dt, max_instructions = n)],
+					[_instTuple(i) for i in insts[:n]])
+				self.assertEqual(distorm3.Decode(0x1000, self.data, dt, max_instructions = n), decoded[:n])
+	def test_end_address(self):
+		insts = distorm3.Decompose(0x1000, self.data, distorm3.Decode64Bits)
+		decoded = distorm3.Decode(0x1000, self.data, distorm3.Decode64Bits)
+		for end in (0, 0x1000, 0x1001, 0x1100, 0x1000 + len(self.data) - 1, 0x10000):
+			expected = [_instTuple(i) for i in insts if i.address < end]
+			got = distorm3.Decompose(0x1000, self.data, distorm3.Decode64Bits, end_address = end)
+			# The last instruction might cross the end address, it's still decoded whole.
+			self.assertEqual([_instTuple(i) for i in got], expected)
+			self.assertEqual(distorm3.Decode(0x1000, self.data, distorm3.Decode64Bits, end_address = end), [i for i in decoded if i[0] < end])
+	def test_both(self):
+		insts = distorm3.Decompose(0, b"\x90" * 100, distorm3.Decode32Bits, max_instructions = 10, end_address = 5)
+		self.assertEqual([i.address for i in insts], [0, 1, 2, 3, 4])
+		decoder = distorm3.Decoder(distorm3.Decode32Bits)
+		self.assertEqual(len(decoder.decompose(0, b"\x90" * 100, max_instructions = 10, end_address = 50)), 10)
+		self.assertEqual(len(decoder.decode(0, b"\x90" * 100, end_address = 50)), 50)
+	def test_batch_growth(self):
+		sizes = list(distorm3._batchSizes(1000, 5000))
+		self.assertEqual(sizes[:3], [16, 32, 64])
+		self.assertEqual(max(sizes), 1000)
+		self.assertEqual(sum(sizes), 5000)
+		self.assertEqual(list(distorm3._batchSizes(1000, 10)), [10])
+	def test_empty_window(self):
+		# A call decodes a window of the code at the most, a window without a returned instruction doesn't end the decoding.
+		code = b"\x00" * 1000 + b"\xc3"
+		limit = distorm3._MAX_CODE_LENGTH
+		distorm3._MAX_CODE_LENGTH = 64
+		try:
+			insts = _withoutNative(distorm3.Decompose, 0, code, distorm3.Decode32Bits, distorm3.DF_RETURN_FC_ONLY)
+		finally:
+			distorm3._MAX_CODE_LENGTH = limit
+		self.assertEqual([(i.address, str(i)) for i in insts], [(1000, "RET")])
+	def test_stop_flag(self):
+		# The stop flag still applies after more instructions than the first batch.
+		code = b"\x90" * 100 + b"\xc3" + b"\x90" * 10
+		self.assertEqual(len(distorm3.Decompose(0, code, distorm3.Decode32Bits, distorm3.DF_STOP_ON_RET)), 101)
+
+class TestOne(unittest.TestCase):
+	def check_one(self, code, dt):
+		expected = distorm3.Decode(0x1000, code[:15], dt)
+		self.assertEqual(distorm3.DecodeOne(0x1000, code, dt), expected[0] if expected else None)
+		self.assertEqual(_withoutNative(distorm3.DecodeOne, 0x1000, code, dt), expected[0] if expected else None)
+		expected = [_instTuple(i) for i in distorm3.Decompose(0x1000, code[:15], dt)][:1]
+		for inst in (distorm3.DecomposeOne(0x1000, code, dt), _withoutNative(distorm3.DecomposeOne, 0x1000, code, dt)):
+			self.assertEqual([_instTuple(inst)] if inst is not None else [], expected)
+	def test_random(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			for i in range(300):
+				self.check_one(bytes(bytearray([random.randint(0, 255) for i in range(random.randint(0, 20))])), dt)
+	def test_only_first_bytes(self):
+		# 16 bytes of prefixes, the instruction can't be longer than 15 bytes.
+		code = b"\x66" * 15 + b"\x90"
+		self.assertEqual(distorm3.DecodeOne(0, code, distorm3.Decode32Bits)[1], 1)
+		inst = distorm3.DecomposeOne(0, bytearray(b"\x48\x8b\x05\x78\x56\x34\x12\x90"), distorm3.Decode64Bits)
+		self.assertEqual(bytes(inst.instructionBytes), b"\x48\x8b\x05\x78\x56\x34\x12")
+		self.assertEqual(str(inst), "MOV RAX, [RIP+0x12345678]")
+	def test_empty(self):
+		self.assertEqual(distorm3.DecodeOne(0, b"", distorm3.Decode32Bits), None)
+		self.assertEqual(distorm3.DecomposeOne(0, b"", distorm3.Decode32Bits), None)
+		self.assertEqual(distorm3.DecomposeOne(0, b"\x90", distorm3.Decode32Bits, distorm3.DF_RETURN_FC_ONLY), None)
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.DecodeOne, 0, b"\x90", 3)
+		self.assertRaises(ValueError, distorm3.DecomposeOne, 0, b"\x90", 3)
+		self.assertRaises(ValueError, _withoutNative, distorm3.DecomposeOne, 0, b"\x90", 3)
+
+class TestMany(unittest.TestCase):
+	def setUp(self):
+		self.regions = []
+		for i in range(200):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(random.randint(0, 64))]))
+			self.regions.append((random.randint(0, 0xffffffff), code, random.choice((distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits))))
+		self.regions.append((0xfffffffffffffffe, b"\x90" * 4, distorm3.Decode64Bits))
+	def expected(self, features):
+		return [[_instTuple(i) for i in distorm3.Decompose(offset, code, dt, features)] for (offset, code, dt) in self.regions]
+	def test_lists(self):
+		for features in (0, distorm3.DF_STOP_ON_RET, distorm3.DF_RETURN_FC_ONLY, distorm3.DF_STOP_ON_UNDECODEABLE):
+			expected = self.expected(features)
+			for insts in (distorm3.DecomposeMany(self.regions, features), _withoutNative(distorm3.DecomposeMany, self.regions, features)):
+				self.assertEqual([[_instTuple(i) for i in r] for r in insts], expected)
+	def test_array(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		for features in (0, distorm3.DF_STOP_ON_RET):
+			expected = self.expected(features)
+			for (a, offsets) in (distorm3.DecomposeMany(self.regions, features, as_array = True),
+					_withoutNative(distorm3.DecomposeMany, self.regions, features, True)):
+				self.assertEqual(len(offsets), len(self.regions) + 1)
+				self.assertEqual(int(offsets[-1]), len(a))
+				for k, r in enumerate(expected):
+					self.assertEqual([int(x) for x in a["addr"][offsets[k]:offsets[k + 1]]], [i[0] for i in r])
+	def test_empty(self):
+		self.assertEqual(distorm3.DecomposeMany([]), [])
+		self.assertEqual(distorm3.DecomposeMany([(0, b"", distorm3.Decode32Bits)]), [[]])
+		self.assertEqual(_withoutNative(distorm3.DecomposeMany, [(0, b"", distorm3.Decode32Bits)]), [[]])
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.DecomposeMany, [(0, b"\x90", 3)])
+		self.assertRaises(ValueError, _withoutNative, distorm3.DecomposeMany, [(0, b"\x90", 3)])
+
+class TestAt(unittest.TestCase):
+	def setUp(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		self.code = bytes(bytearray([random.randint(0, 255) for i in range(1 << 12)]))
+		self.base = 0x400000
+	def check_at(self, addresses, dt, features = 0):
+		expected = []
+		for address in addresses:
+			index = address - self.base
+			inst = distorm3.DecomposeOne(address, self.code[index:] if 0 <= index < len(self.code) else b"", dt, features)
+			expected.append((inst.address, inst.size, inst.opcode, inst.valid) if inst else (address, 0, 0, False))
+		for a in (distorm3.DecomposeAt(self.base, self.code, addresses, dt, features),
+				_withoutNative(distorm3.DecomposeAt, self.base, self.code, addresses, dt, features)):
+			self.assertEqual(len(a), len(addresses))
+			self.assertEqual([(int(r["addr"]), int(r["size"]), int(r["opcode"])) for r in a], [e[:3] for e in expected])
+			for r, e in zip(a, expected):
+				self.assertEqual(int(r["flags"]) == distorm3.FLAG_NOT_DECODABLE, not e[3])
+	def test_random(self):
+		addresses = sorted([random.randint(self.base - 16, self.base + len(self.code) + 16) for i in range(500)])
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			self.check_at(addresses, dt)
+		self.check_at(addresses, distorm3.Decode64Bits, distorm3.DF_RETURN_FC_ONLY)
+	def test_duplicates(self):
+		addresses = [self.base, self.base, self.base + 5, self.base + 5, self.base + 5]
+		self.check_at(addresses, distorm3.Decode32Bits)
+		a = distorm3.DecomposeAt(self.base, self.code, addresses, distorm3.Decode32Bits)
+		self.assertEqual(a[0].tobytes(), a[1].tobytes())
+		self.assertEqual(a[2].tobytes(), a[4].tobytes())
+	def test_end_of_code(self):
+		# The last instruction is cut by the end of the code.
+		a = distorm3.DecomposeAt(0x100, b"\x90\xb8\x01\x02", [0x100, 0x101, 0x104], distorm3.Decode32Bits)
+		self.assertEqual([int(x) for x in a["size"]], [1, 1, 0])
+		self.assertEqual(len(distorm3.DecomposeAt(0, b"", [], distorm3.Decode32Bits)), 0)
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.DecomposeAt, 0, b"\x90", [0], 3)
+		self.assertRaises(ValueError, _withoutNative, distorm3.DecomposeAt, 0, b"\x90", [0], 3)
+
+class TestParallel(unittest.TestCase):
+	def setUp(self):
+		self.regions = []
+		for i in range(100):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(random.randint(0, 300))]))
+			self.regions.append((random.randint(0, 0xffffffff), code, random.choice((distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits))))
+	def test_order(self):
+		expected = [[_instTuple(i) for i in r] for r in distorm3.DecomposeMany(self.regions)]
+		for workers in (1, 3, 8):
+			insts = distorm3.parallel.ParallelDecompose(iter(self.regions), workers = workers, chunk_size = 7)
+			self.assertEqual([[_instTuple(i) for i in r] for r in insts], expected)
+		self.assertEqual(distorm3.parallel.ParallelDecompose([], workers = 4), [])
+	def test_array(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		a, offsets = distorm3.DecomposeMany(self.regions, distorm3.DF_STOP_ON_RET, as_array = True)
+		b, parallelOffsets = distorm3.parallel.ParallelDecompose(self.regions, 4, distorm3.DF_STOP_ON_RET, as_array = True)
+		self.assertEqual(list(offsets), list(parallelOffsets))
+		for name in a.dtype.names:
+			self.assertTrue(numpy.array_equal(a[name], b[name]))
+	def test_threads(self):
+		# The native decoder runs without the GIL, concurrent decoding of the same code has to give the same results.
+		code = bytes(bytearray([random.randint(0, 255) for i in range(1 << 14)]))
+		expected = [_instTuple(i) for i in distorm3.Decompose(0, code, distorm3.Decode64Bits)]
+		results = []
+		def worker():
+			results.append([_instTuple(i) for i in distorm3.Decompose(0, code, distorm3.Decode64Bits)])
+		threads = [threading.Thread(target = worker) for i in range(4)]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		self.assertEqual(results, [expected] * 4)
+	def test_stress(self):
+		# Threads share the code and the regions, and use different entry points at once, while the regions list changes.
+		code = bytes(bytearray([random.randint(0, 255) for i in range(1 << 12)]))
+		regions = list(self.regions)
+		calls = [
+			lambda: [_instTuple(i) for i in distorm3.Decompose(0, code, distorm3.Decode64Bits, with_text = True)],
+			lambda: distorm3.Decode(0, code, distorm3.Decode64Bits),
+			lambda: [str(i) for i in distorm3.Decoder.local(distorm3.Decode64Bits).decompose(0, code)]]
+		expected = [f() for f in calls]
+		errors = []
+		done = []
+		def worker(n):
+			try:
+				for i in range(10):
+					self.assertEqual(calls[n % len(calls)](), expected[n % len(calls)])
+					distorm3.DecomposeMany(regions)
+			except Exception as e:
+				errors.append(e)
+		def mutator():
+			while not done:
+				regions.append(regions.pop(0))
+		threads = [threading.Thread(target = worker, args = (i,)) for i in range(6)]
+		changer = threading.Thread(target = mutator)
+		changer.start()
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+		done.append(True)
+		changer.join()
+		self.assertEqual(errors, [])
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.parallel.ParallelDecompose, self.regions, 0)
+		self.assertRaises(ValueError, distorm3.parallel.ParallelDecompose, [(0, b"\x90", 3)], 2)
+
+class TestSweep(unittest.TestCase):
+	def setUp(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+	def check_sweep(self, offset, code, dt, **kwargs):
+		import numpy
+		expected = distorm3.DecomposeArray(offset, code, dt)
+		a = distorm3.parallel.ParallelSweep(offset, code, dt, **kwargs)
+		self.assertEqual(len(a), len(expected))
+		for name in expected.dtype.names:
+			self.assertTrue(numpy.array_equal(a[name], expected[name]), name)
+	def test_random(self):
+		code = bytes(bytearray([random.randint(0, 255) for i in range(1 << 14)]))
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			for chunkSize in (None, 256, 1000, 1 << 20):
+				self.check_sweep(0x401000, code, dt, workers = 4, chunk_size = chunkSize)
+	def test_prefixes(self):
+		# Long runs of prefixes keep the instruction streams of neighbouring chunks out of sync.
+		code = (b"\x66" * 997 + b"\x90\xf3\x2e\x48\x8b\x00") * 8
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			self.check_sweep(0, code, dt, workers = 3, chunk_size = 300)
+	def test_edges(self):
+		self.check_sweep(0, b"", distorm3.Decode32Bits)
+		self.check_sweep(0xfffffffffffffff0, b"\x90" * 1000, distorm3.Decode64Bits, workers = 2, chunk_size = 256)
+		self.check_sweep(0, b"\x90\xb8\x01", distorm3.Decode32Bits, workers = 2)
+	def test_position_independent(self):
+		# The decoder used to leak the prefixes that an instruction used into the next one,
+		# the address size prefix of the second instruction wasn't marked as unused.
+		a = distorm3.DecomposeArray(0, b"\x8b\x00\x67\x06", distorm3.Decode32Bits)
+		self.assertEqual([int(x) for x in a["unusedPrefixesMask"]], [0, 1])
+	def test_invalid_args(self):
+		self.assertRaises(ValueError, distorm3.parallel.ParallelSweep, 0, b"\x90", distorm3.Decode32Bits, distorm3.DF_STOP_ON_RET)
+		self.assertRaises(ValueError, distorm3.parallel.ParallelSweep, 0, b"\x90", distorm3.Decode32Bits, workers = 0)
+
+class TestPool(unittest.TestCase):
+	def setUp(self):
+		try:
+			import numpy
+			import distorm3.pool
+		except ImportError:
+			self.skipTest("numpy or multiprocessing.shared_memory isn't available")
+		self.files = []
+		for size in (0, 1, 100, 5000, 20000):
+			f = tempfile.NamedTemporaryFile(delete = False)
+			f.write(bytes(bytearray([random.randint(0, 255) for i in range(size)])))
+			f.close()
+			self.files.append(f.name)
+	def tearDown(self):
+		for name in self.files:
+			os.remove(name)
+	def check_files(self, results, address, dt):
+		import numpy
+		self.assertEqual([path for (path, _) in results], self.files)
+		for (path, a) in results:
+			with open(path, "rb") as f:
+				expected = distorm3.DecomposeArray(address, f.read(), dt)
+			self.assertEqual(len(a), len(expected))
+			for name in expected.dtype.names:
+				self.assertTrue(numpy.array_equal(a[name], expected[name]))
+	def test_files(self):
+		import distorm3.pool
+		self.check_files(distorm3.pool.DecomposeFiles(self.files, distorm3.Decode32Bits, processes = 2), 0, distorm3.Decode32Bits)
+		with distorm3.pool.DecomposePool(2, distorm3.Decode64Bits) as pool:
+			results = list(pool.decompose_files([(name, 0x401000) for name in self.files], chunksize = 2))
+		self.check_files(results, 0x401000, distorm3.Decode64Bits)
+	def test_prefork(self):
+		import multiprocessing
+		import distorm3.pool
+		if "fork" not in multiprocessing.get_all_start_methods():
+			self.skipTest("fork isn't supported")
+		self.check_files(distorm3.pool.DecomposeFiles(self.files, distorm3.Decode16Bits, processes = 2, prefork = True), 0, distorm3.Decode16Bits)
+	def test_without_shared_memory(self):
+		# The instructions are pickled where shared memory blocks don't outlive their creator, the forked workers see the flag.
+		import multiprocessing
+		import distorm3.pool
+		if "fork" not in multiprocessing.get_all_start_methods():
+			self.skipTest("fork isn't supported")
+		distorm3.pool._SHARED_MEMORY = False
+		try:
+			results = distorm3.pool.DecomposeFiles(self.files, distorm3.Decode64Bits, processes = 2, prefork = True)
+		finally:
+			distorm3.pool._SHARED_MEMORY = os.name == "posix"
+		self.check_files(results, 0, distorm3.Decode64Bits)
+	def blocks(self):
+		return set([name for name in os.listdir("/dev/shm") if name.startswith("psm_")])
+	def test_abandoned(self):
+		# The blocks of the results that are never taken are freed, after a file fails and after an early break.
+		import distorm3.pool
+		if not os.path.isdir("/dev/shm"):
+			self.skipTest("the shared memory blocks can't be listed")
+		files = self.files * 4
+		before = self.blocks()
+		for chunksize in (1, 3):
+			with distorm3.pool.DecomposePool(2) as pool:
+				self.assertRaises(IOError, list, pool.decompose_files(files[-1:] + [files[0] + ".missing"] + files, chunksize))
+			self.assertEqual(self.blocks() - before, set())
+			with distorm3.pool.DecomposePool(2) as pool:
+				for result in pool.decompose_files(files, chunksize):
+					break
+			self.assertEqual(self.blocks() - before, set())
+		# A pool that's terminated in the middle of an iteration doesn't wait for the rest of the files.
+		with distorm3.pool.DecomposePool(2) as pool:
+			results = pool.decompose_files(files)
+			next(results)
+		results.close()
+	def test_invalid_args(self):
+		import distorm3.pool
+		self.assertRaises(ValueError, distorm3.pool.DecomposePool, 1, 3)
+		self.assertRaises(IOError, distorm3.pool.DecomposeFiles, [self.files[0] + ".missing"], processes = 1)
+
+class TestStream(unittest.TestCase):
+	def chunks(self, code, sizes):
+		index = 0
+		while index < len(code):
+			size = random.choice(sizes)
+			yield code[index : index + size]
+			index += size
+	def check_stream(self, offset, code, dt, features = 0):
+		expected = list(distorm3.DecodeGenerator(offset, code, dt))
+		for sizes in ((1, 2, 3, 17), (14, 15, 16), (4096,)):
+			self.assertEqual(list(distorm3.DecodeStream(offset, self.chunks(code, sizes), dt)), expected)
+		self.assertEqual(list(distorm3.DecodeStream(offset, io.BytesIO(code), dt, chunk_size = 7)), expected)
+		for withText in (False, True):
+			expected = [_instTuple(i) for i in distorm3.DecomposeGenerator(offset, code, dt, features, withText)]
+			for sizes in ((1, 2, 3, 17), (14, 15, 16), (4096,)):
+				insts = distorm3.DecomposeStream(offset, self.chunks(code, sizes), dt, features, withText)
+				self.assertEqual([_instTuple(i) for i in insts], expected)
+	def test_random(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(3000)]))
+			self.check_stream(0x401000, code, dt)
+			self.check_stream(0x401000, code[:700], dt, distorm3.DF_RETURN_FC_ONLY)
+			self.check_stream(0x401000, code[:300], dt, distorm3.DF_SINGLE_BYTE_STEP)
+	def test_prefixes(self):
+		# Instructions with many prefixes are cut by the chunks.
+		code = (b"\x66" * 13 + b"\x90\x48\x8b\x05\x78\x56\x34\x12") * 50
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			self.check_stream(0xfffffffffffffff0, code, dt)
+	def test_stop(self):
+		code = b"\x90" * 100 + b"\xc3" + b"\x90" * 100
+		self.assertEqual(len(list(distorm3.DecomposeStream(0, self.chunks(code, (3,)), distorm3.Decode32Bits, distorm3.DF_STOP_ON_RET))), 101)
+		self.assertEqual(len(list(distorm3.DecomposeStream(0, self.chunks(code, (3,)), distorm3.Decode32Bits, distorm3.DF_RETURN_FC_ONLY))), 1)
+	def test_file(self):
+		code = bytes(bytearray([random.randint(0, 255) for i in range(5000)]))
+		f = tempfile.TemporaryFile()
+		try:
+			f.write(code)
+			f.seek(0)
+			insts = distorm3.DecomposeStream(0, f, distorm3.Decode64Bits, chunk_size = 100)
+			self.assertEqual([_instTuple(i) for i in insts], [_instTuple(i) for i in distorm3.Decompose(0, code, distorm3.Decode64Bits)])
+		finally:
+			f.close()
+	def test_empty(self):
+		self.assertEqual(list(distorm3.DecodeStream(0, [], distorm3.Decode32Bits)), [])
+		self.assertEqual(list(distorm3.DecomposeStream(0, io.BytesIO(b""), distorm3.Decode32Bits)), [])
+		self.assertRaises(ValueError, list, distorm3.DecomposeStream(0, [b"\x90"], 3))
+
+class TestTruncated(unittest.TestCase):
+	def test_truncated(self):
+		# mov rax, [rip+0x12345678] that's cut after its modrm.
+		code = b"\x90\x90\x48\x8b\x05\x78"
+		dt = distorm3.Decode64Bits
+		self.assertEqual([str(i) for i in distorm3.Decompose(0x1000, code, dt)], ["NOP", "NOP", "DB 0x48", "DB 0x8b", "DB 0x5", "DB 0x78"])
+		for f in (lambda: distorm3.Decompose(0x1000, code, dt, distorm3.DF_STOP_ON_TRUNCATED), lambda: distorm3.DecomposeArray(0x1000, code, dt, distorm3.DF_STOP_ON_TRUNCATED)):
+			self.assertEqual(len(f()), 2)
+			self.assertEqual(len(_withoutNative(f)), 2)
+	def test_next_offset(self):
+		code = b"\x90\x0f\x04"
+		for decompose in ([distorm3._native.decompose] if distorm3._native is not None else []) + [distorm3._decomposeCtypes]:
+			if decompose is distorm3._decomposeCtypes:
+				status, insts, nextOffset = decompose(0x1000, distorm3._CtypesCode(code), 0, distorm3.Decode32Bits, distorm3.DF_STOP_ON_TRUNCATED, 10)
+			else:
+				status, insts, nextOffset = decompose(0x1000, code, 0, distorm3.Decode32Bits, distorm3.DF_STOP_ON_TRUNCATED, 10)
+			# 0f 04 is undecodable, add al, imm8 is cut.
+			self.assertEqual(status, distorm3.DECRES_TRUNCATED)
+			self.assertEqual(len(insts), 2)
+			self.assertEqual(nextOffset, 0x1002)
+	def test_whole(self):
+		code = b"\x90\x48\x8b\x05\x78\x56\x34\x12\xff"
+		insts = distorm3.Decompose(0, code, distorm3.Decode64Bits, distorm3.DF_STOP_ON_TRUNCATED)
+		self.assertEqual([str(i) for i in insts], ["NOP", "MOV RAX, [RIP+0x12345678]"])
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(2000)]))
+			expected = [_instTuple(i) for i in distorm3.Decompose(0, code, dt)]
+			insts = [_instTuple(i) for i in distorm3.Decompose(0, code, dt, distorm3.DF_STOP_ON_TRUNCATED)]
+			self.assertEqual(insts, expected[:len(insts)])
+			self.assertTrue(len(expected) - len(insts) < distorm3.MAX_INSTRUCTION_SIZE)
+
+class TestMain(unittest.TestCase):
+	def run_main(self, code, args, offset = None):
+		fd, path = tempfile.mkstemp()
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(code)
+			args = [sys.executable, "-m", "distorm3"] + args + [path] + ([str(offset)] if offset is not None else [])
+			return subprocess.check_output(args, cwd = os.path.dirname(os.path.abspath(__file__)), universal_newlines = True)
+		finally:
+			os.remove(path)
+	def test_text(self):
+		code = bytes(bytearray([random.randint(0, 255) for i in range(10000)]))
+		expected = "".join(["%.8x: %-32s %s\n" % (o, h, i) for (o, s, i, h) in distorm3.Decode(0, code, distorm3.Decode64Bits)])
+		self.assertEqual(self.run_main(code, ["--b64"]), expected)
+		self.assertEqual(self.run_main(b"", ["--b64"]), "")
+	def test_window(self):
+		code = b"\x90" * 4 + b"\x48\x8b\x05\x78\x56\x34\x12" + b"\x90" * 4
+		lines = self.run_main(code, ["--b64", "--start", "3", "--length", "0x2"], 0x1000).splitlines()
+		# The last instruction that starts in the window is decoded whole.
+		self.assertEqual(lines, ["00001003: 90                               NOP", "00001004: 488b0578563412                   MOV RAX, [RIP+0x12345678]"])
+		self.assertEqual(self.run_main(code, ["--start", "100"]), "")
+	def test_formats(self):
+		code = b"\x90\x48\x8b\x05\x78\x56\x34\x12\xc3"
+		expected = [[0x1000, 1, "NOP", "90"], [0x1001, 7, "MOV RAX, [RIP+0x12345678]", "488b0578563412"], [0x1008, 1, "RET", "c3"]]
+		lines = self.run_main(code, ["--b64", "--format", "jsonl"], 0x1000).splitlines()
+		self.assertEqual([[d["offset"], d["size"], d["instruction"], d["hexdump"]] for d in map(json.loads, lines)], expected)
+		for format, delimiter in (("csv", ","), ("tsv", "\t")):
+			rows = list(csv.reader(io.StringIO(self.run_main(code, ["--b64", "--format", format], 0x1000)), delimiter = delimiter))
+			self.assertEqual(rows[0], ["offset", "size", "instruction", "hexdump"])
+			self.assertEqual(rows[1:], [[str(f) for f in e] for e in expected])
+			# An empty window still has the header.
+			for empty, args in ((code, ["--start", "100"]), (code, ["--length", "0"]), (b"", [])):
+				rows = list(csv.reader(io.StringIO(self.run_main(empty, ["--format", format] + args)), delimiter = delimiter))
+				self.assertEqual(rows, [["offset", "size", "instruction", "hexdump"]])
+
+class TestAio(unittest.TestCase):
+	def collect(self, agen):
+		async def collect():
+			return [inst async for inst in agen]
+		return asyncio.run(collect())
+	def test_decompose(self):
+		code = bytes(bytearray([random.randint(0, 255) for i in range(20000)]))
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			expected = [_instTuple(i) for i in distorm3.Decompose(0x1000, code, dt)]
+			self.assertEqual([_instTuple(i) for i in self.collect(distorm3.aio.adecompose(0x1000, code, dt))], expected)
+			self.assertEqual([_instTuple(i) for i in self.collect(distorm3.aio.adecompose(0x1000, code, dt, with_text = True, batch_size = 7))], expected)
+			self.assertEqual(self.collect(distorm3.aio.adecode(0x1000, code, dt, max_instructions = 100)), distorm3.Decode(0x1000, code, dt, max_instructions = 100))
+		self.assertEqual(self.collect(distorm3.aio.adecompose(0, b"")), [])
+		self.assertRaises(ValueError, self.collect, distorm3.aio.adecompose(0, code, 3))
+		self.assertRaises(ValueError, self.collect, distorm3.aio.adecompose(0, code, batch_size = 0))
+	def test_cancel(self):
+		code = b"\x90" * (1 << 22)
+		async def cancel():
+			ticks = []
+			async def decompose():
+				async for inst in distorm3.aio.adecompose(0, code, batch_size = 100):
+					ticks.append(None)
+			task = asyncio.ensure_future(decompose())
+			# The event loop keeps running while the code is decoded.
+			while len(ticks) < 1000:
+				await asyncio.sleep(0)
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+			return len(ticks)
+		self.assertTrue(asyncio.run(cancel()) < len(code))
+
+class TestCache(unittest.TestCase):
+	def test_same(self):
+		cache = distorm3.cache.DecodeCache()
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(3000)]))
+			# The entry is relocated to the other addresses, which wrap around in 16 and 32 bits.
+			for offset in (0x1000, 0xfffe, 0x7ffffff0, 0xfffffffffffffff0, 0x1000):
+				self.assertEqual(cache.decode(offset, code, dt), distorm3.Decode(offset, code, dt))
+				for withText in (False, True):
+					expected = [_instTuple(i) for i in distorm3.Decompose(offset, code, dt)]
+					self.assertEqual([_instTuple(i) for i in cache.decompose(offset, code, dt, with_text = withText)], expected)
+				self.assertEqual(cache.decode(offset, code, dt, max_instructions = 10, end_address = offset + 20), distorm3.Decode(offset, code, dt, max_instructions = 10, end_address = offset + 20))
+		self.assertEqual(cache.decompose(0, b""), [])
+		self.assertEqual(cache.decode(0, b""), [])
+		self.assertRaises(ValueError, cache.decompose, 0, b"\x90", 3)
+	def test_relocation(self):
+		cache = distorm3.cache.DecodeCache()
+		# call $+5; jmp [rip]
+		code = b"\xe8\x00\x00\x00\x00\xff\x25\x00\x00\x00\x00"
+		self.assertEqual([str(i) for i in cache.decompose(0x1000, code, distorm3.Decode64Bits, with_text = True)], ["CALL 0x1005", "JMP QWORD [RIP+0x0]"])
+		insts = cache.decompose(0x2000, code, distorm3.Decode64Bits, with_text = True)
+		self.assertEqual([str(i) for i in insts], ["CALL 0x2005", "JMP QWORD [RIP+0x0]"])
+		self.assertEqual(insts[0].operands[0].value, 0x2005)
+		self.assertEqual([i.address for i in insts], [0x2000, 0x2005])
+		self.assertEqual((cache.hits, cache.misses, len(cache)), (1, 1, 1))
+	def test_budget(self):
+		cache = distorm3.cache.DecodeCache(1 << 16)
+		for i in range(100):
+			code = struct.pack("<BI", 0xb8, i) * 50
+			cache.decompose(0, code)
+			self.assertTrue(cache.size <= 1 << 16)
+		self.assertTrue(cache.evictions > 0)
+		self.assertEqual(cache.evictions + len(cache), 100)
+		# The most recently used entry is kept.
+		cache.decompose(0, code)
+		self.assertEqual((cache.hits, cache.misses), (1, 100))
+		cache.clear()
+		self.assertEqual((len(cache), cache.size), (0, 0))
+		self.assertRaises(ValueError, distorm3.cache.DecodeCache, 0)
+	def test_single_flight(self):
+		cache = distorm3.cache.DecodeCache()
+		calls = []
+		started = threading.Event()
+		release = threading.Event()
+		def decompose():
+			calls.append(None)
+			started.set()
+			release.wait()
+			return cache._regionEntry(0, memoryview(b"\x90"), distorm3.Decode32Bits, 0, None, None)[1]
+		results = []
+		threads = [threading.Thread(target = lambda: results.append(cache._lookup("key", decompose))) for i in range(4)]
+		threads[0].start()
+		started.wait()
+		for t in threads[1:]:
+			t.start()
+		while cache.hits < 3:
+			threading.Event().wait(0.001)
+		release.set()
+		for t in threads:
+			t.join()
+		self.assertEqual(len(calls), 1)
+		self.assertTrue(all([r is results[0] for r in results]))
+
+class TestDiskCache(unittest.TestCase):
+	def setUp(self):
+		try:
+			import numpy
+		except ImportError:
+			self.skipTest("numpy isn't installed")
+		self.directory = tempfile.mkdtemp()
+		self.code = bytes(bytearray([random.randint(0, 255) for i in range(5000)]))
+	def tearDown(self):
+		import shutil
+		shutil.rmtree(self.directory)
+	def assertArraysEqual(self, a, b):
+		self.assertEqual(len(a), len(b))
+		for name in a.dtype.names:
+			self.assertEqual(a[name].tolist(), b[name].tolist())
+	def test_same(self):
+		cache = distorm3.cache.DiskCache(self.directory)
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			for features in (0, distorm3.DF_RETURN_FC_ONLY):
+				for offset in (0x1000, 0xfffffffffffffff0, 0x1000):
+					self.assertArraysEqual(cache.decomposeArray(offset, self.code, dt, features), distorm3.DecomposeArray(offset, self.code, dt, features))
+		self.assertEqual((cache.hits, cache.misses), (12, 6))
+		self.assertEqual(len(cache.decomposeArray(0, b"")), 0)
+		self.assertRaises(ValueError, cache.decomposeArray, 0, self.code, 3)
+	def test_persistent(self):
+		distorm3.cache.DiskCache(self.directory).decomposeArray(0x1000, self.code, distorm3.Decode64Bits)
+		cache = distorm3.cache.DiskCache(self.directory)
+		insts = cache.decomposeArray(0x1000, self.code, distorm3.Decode64Bits)
+		self.assertEqual((cache.hits, cache.misses), (1, 0))
+		# It's a view of the mapped file.
+		self.assertFalse(insts.flags.writeable)
+		self.assertArraysEqual(insts, distorm3.DecomposeArray(0x1000, self.code, distorm3.Decode64Bits))
+		# Another version of the library doesn't use the files of this one.
+		version = distorm3.cache.DISTORM_VERSION
+		distorm3.cache.DISTORM_VERSION = version + 1
+		try:
+			cache.decomposeArray(0x1000, self.code, distorm3.Decode64Bits)
+		finally:
+			distorm3.cache.DISTORM_VERSION = version
+		self.assertEqual(cache.misses, 1)
+	def test_invalid_file(self):
+		cache = distorm3.cache.DiskCache(self.directory)
+		cache.decomposeArray(0x1000, self.code)
+		for name in os.listdir(self.directory):
+			with open(os.path.join(self.directory, name), "r+b") as f:
+				f.truncate(100)
+		self.assertArraysEqual(cache.decomposeArray(0x1000, self.code), distorm3.DecomposeArray(0x1000, self.code))
+		self.assertEqual((cache.hits, cache.misses), (0, 2))
+	def test_evict(self):
+		cache = distorm3.cache.DiskCache(self.directory, max_bytes = 100000)
+		for i in range(10):
+			cache.decomposeArray(0, self.code[i * 500:])
+			self.assertTrue(cache.size <= 100000)
+		self.assertTrue(len(os.listdir(self.directory)) < 10)
+		cache = distorm3.cache.DiskCache(self.directory, max_age = 60)
+		for name in os.listdir(self.directory)[1:]:
+			os.utime(os.path.join(self.directory, name), (0, 0))
+		cache.evict()
+		self.assertEqual(len(os.listdir(self.directory)), 1)
+		cache.clear()
+		self.assertEqual(os.listdir(self.directory), [])
+		self.assertRaises(ValueError, distorm3.cache.DiskCache, self.directory, 0)
+
+class TestLengths(unittest.TestCase):
+	def test_lengths(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(10000)]))
+			for features in (0, distorm3.DF_SINGLE_BYTE_STEP, distorm3.DF_STOP_ON_TRUNCATED):
+				expected = bytearray([i.size if i.valid else 0 for i in distorm3.Decompose(0, code, dt, features)])
+				self.assertEqual(distorm3.DecodeLengths(code, dt, features), expected)
+				self.assertEqual(_withoutNative(distorm3.DecodeLengths, code, dt, features), expected)
+	def test_boundaries(self):
+		# An undecodable byte, dec [rax-0x75], add eax, 0x12345678.
+		code = b"\xff\xff\x48\x8b\x05\x78\x56\x34\x12"
+		lengths = distorm3.DecodeLengths(memoryview(code), distorm3.Decode64Bits)
+		self.assertEqual(list(lengths), [0, 3, 5])
+		self.assertEqual(sum([n or 1 for n in lengths]), len(code))
+		self.assertEqual(len(distorm3.DecodeLengths(code, distorm3.Decode64Bits, distorm3.DF_SINGLE_BYTE_STEP)), len(code))
+		self.assertEqual(distorm3.DecodeLengths(b"", distorm3.Decode64Bits), bytearray())
+		# add al, imm8 is cut.
+		self.assertEqual(list(distorm3.DecodeLengths(b"\x90\x0f\x04", distorm3.Decode32Bits, distorm3.DF_STOP_ON_TRUNCATED)), [1, 0])
+		self.assertRaises(ValueError, distorm3.DecodeLengths, code, 3)
+
+class TestBitmap(unittest.TestCase):
+	def test_bitmaps(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(10001)]))
+			starts = [i.address for i in distorm3.Decompose(0x1000, code, dt) if i.valid]
+			valid = [i.address for i in distorm3.Decompose(0x1000, code, dt, distorm3.DF_SINGLE_BYTE_STEP) if i.valid]
+			for f in (lambda: distorm3.DecodeBoundaries(0x1000, code, dt), lambda: distorm3.DecodeValidOffsets(0x1000, code, dt)):
+				self.assertEqual(f(), _withoutNative(f))
+			boundaries = distorm3.DecodeBoundaries(0x1000, code, dt)
+			validOffsets = distorm3.DecodeValidOffsets(0x1000, code, dt)
+			self.assertEqual(list(boundaries), starts)
+			self.assertEqual(list(validOffsets), valid)
+			self.assertEqual(boundaries.count(), len(starts))
+			self.assertEqual(len(boundaries.bits), (len(code) + 7) // 8)
+			self.assertEqual(boundaries & validOffsets, boundaries)
+			self.assertEqual(boundaries | validOffsets, validOffsets)
+			self.assertEqual(list(validOffsets & ~boundaries), sorted(set(valid) - set(starts)))
+			self.assertEqual((~boundaries).count(), len(code) - len(starts))
+	def test_contains(self):
+		# An undecodable byte, dec [rax-0x75], add eax, 0x12345678.
+		code = b"\xff\xff\x48\x8b\x05\x78\x56\x34\x12"
+		boundaries = distorm3.DecodeBoundaries(0xfffffffffffffffe, code, distorm3.Decode64Bits)
+		self.assertEqual([a in boundaries for a in (0xfffffffffffffffe, 0xffffffffffffffff, 0, 1, 2, 3, 4)], [False, True, False, False, True, False, False])
+		self.assertFalse(7 in boundaries)
+		self.assertFalse(0xfffffffffffffffd in boundaries)
+		self.assertEqual(len(boundaries), len(code))
+		self.assertEqual(list(distorm3.DecodeBoundaries(0, b"", distorm3.Decode64Bits)), [])
+		self.assertRaises(ValueError, lambda: boundaries & distorm3.DecodeBoundaries(0, code, distorm3.Decode64Bits))
+		self.assertRaises(ValueError, distorm3.DecodeValidOffsets, 0, code, 3)
+
+class TestFilter(unittest.TestCase):
+	def test_filters(self):
+		filters = [
+			(distorm3.DecodeFilter(opcodes = ["MOV", 0x47]), lambda i: i.mnemonic in ("MOV", "CMP")),
+			(distorm3.DecodeFilter(classes = ["ISC_SSE", "ISC_SSE2"]), lambda i: i.instructionClass in ("ISC_SSE", "ISC_SSE2")),
+			(distorm3.DecodeFilter(flow_control = ["FC_CALL", distorm3.FlowControl.RET]), lambda i: i.flowControl in ("FC_CALL", "FC_RET")),
+			(distorm3.DecodeFilter(flow_control = ["FC_NONE"], registers = ["RM_SP", "RM_BP"]), lambda i: i.flowControl == "FC_NONE" and ("RM_SP" in i.registers or "RM_BP" in i.registers)),
+			(distorm3.DecodeFilter(registers = 0x400), lambda i: "RM_SSE" in i.registers),
+			(distorm3.DecodeFilter(rip_relative = True), lambda i: i.rawFlags & distorm3.FLAG_RIP_RELATIVE),
+			(distorm3.DecodeFilter(privileged = True, opcodes = ["HLT", "CLI"]), lambda i: i.privileged and i.mnemonic in ("HLT", "CLI"))]
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(20000)]))
+			insts = [i for i in distorm3.Decompose(0x1000, code, dt) if i.valid]
+			for decodeFilter, match in filters:
+				expected = [_instTuple(i) for i in insts if match(i)]
+				for f in (lambda: [_instTuple(i) for i in distorm3.Decompose(0x1000, code, dt, filter = decodeFilter)],
+					lambda: [_instTuple(i) for i in distorm3.Decompose(0x1000, code, dt, with_text = True, filter = decodeFilter)]):
+					self.assertEqual(f(), expected)
+					self.assertEqual(_withoutNative(f), expected)
+				array = distorm3.DecomposeArray(0x1000, code, dt, filter = decodeFilter)
+				self.assertEqual(list(array['addr']), [i[0] for i in expected])
+				self.assertTrue((_withoutNative(distorm3.DecomposeArray, 0x1000, code, dt, 0, decodeFilter) == array).all())
+	def test_stop(self):
+		# The instructions that are filtered out don't stop the decoding: nop, ret, call, nop.
+		code = b"\x90\xc3\xe8\x00\x00\x00\x00\x90"
+		decodeFilter = distorm3.DecodeFilter(flow_control = ["FC_CALL"])
+		insts = distorm3.Decompose(0, code, distorm3.Decode32Bits, distorm3.DF_STOP_ON_RET, filter = decodeFilter)
+		self.assertEqual([str(i) for i in insts], ["CALL 0x7"])
+		self.assertEqual(distorm3.Decompose(0, b"\xff\xff", distorm3.Decode32Bits, filter = distorm3.DecodeFilter()), [])
+	def test_empty_window(self):
+		# A window of the code (see _MAX_CODE_LENGTH) without a matching instruction doesn't end the decoding.
+		code = bytearray(b"\x00" * 1000 + b"\xc3")
+		decodeFilter = distorm3.DecodeFilter(flow_control = ["FC_RET"])
+		limit = distorm3._MAX_CODE_LENGTH
+		distorm3._MAX_CODE_LENGTH = 64
+		try:
+			insts = _withoutNative(distorm3.Decompose, 0, code, distorm3.Decode32Bits, 0, False, None, None, decodeFilter)
+			array = _withoutNative(distorm3.DecomposeArray, 0, code, distorm3.Decode32Bits, 0, decodeFilter)
+		finally:
+			distorm3._MAX_CODE_LENGTH = limit
+		self.assertEqual([(i.address, str(i)) for i in insts], [(1000, "RET")])
+		self.assertEqual(list(array['addr']), [1000])
+	def test_invalid(self):
+		self.assertRaises(ValueError, distorm3.DecodeFilter, opcodes = ["NOSUCH"])
+		self.assertRaises(ValueError, distorm3.DecodeFilter, opcodes = [0xffff])
+		self.assertRaises(ValueError, distorm3.DecodeFilter, classes = ["ISC_NOSUCH"])
+		self.assertRaises(ValueError, distorm3.DecodeFilter, flow_control = [9])
+		self.assertRaises(ValueError, distorm3.DecodeFilter, registers = ["RSP"])
+		if distorm3._native is not None:
+			self.assertRaises(TypeError, distorm3._native.decompose, 0, b"\x90", 0, 1, 0, 1, None, [None, 0, 0, 0, 0])
+			self.assertRaises(ValueError, distorm3._native.decompose, 0, b"\x90", 0, 1, 0, 1, None, (b"", 0, 0, 0, 0))
+
+class TestEvents(unittest.TestCase):
+	def test_events(self):
+		featuresList = [distorm3.DF_STOP_ON_FLOW_CONTROL,
+			distorm3.DF_STOP_ON_CALL | distorm3.DF_STOP_ON_PRIVILEGED,
+			distorm3.DF_STOP_ON_RET | distorm3.DF_STOP_ON_UNDECODEABLE,
+			distorm3.DF_STOP_ON_CND_BRANCH | distorm3.DF_SINGLE_BYTE_STEP]
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(5000)]))
+			for features in featuresList:
+				# The same instructions without the stop features, the events are the ones that would stop.
+				insts = distorm3.Decompose(0x1000, code, dt, features & ~(distorm3.DF_STOP_ON_FLOW_CONTROL | distorm3.DF_STOP_ON_PRIVILEGED | distorm3.DF_STOP_ON_UNDECODEABLE))
+				expected = [(i.address, str(i), distorm3._stopReason(features, i._di)) for i in insts if distorm3._stopReason(features, i._di)]
+				f = lambda: [(i.address, str(i), reason) for i, reason in distorm3.DecomposeEvents(0x1000, code, dt, features)]
+				self.assertEqual(f(), expected)
+				self.assertEqual(_withoutNative(f), expected)
+				self.assertEqual([(i.address, str(i), reason) for i, reason in distorm3.DecomposeEvents(0x1000, code, dt, features, max_events = 3)], expected[:3])
+	def test_reasons(self):
+		# call, nop, cli, ret, and two undecodable bytes.
+		code = b"\xe8\x00\x00\x00\x00\x90\xfa\xc3\xff\xff"
+		features = distorm3.DF_STOP_ON_CALL | distorm3.DF_STOP_ON_RET | distorm3.DF_STOP_ON_PRIVILEGED | distorm3.DF_STOP_ON_UNDECODEABLE
+		expected = [("CALL 0x5", distorm3.DF_STOP_ON_CALL), ("CLI", distorm3.DF_STOP_ON_PRIVILEGED), ("RET", distorm3.DF_STOP_ON_RET),
+			("DB 0xff", distorm3.DF_STOP_ON_UNDECODEABLE), ("DB 0xff", distorm3.DF_STOP_ON_UNDECODEABLE)]
+		f = lambda: [(str(i), reason) for i, reason in distorm3.DecomposeEvents(0, code, distorm3.Decode32Bits, features)]
+		self.assertEqual(f(), expected)
+		self.assertEqual(_withoutNative(f), expected)
+		# The decoding is resumed right after an undecodable byte that it stops on.
+		if distorm3._native is not None:
+			self.assertEqual(distorm3._native.decompose(0, b"\x90\xd6\x90", 0, distorm3.Decode64Bits, distorm3.DF_STOP_ON_UNDECODEABLE, 10)[2], 2)
+	def test_truncated(self):
+		# The events end at the truncated call.
+		code = b"\xc3\x90\xe8\x00\x00"
+		features = distorm3.DF_STOP_ON_FLOW_CONTROL | distorm3.DF_STOP_ON_TRUNCATED
+		f = lambda: [str(i) for i, reason in distorm3.DecomposeEvents(0, code, distorm3.Decode32Bits, features)]
+		self.assertEqual(f(), ["RET"])
+		self.assertEqual(_withoutNative(f), ["RET"])
+		self.assertEqual(list(distorm3.DecomposeEvents(0, b"", distorm3.Decode32Bits)), [])
+		self.assertRaises(ValueError, lambda: list(distorm3.DecomposeEvents(0, code, 3)))
+
+class TestRegion(unittest.TestCase):
+	def test_region(self):
+		for dt in (distorm3.Decode16Bits, distorm3.Decode32Bits, distorm3.Decode64Bits):
+			code = bytes(bytearray([random.randint(0, 255) for i in range(5000)]))
+			for end in (0x1000, 0x1001, 0x1800, 0x1000 + len(code), 0x1000 + 2 * len(code)):
+				for features in (0, distorm3.DF_STOP_ON_FLOW_CONTROL, distorm3.DF_SINGLE_BYTE_STEP):
+					expected = [_instTuple(i) for i in distorm3.Decompose(0x1000, code, dt, features, end_address = end)]
+					f = lambda: distorm3.DecomposeRegion(0x1000, code, dt, features, end)
+					for insts, stop, nextAddress in (f(), _withoutNative(f)):
+						self.assertEqual([_instTuple(i) for i in insts], expected)
+						if features == 0:
+							self.assertEqual(stop, distorm3.DECSTOP_REGION_END if end < 0x1000 + len(code) else distorm3.DECSTOP_CODE_END)
+	def test_stops(self):
+		nops = b"\x90\x90"
+		cases = [
+			(b"\xc3\x90", distorm3.DF_STOP_ON_RET, None, None, (["NOP", "NOP", "RET"], distorm3.DECSTOP_FLOW_CONTROL, 3)),
+			(b"\xfa\x90", distorm3.DF_STOP_ON_PRIVILEGED, None, None, (["NOP", "NOP", "CLI"], distorm3.DECSTOP_PRIVILEGED, 3)),
+			(b"\xff\xff", distorm3.DF_STOP_ON_UNDECODEABLE, None, None, (["NOP", "NOP", "DB 0xff"], distorm3.DECSTOP_UNDECODABLE, 3)),
+			(b"\xe8\x00", distorm3.DF_STOP_ON_TRUNCATED, None, None, (["NOP", "NOP"], distorm3.DECSTOP_TRUNCATED, 2)),
+			(b"\xc3", 0, None, None, (["NOP", "NOP", "RET"], distorm3.DECSTOP_CODE_END, 3)),
+			# The instruction that starts before the end is decoded whole.
+			(b"\xb8\x01\x02\x03\x04\x90", 0, 3, None, (["NOP", "NOP", "MOV EAX, 0x4030201"], distorm3.DECSTOP_REGION_END, 7)),
+			(b"\x90\x90", 0, None, 3, (["NOP", "NOP", "NOP"], distorm3.DECSTOP_RESULTS_FULL, 3))]
+		for code, features, end, maxInstructions, (texts, stop, nextIndex) in cases:
+			f = lambda: distorm3.DecomposeRegion(0x100, nops + code, distorm3.Decode32Bits, features, None if end is None else 0x100 + end, maxInstructions)
+			for insts, s, nextAddress in (f(), _withoutNative(f)):
+				self.assertEqual(([str(i) for i in insts], s, nextAddress), (texts, stop, 0x100 + nextIndex))
+		self.assertEqual(distorm3.DecomposeRegion(0, b"", distorm3.Decode32Bits), ([], distorm3.DECSTOP_CODE_END, 0))
+	def test_wrap(self):
+		nops = b"\x90" * 8
+		# An end below the offset is an empty region.
+		f = lambda: distorm3.DecomposeRegion(0x1000, nops, distorm3.Decode32Bits, 0, 0xfff)
+		for insts, stop, nextAddress in (f(), _withoutNative(f)):
+			self.assertEqual((insts, stop, nextAddress), ([], distorm3.DECSTOP_REGION_END, 0x1000))
+		# Unless the code wraps around the end of the address space up to it.
+		start = (1 << (distorm3.OffsetTypeSize * 8)) - 4
+		f = lambda: distorm3.DecomposeRegion(start, nops, distorm3.Decode32Bits, 0, 2)
+		for insts, stop, nextAddress in (f(), _withoutNative(f)):
+			self.assertEqual((len(insts), stop, nextAddress), (6, distorm3.DECSTOP_REGION_END, 2))
+		f = lambda: distorm3.DecomposeRegion(start, nops, distorm3.Decode32Bits)
+		for insts, stop, nextAddress in (f(), _withoutNative(f)):
+			self.assertEqual((len(insts), stop, nextAddress), (8, distorm3.DECSTOP_CODE_END, 4))
+		self.assertRaises(ValueError, distorm3.DecomposeRegion, 0, nops, 3)
+
 def GetNewSuite(className):
 	suite = unittest.TestSuite()
 	suite.addTest(unittest.makeSuite(className))
@@ -2146,6 +3167,30 @@ if __name__ == "__main__":
 	suite.addTest(GetNewSuite(TestInvalid))
 	suite.addTest(GetNewSuite(TestFeatures))
 	suite.addTest(GetNewSuite(TestAPI))
+	suite.addTest(GetNewSuite(TestNative))
+	suite.addTest(GetNewSuite(TestBuffers))
+	suite.addTest(GetNewSuite(TestLazyInstruction))
+	suite.addTest(GetNewSuite(TestText))
+	suite.addTest(GetNewSuite(TestArray))
+	suite.addTest(GetNewSuite(TestDecoder))
+	suite.addTest(GetNewSuite(TestLimits))
+	suite.addTest(GetNewSuite(TestOne))
+	suite.addTest(GetNewSuite(TestMany))
+	suite.addTest(GetNewSuite(TestAt))
+	suite.addTest(GetNewSuite(TestParallel))
+	suite.addTest(GetNewSuite(TestSweep))
+	suite.addTest(GetNewSuite(TestPool))
+	suite.addTest(GetNewSuite(TestStream))
+	suite.addTest(GetNewSuite(TestTruncated))
+	suite.addTest(GetNewSuite(TestMain))
+	suite.addTest(GetNewSuite(TestAio))
+	suite.addTest(GetNewSuite(TestCache))
+	suite.addTest(GetNewSuite(TestDiskCache))
+	suite.addTest(GetNewSuite(TestLengths))
+	suite.addTest(GetNewSuite(TestBitmap))
+	suite.addTest(GetNewSuite(TestFilter))
+	suite.addTest(GetNewSuite(TestEvents))
+	suite.addTest(GetNewSuite(TestRegion))
 	result = unittest.TextTestRunner(verbosity=1).run(suite)
 	if result.wasSuccessful():
 		exit(0)
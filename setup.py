@@ -22,6 +22,7 @@ def main():
     # Setup instructions
     'requires'          : ['ctypes'],
     'provides'          : ['distorm3'],
+    'extras_require'    : { 'numpy' : ['numpy'] }, # DecomposeArray
     'packages'          : ['distorm3'],
     'package_dir'       : { '' : 'python' },
     'ext_modules'       : [distorm_module],
@@ -98,6 +98,8 @@ static _DecodeResult decode_inst(_CodeInfo* ci, _PrefixState* ps, const uint8_t*
 	/* The ModR/M byte of the current instruction. */
 	unsigned int modrm = 0;
 	int isPrefixed = 0;
+	/* Remaining length at the start of the instruction, codeLen isn't always in sync with code upon failure. */
+	int startCodeLen = ci->codeLen;
 
 	ii = inst_lookup(ci, ps, &isPrefixed);
 	if (ii == NULL) goto _Undecodable;
@@ -399,7 +401,6 @@ _SkipOpcoding:
 _Undecodable: /* If the instruction couldn't be decoded for some reason, fail. */
 	/* Special case for WAIT instruction: If it's dropped as a prefix, we have to return a valid instruction! */
 	if (*startCode == INST_WAIT_INDEX) {
-		int delta;
 		memset(di, 0, sizeof(_DInst));
 		di->addr = ci->codeOffset & ci->addrMask;
 		di->imm.byte = INST_WAIT_INDEX;
@@ -410,8 +411,7 @@ _Undecodable: /* If the instruction couldn't be decoded for some reason, fail. *
 		META_SET_ISC(di, ISC_INTEGER);
 
 		/* Fix ci because WAIT could be a prefix that failed, and ci->code is now out of sync. */
-		delta = (int)(ci->code - startCode); /* How many bytes we read so far. */
-		ci->codeLen += delta - 1;
+		ci->codeLen = startCodeLen - 1;
 		ci->code = startCode + 1;
 		/* codeOffset is fixed outside. */
 
@@ -422,6 +422,38 @@ _Undecodable: /* If the instruction couldn't be decoded for some reason, fail. *
 	return DECRES_INPUTERR;
 }
 
+/*
+ * Checks whether the code that failed decoding is the beginning of an instruction that continues beyond the code's end.
+ * That's what decoding it again with zeros padding it to a maximum sized instruction tells,
+ * as the undecodable bytes are still undecodable when padded, unless they need more bytes.
+ */
+static int is_truncated(const _CodeInfo* ci, const uint8_t* code, int codeLen, _OffsetType codeOffset)
+{
+	uint8_t padded[INST_MAXIMUM_SIZE] = { 0 };
+	_CodeInfo paddedCi = *ci;
+	_PrefixState ps;
+	_DInst di;
+
+	if (codeLen >= INST_MAXIMUM_SIZE) return FALSE;
+
+	memcpy(padded, code, codeLen);
+	paddedCi.code = padded;
+	paddedCi.codeLen = INST_MAXIMUM_SIZE;
+	paddedCi.codeOffset = codeOffset;
+	memset(&ps, 0, sizeof(ps));
+	return (decode_inst(&paddedCi, &ps, padded, &di) == DECRES_SUCCESS) && (di.size > codeLen);
+}
+
+/* Checks whether a decoded instruction matches all the criteria of the filter. */
+static int filter_match(const _DecodeFilter* filter, const _DInst* di)
+{
+	if ((filter->opcodes != NULL) && !((filter->opcodes[di->opcode >> 3] >> (di->opcode & 7)) & 1)) return FALSE;
+	if (filter->iscMask && !(filter->iscMask & (1 << META_GET_ISC(di->meta)))) return FALSE;
+	if (filter->fcMask && !(filter->fcMask & (1 << META_GET_FC(di->meta)))) return FALSE;
+	if (filter->usedRegistersMask && !(filter->usedRegistersMask & di->usedRegistersMask)) return FALSE;
+	return (di->flags & filter->flags) == filter->flags;
+}
+
 /*
  * decode_internal
  *
@@ -429,8 +461,10 @@ _Undecodable: /* If the instruction couldn't be decoded for some reason, fail. *
  *                  So although, the array is now of type _DInst, we want to read it in jumps of the old array element's size.
  *                  This is in order to save memory allocation for conversion between the new and the old structures.
  *                  It really means we can do the conversion in-place now.
+ * filter - Optional, only the instructions that match it are returned, like DF_RETURN_FC_ONLY does.
+ * region - Optional, the decoding stops at its endOffset, and the reason that it stopped for is set in it.
  */
-_DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[], unsigned int maxResultCount, unsigned int* usedInstructionsCount)
+_DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, const _DecodeFilter* filter, _DecodeRegion* region, _DInst result[], unsigned int maxResultCount, unsigned int* usedInstructionsCount)
 {
 	_CodeInfo ci = *_ci; /* A working copy, we don't touch user's _ci except OUT params. */
 	_PrefixState ps;
@@ -440,6 +474,10 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 	_OffsetType codeOffset;
 
 	_DecodeResult ret = DECRES_SUCCESS;
+	_DecodeStop stop = DECSTOP_CODE_END;
+	/* Length of the region from the beginning of the code, without a region the code is never that long. */
+	_OffsetType regionLen = (_OffsetType)-1;
+	_OffsetType startOffset = ci.codeOffset;
 
 	/* Current working decoded instruction in results. */
 	_DInst* pdi = (_DInst*)&result[0]; /* There's always a room for at least one slot, checked earlier. */
@@ -475,6 +513,12 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 	else if (features & DF_MAXIMUM_ADDR16) ci.addrMask = 0xffff;
 #endif
 
+	if (region != NULL) {
+		regionLen = region->endOffset - ci.codeOffset;
+		/* An end below the code is an empty region, unless the code wraps around the address space up to it. */
+		if ((region->endOffset < ci.codeOffset) && (regionLen > (_OffsetType)ci.codeLen)) regionLen = 0;
+	}
+
 	ps.count = 1; /* Force zero'ing ps below. */
 
 	/* Decode instructions as long as we have what to decode/enough room in entries. */
@@ -484,12 +528,21 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 		codeOffset = ci.codeOffset;
 
 		if (ps.count) memset(&ps, 0, sizeof(ps));
+		/* Operands mark prefixes as used even for an instruction without any, that mustn't leak into the next one. */
+		else ps.usedPrefixes = 0;
 
 		/**** INSTRUCTION DECODING NEXT: ****/
 
+		/* Don't decode an instruction that starts after the region, the offsets might wrap around. */
+		if ((_OffsetType)(codeOffset - startOffset) >= regionLen) {
+			stop = DECSTOP_REGION_END;
+			break;
+		}
+
 		/* Make sure we didn't run out of output entries. */
 		if (pdi >= maxResultAddr) {
 			ret = DECRES_MEMORYERR;
+			stop = DECSTOP_RESULTS_FULL;
 			break;
 		}
 
@@ -499,7 +552,7 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 
 		if (ret == DECRES_SUCCESS) {
 
-			if (features & (DF_SINGLE_BYTE_STEP | DF_RETURN_FC_ONLY | DF_STOP_ON_PRIVILEGED | DF_STOP_ON_FLOW_CONTROL)) {
+			if ((features & (DF_SINGLE_BYTE_STEP | DF_RETURN_FC_ONLY | DF_STOP_ON_PRIVILEGED | DF_STOP_ON_FLOW_CONTROL)) || (filter != NULL)) {
 
 				/* Sync codeinfo, remember that currently it points to beginning of the instruction and prefixes if any. */
 				if (features & DF_SINGLE_BYTE_STEP) {
@@ -512,10 +565,14 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 				if ((features & DF_RETURN_FC_ONLY) && (META_GET_FC(pdi->meta) == FC_NONE)) {
 					continue;
 				}
+				if ((filter != NULL) && !filter_match(filter, pdi)) {
+					continue;
+				}
 
 				/* Check whether we need to stop on any feature. */
 				if ((features & DF_STOP_ON_PRIVILEGED) && (FLAG_GET_PRIVILEGED(pdi->flags))) {
 					pdi = (_DInst*)((char*)pdi + diStructSize);
+					stop = DECSTOP_PRIVILEGED;
 					break; /* ret = DECRES_SUCCESS; */
 				}
 
@@ -530,6 +587,7 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 						((features & DF_STOP_ON_CMOV) && (mfc == FC_CMOV)) ||
 						((features & DF_STOP_ON_HLT) && (mfc == FC_HLT)))) {
 						pdi = (_DInst*)((char*)pdi + diStructSize);
+						stop = DECSTOP_FLOW_CONTROL;
 						break; /* ret = DECRES_SUCCESS; */
 					}
 				}
@@ -540,20 +598,22 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 		}
 		else { /* ret == DECRES_INPUTERR */
 
+			/* Leave an instruction that the code ends in the middle of to the caller, who might have more code. */
+			if ((features & DF_STOP_ON_TRUNCATED) && is_truncated(&ci, code, codeLen, codeOffset)) {
+				ci.codeOffset = codeOffset;
+				ret = DECRES_TRUNCATED;
+				stop = DECSTOP_TRUNCATED;
+				break;
+			}
+
 			/* Handle failure of decoding last instruction. */
-			if ((!(features & DF_RETURN_FC_ONLY))) {
+			if (!(features & DF_RETURN_FC_ONLY) && (filter == NULL)) {
 				memset(pdi, 0, sizeof(_DInst));
 				pdi->flags = FLAG_NOT_DECODABLE;
 				pdi->imm.byte = *code;
 				pdi->size = 1;
 				pdi->addr = codeOffset & ci.addrMask;
 				pdi = (_DInst*)((char*)pdi + diStructSize);
-
-				/* If an instruction wasn't decoded then stop on undecodeable if set. */
-				if (features & DF_STOP_ON_UNDECODEABLE) {
-					ret = DECRES_SUCCESS;
-					break;
-				}
 			}
 
 			/* Skip a single byte in case of a failure and retry instruction. */
@@ -563,12 +623,86 @@ _DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[
 
 			/* Reset return value. */
 			ret = DECRES_SUCCESS;
+
+			/* If an instruction wasn't decoded then stop on undecodeable if set, the next offset is past the byte. */
+			if ((features & DF_STOP_ON_UNDECODEABLE) && !(features & DF_RETURN_FC_ONLY) && (filter == NULL)) {
+				stop = DECSTOP_UNDECODABLE;
+				break;
+			}
 		}
 	}
 
 	/* Set OUT params. */
 	*usedInstructionsCount = (unsigned int)(((size_t)pdi - (size_t)result) / (size_t)diStructSize);
 	_ci->nextOffset = ci.codeOffset;
+	if (region != NULL) region->stop = stop;
+
+	return ret;
+}
+
+/*
+ * decode_lengths
+ *
+ * Decodes the instructions like decode_internal does, but only writes their lengths to the result array, a byte each.
+ * An undecodable byte gets a zero length, it's skipped like decode_internal skips it.
+ * Every instruction is decoded into the same local _DInst, which stays in the cache,
+ * instead of filling an array of them that the caller then has to go through.
+ * Only the DF_SINGLE_BYTE_STEP and DF_STOP_ON_TRUNCATED features apply.
+ */
+_DecodeResult decode_lengths(_CodeInfo* _ci, uint8_t result[], unsigned int maxResultCount, unsigned int* usedLengthsCount)
+{
+	_CodeInfo ci = *_ci;
+	_PrefixState ps;
+	_DInst di;
+	const uint8_t* code;
+	int codeLen;
+	_OffsetType codeOffset;
+	unsigned int features = ci.features, count = 0;
+	_DecodeResult ret = DECRES_SUCCESS;
+
+	ci.addrMask = (_OffsetType)-1;
+	/* Nothing but the length is looked at. */
+	ci.features &= ~DF_FILL_EFLAGS;
+
+	ps.count = 1; /* Force zero'ing ps below. */
+
+	while (ci.codeLen > 0) {
+		code = ci.code;
+		codeLen = ci.codeLen;
+		codeOffset = ci.codeOffset;
+
+		if (ps.count) memset(&ps, 0, sizeof(ps));
+		else ps.usedPrefixes = 0;
+
+		if (count >= maxResultCount) {
+			ret = DECRES_MEMORYERR;
+			break;
+		}
+
+		if (decode_inst(&ci, &ps, code, &di) == DECRES_SUCCESS) {
+			result[count++] = di.size;
+			if (features & DF_SINGLE_BYTE_STEP) {
+				ci.code = code + 1;
+				ci.codeLen = codeLen - 1;
+				ci.codeOffset = codeOffset + 1;
+			}
+			else ci.codeOffset += di.size;
+			continue;
+		}
+
+		if ((features & DF_STOP_ON_TRUNCATED) && is_truncated(&ci, code, codeLen, codeOffset)) {
+			ret = DECRES_TRUNCATED;
+			break;
+		}
+
+		result[count++] = 0;
+		ci.code = code + 1;
+		ci.codeLen = codeLen - 1;
+		ci.codeOffset = codeOffset + 1;
+	}
+
+	*usedLengthsCount = count;
+	_ci->nextOffset = ci.codeOffset;
 
 	return ret;
 }
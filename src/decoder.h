@@ -16,6 +16,7 @@ This library is licensed under the BSD license. See the file COPYING.
 
 typedef unsigned int _iflags;
 
-_DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, _DInst result[], unsigned int maxResultCount, unsigned int* usedInstructionsCount);
+_DecodeResult decode_internal(_CodeInfo* _ci, int supportOldIntr, const _DecodeFilter* filter, _DecodeRegion* region, _DInst result[], unsigned int maxResultCount, unsigned int* usedInstructionsCount);
+_DecodeResult decode_lengths(_CodeInfo* _ci, uint8_t result[], unsigned int maxResultCount, unsigned int* usedLengthsCount);
 
 #endif /* DECODER_H */
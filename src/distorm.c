@@ -40,7 +40,82 @@ This library is licensed under the BSD license. See the file COPYING.
 		return DECRES_INPUTERR;
 	}
 
-	return decode_internal(ci, FALSE, result, maxInstructions, usedInstructionsCount);
+	return decode_internal(ci, FALSE, NULL, NULL, result, maxInstructions, usedInstructionsCount);
+}
+
+#ifdef SUPPORT_64BIT_OFFSET
+	_DLLEXPORT_ _DecodeResult distorm_decompose_filtered64(_CodeInfo* ci, const _DecodeFilter* filter, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#else
+	_DLLEXPORT_ _DecodeResult distorm_decompose_filtered32(_CodeInfo* ci, const _DecodeFilter* filter, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#endif
+{
+	if (usedInstructionsCount == NULL) {
+		return DECRES_SUCCESS;
+	}
+
+	if ((ci == NULL) ||
+		(filter == NULL) ||
+		(ci->codeLen < 0) ||
+		((unsigned)ci->dt > (unsigned)Decode64Bits) ||
+		(ci->code == NULL) ||
+		(result == NULL) ||
+		(maxInstructions == 0) ||
+		((ci->features & (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32)) == (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32)))
+	{
+		return DECRES_INPUTERR;
+	}
+
+	return decode_internal(ci, FALSE, filter, NULL, result, maxInstructions, usedInstructionsCount);
+}
+
+#ifdef SUPPORT_64BIT_OFFSET
+	_DLLEXPORT_ _DecodeResult distorm_decompose_region64(_CodeInfo* ci, _DecodeRegion* region, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#else
+	_DLLEXPORT_ _DecodeResult distorm_decompose_region32(_CodeInfo* ci, _DecodeRegion* region, _DInst result[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#endif
+{
+	if (region != NULL) region->stop = DECSTOP_NONE;
+
+	if (usedInstructionsCount == NULL) {
+		return DECRES_SUCCESS;
+	}
+
+	if ((ci == NULL) ||
+		(region == NULL) ||
+		(ci->codeLen < 0) ||
+		((unsigned)ci->dt > (unsigned)Decode64Bits) ||
+		(ci->code == NULL) ||
+		(result == NULL) ||
+		(maxInstructions == 0) ||
+		((ci->features & (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32)) == (DF_MAXIMUM_ADDR16 | DF_MAXIMUM_ADDR32)))
+	{
+		return DECRES_INPUTERR;
+	}
+
+	return decode_internal(ci, FALSE, NULL, region, result, maxInstructions, usedInstructionsCount);
+}
+
+#ifdef SUPPORT_64BIT_OFFSET
+	_DLLEXPORT_ _DecodeResult distorm_lengths64(_CodeInfo* ci, unsigned char lengths[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#else
+	_DLLEXPORT_ _DecodeResult distorm_lengths32(_CodeInfo* ci, unsigned char lengths[], unsigned int maxInstructions, unsigned int* usedInstructionsCount)
+#endif
+{
+	if (usedInstructionsCount == NULL) {
+		return DECRES_SUCCESS;
+	}
+
+	if ((ci == NULL) ||
+		(ci->codeLen < 0) ||
+		((unsigned)ci->dt > (unsigned)Decode64Bits) ||
+		(ci->code == NULL) ||
+		(lengths == NULL) ||
+		(maxInstructions == 0))
+	{
+		return DECRES_INPUTERR;
+	}
+
+	return decode_lengths(ci, lengths, maxInstructions, usedInstructionsCount);
 }
 
 #ifndef DISTORM_LIGHT
@@ -397,7 +472,7 @@ skipOperands:
 	else if (dt == Decode32Bits) ci.addrMask = 0xffffffff;
 	else ci.addrMask = (_OffsetType)-1;
 
-	res = decode_internal(&ci, TRUE, (_DInst*)result, maxInstructions, usedInstructionsCount);
+	res = decode_internal(&ci, TRUE, NULL, NULL, (_DInst*)result, maxInstructions, usedInstructionsCount);
 	instsCount = *usedInstructionsCount;
 	for (i = 0; i < instsCount; i++) {
 		/* distorm_format is optimized and can work with same input/output buffer in-place. */